@@ -0,0 +1,283 @@
+"""
+Performance benchmarks of the query building, fetching, writing and db investigation
+
+Usage:
+	python bench.py                                   - run on a copy of test.sqlite
+	python bench.py --rows 10000,1000000              - run on copies scaled to the given number of items
+	python bench.py --output base.json                - save results
+	python bench.py --baseline base.json              - compare with saved results, exit code 1 on regressions
+"""
+
+__author__ = "DarkPark"
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+from sql import *
+
+"Benchmark functions by name"
+benchmarks = {}
+
+def benchmark(func):
+	"""Register the benchmark function
+	*func* is the function getting the db file name and returning the number of operations made
+	"""
+	benchmarks[func.__name__] = func
+	return func
+
+def scale(source, path, rows):
+	"""Make a copy of the db with the given number of items and info records
+	*source* is the original db file name
+	*path* is the new db file name
+	*rows* is the number of items, the original data is kept if 0
+	"""
+	shutil.copy(source, path)
+	if not rows:
+		return
+	conn = sqlite3.connect(path)
+	count = conn.execute('select count(*) from items').fetchone()[0]
+	if rows > count:
+		conn.execute('''with recursive n(i) as (select ? union all select i + 1 from n where i < ?)
+			insert into items (id_src, id_section, id_section_neo, id_update, id_shop, id_brand, art, name, price, price_diff, warranty, access, is_new)
+			select i % 10, i % 339 + 1, i % 50, i % 100, i % 20, i % 199 + 1, 'art' || i, 'item ' || i, (i % 100000) / 10.0, 0.0, i % 36, 0, i % 2 from n''', (count + 1, rows))
+		conn.execute('''insert into info (id_update, id_item, price)
+			select id_update, id, price from items where id > (select coalesce(max(id_item), 0) from info)''')
+	conn.commit()
+	conn.execute('analyze')
+	conn.close()
+
+def chain(db):
+	"""Make the typical select query
+	*db* is the DataBase object
+	Returns SqlBuilder object
+	"""
+	return SqlBuilder().Select(db.items.id, db.items.name, db.items.price)\
+		.From(db.items)\
+		.Join(db.sections, db.sections.id == db.items.id_section, 'left')\
+		.Where((db.items.price > 10.0) & (db.items.is_new == 1))\
+		.OrderBy(db.items.price, 'desc')\
+		.Limit(50)
+
+@benchmark
+def build_chain(path):
+	"Building of the select query with chained calls"
+	db = DataBase(path)
+	for i in range(2000):
+		chain(db).BuildSelect()
+	return 2000
+
+@benchmark
+def build_select(path):
+	"BuildSelect call for the prepared query"
+	query = chain(DataBase(path))
+	for i in range(5000):
+		query.BuildSelect()
+	return 5000
+
+@benchmark
+def build_deep_where(path):
+	"Building of the select with deep where tree of 200 conditions"
+	db = DataBase(path)
+	for i in range(50):
+		condition = db.items.id == 0
+		for id in range(1, 200):
+			condition = (condition | (db.items.id == id)) if id % 2 else (condition & (db.items.id_brand != id))
+		SqlBuilder().Select(db.items.id).From(db.items).Where(condition).BuildSelect()
+	return 50 * 200
+
+@benchmark
+def fetch_from(path):
+	"Iteration over the FetchFrom cursor, rows"
+	db = DataBase(path)
+	rows = 0
+	for row in SqlBuilder().Select(db.items.id, db.items.name, db.items.price).From(db.items).FetchFrom(db):
+		rows += 1
+	return rows
+
+@benchmark
+def fetch_all(path):
+	"FetchAllFrom of the whole table, rows"
+	db = DataBase(path)
+	return len(SqlBuilder().Select(db.items.id, db.items.name, db.items.price).From(db.items).FetchAllFrom(db))
+
+@benchmark
+def iter_tuples(path):
+	"IterFrom of the whole table as tuples, rows"
+	db = DataBase(path)
+	rows = 0
+	for row in SqlBuilder().Select(db.items.id, db.items.name, db.items.price).From(db.items).IterFrom(db, 1000, 'tuple'):
+		rows += 1
+	return rows
+
+@benchmark
+def search_like(path):
+	"Search of items by a word in the name with like, queries"
+	db = DataBase(path)
+	query = SqlBuilder(bind=True).Select(db.items.id).From(db.items).Where("items.name like '%eeepc%'").Limit(20)
+	for i in range(200):
+		query.FetchAllFrom(db)
+	return 200
+
+@benchmark
+def search_match(path):
+	"Search of items by a word in the name with the full text search index, queries, the index building included"
+	db = DataBase(path)
+	db.CreateSearch(db.items, [db.items.name])
+	query = SqlBuilder(bind=True).Select(db.items.id).From(db.items).Where(db.items.name.Match('eeepc')).Limit(20)
+	for i in range(2000):
+		query.FetchAllFrom(db)
+	return 2000
+
+@benchmark
+def insert_to(path):
+	"InsertTo with the commit for each row, rows"
+	db = DataBase(path)
+	query = SqlBuilder(bind=True)
+	for i in range(200):
+		query.Insert({'name': 'bench %s' % i, 'description': 'bench'}).Into(db.brands).InsertTo(db)
+	return 200
+
+@benchmark
+def writer_insert(path):
+	"Inserts from 4 threads through the group commit writer, rows"
+	db = DataBase(path)
+	writer = db.Writer()
+	def produce(thread):
+		for i in range(500):
+			writer.SubmitRow(db.brands, {'name': 'bench %s %s' % (thread, i), 'description': 'bench'})
+	threads = [threading.Thread(target = produce, args = (thread,)) for thread in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	db.Close()
+	return 2000
+
+@benchmark
+def insert_many(path):
+	"InsertManyTo in a single transaction, rows"
+	db = DataBase(path)
+	rows = [(1, 1, 1, 1, 'bench %s' % i, i / 10.0) for i in range(20000)]
+	SqlBuilder().InsertMany(rows, ['id_src', 'id_section', 'id_update', 'id_shop', 'name', 'price']).Into(db.items).InsertManyTo(db)
+	return len(rows)
+
+@benchmark
+def update_in(path):
+	"UpdateIn of a row by the primary key with the commit for each row, rows"
+	db = DataBase(path)
+	query = SqlBuilder(bind=True)
+	for i in range(200):
+		query.Update(db.items).Set({'name': 'bench %s' % i}).Where(db.items.id == i + 1).UpdateIn(db)
+	return 200
+
+@benchmark
+def delete_from(path):
+	"DeleteFrom of a row by the primary key with the commit for each row, rows"
+	db = DataBase(path)
+	query = SqlBuilder(bind=True)
+	for i in range(200):
+		query.Delete(db.items).Where(db.items.id == i + 1).DeleteFrom(db)
+	return 200
+
+@benchmark
+def struct_open(path):
+	"DataBase opening with the whole db investigation"
+	for i in range(20):
+		DataBase(path).Close()
+	return 20
+
+@benchmark
+def struct_open_cached(path):
+	"DataBase opening with the tables structure cache"
+	for i in range(20):
+		DataBase(path, cache=path + '.bench').Close()
+	return 20
+
+def run(source, scales, names, repeat):
+	"""Run benchmarks, each one on the fresh copy of the db
+	*source* is the original db file name
+	*scales* is the list of numbers of items, 0 for the original data
+	*names* is the list of benchmark names
+	*repeat* is the number of runs, the best one is taken
+	Returns dict of results by "scale/name" keys
+	"""
+	results = {}
+	folder = tempfile.mkdtemp()
+	try:
+		for rows in scales:
+			template = os.path.join(folder, 'scaled.sqlite')
+			scale(source, template, rows)
+			for name in names:
+				best = None
+				for i in range(repeat):
+					path = os.path.join(folder, 'run.sqlite')
+					shutil.copy(template, path)
+					start = time.perf_counter()
+					ops = benchmarks[name](path)
+					duration = time.perf_counter() - start
+					if best is None or duration < best[0]:
+						best = (duration, ops)
+					for file in [path, path + '.bench']:
+						if os.path.isfile(file):
+							os.remove(file)
+				results['%s/%s' % (rows, name)] = {'seconds': best[0], 'ops': best[1], 'rate': best[1] / best[0]}
+				print('%-32s %12.0f op/s %10.4fs' % ('%s/%s' % (rows, name), best[1] / best[0], best[0]))
+	finally:
+		shutil.rmtree(folder)
+	return results
+
+def compare(results, baseline, threshold):
+	"""Print the rates change against the baseline
+	*results* is the dict of the current results
+	*baseline* is the dict of the baseline results
+	*threshold* is the allowed rate decrease part
+	Returns list of regressed benchmark keys
+	"""
+	regressions = []
+	for key in sorted(set(results) & set(baseline)):
+		change = results[key]['rate'] / baseline[key]['rate'] - 1
+		mark = ''
+		if change < -threshold:
+			regressions.append(key)
+			mark = ' REGRESSION'
+		print('%-32s %+8.1f%%%s' % (key, change * 100, mark))
+	return regressions
+
+def main():
+	"""Command line entry point"""
+	parser = argparse.ArgumentParser(description = 'PySql benchmarks')
+	parser.add_argument('--db', default = 'test.sqlite', help = 'source db file')
+	parser.add_argument('--rows', default = '0', help = 'comma separated numbers of items in the scaled db copies, 0 for the source data')
+	parser.add_argument('--only', default = '', help = 'comma separated benchmark names')
+	parser.add_argument('--repeat', type = int, default = 3, help = 'number of runs, the best is taken')
+	parser.add_argument('--output', help = 'json file to save the results')
+	parser.add_argument('--baseline', help = 'json file with results to compare with')
+	parser.add_argument('--threshold', type = float, default = 0.1, help = 'allowed rate decrease part')
+	args = parser.parse_args()
+	names = [name for name in args.only.split(',') if name] or list(benchmarks)
+	for name in names:
+		if name not in benchmarks:
+			parser.error('unknown benchmark %s' % name)
+	results = run(args.db, [int(rows) for rows in args.rows.split(',')], names, max(1, args.repeat))
+	data = {
+		'meta': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'time': time.time()},
+		'results': results,
+	}
+	if args.output:
+		with open(args.output, 'w') as output:
+			json.dump(data, output, indent = 1, sort_keys = True)
+	if args.baseline:
+		with open(args.baseline) as baseline:
+			if compare(results, json.load(baseline)['results'], args.threshold):
+				return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -3,7 +3,7 @@ Possible future improvements:
 	- aliases support
 	- strict check that "where" fields are from "from" tables
 	- create/alter/update tables functions
-	- triggers/indexes/view/transactions support
+	- triggers/indexes/view support
 """
 
 from sql import *
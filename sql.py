@@ -6,14 +6,80 @@ __author__  = "DarkPark"
 __version__ = '0.1.a'
 
 import os
+import re
+import time
+import json
+import base64
+import weakref
+import zlib
 import sqlite3
+import itertools
+import contextlib
+import collections
+import array
+import queue
+import threading
+import asyncio
+import logging
+import functools
+import concurrent.futures
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+log = logging.getLogger(__name__)
 
 class dbTable:
 	"""DataBase table class"""
 	
+	def __init__(self, name, columns = (), indexes = None, fkeys = ()):
+		"""Constructor
+		*name* is table name
+		*columns* is the list of column names in the table order
+		*indexes* is the dict of index name and dict with index columns list and unique flag
+		*fkeys* is the list of foreign keys dicts with columns, referenced table and columns
+		"""
+		self.__name__    = name
+		self.__columns__ = list(columns)
+		self.__indexes__ = indexes or {}
+		self.__fkeys__   = list(fkeys)
+
+class dbRow:
+	"""Base class for query result rows with fixed set of fields"""
+	
+	__slots__ = ()
+	
+	def __init__(self, *values):
+		"""Constructor
+		*values* is a list of field values in order of the fields
+		"""
+		for name, value in zip(self.__slots__, values):
+			setattr(self, name, value)
+	
+	def __getitem__(self, key):
+		"""Get field value by name or position"""
+		if isinstance(key, int):
+			key = self.__slots__[key]
+		return getattr(self, key)
+	
+	def keys(self):
+		"""Returns the list of field names"""
+		return list(self.__slots__)
+
+class Param:
+	"""Named query parameter placeholder"""
+	
 	def __init__(self, name):
-		"""Constructor"""
+		"""Constructor
+		*name* is the parameter name used on the query template run
+		"""
 		self.__name__ = name
+	
+	def __str__(self):
+		"""Returns the sql named placeholder"""
+		return ':%s' % self.__name__
 
 class dbTableColumn:
 	"""DataBase table column class"""
@@ -23,7 +89,7 @@ class dbTableColumn:
 		*name* is table column name
 		*data* is the dict with column info such as table name and type
 		*base* is flag showing if the column object directly or its inheritor
-		*repr* is the sql part representing the current column or operation result
+		*repr* is the sql part representing the current column
 		"""
 		self.__name__ = name
 		self.__data__ = data
@@ -31,175 +97,1881 @@ class dbTableColumn:
 		self.__repr__ = repr
 		if base:
 			self.__repr__ = '%s.%s' % (self.__data__['table'], self.__name__)
+		# python type of the column values for operands type checking
+		self.__type__ = {'integer': 'int', 'text': 'str', 'real': 'float'}.get(self.__affinity__(), 'dbTableColumn')
 	
-	def __get__(self, param):
-		"""Returns the sql representation of the object or the given value otherwise
-		*param* is mixed, can be object or simple int/str type
-		"""
-		if isinstance(param, dbTableColumn):
-			if param.__repr__:
-				return param.__repr__
-		elif isinstance(param, str):
-			return "'%s'" % param
-		elif type(param).__name__ in ['tuple', 'list', 'set', 'dict']:
-			list = []
-			for item in param:
-				if isinstance(item, str):
-					list.append("'%s'" % item)
-				elif isinstance(item, int):
-					list.append(str(item))
-			return '(%s)' % ', '.join(list)
-		else:
-			return param
-	
-	def __get_type__(self, param):
-		"""Returns the param type adopting db types to python
-		*param* is mixed, can be object or simple int/str type
-		"""
-		if isinstance(param, dbTableColumn):
-			if param.__data__['type'] in ['INTEGER']:
-				return 'int'
-			elif param.__data__['type'] in ['VARCHAR', 'TEXT']:
-				return 'str'
-			elif param.__data__['type'] in ['REAL']:
-				return 'float'
-			else:
-				return 'dbTableColumn'
-		else:
-			return type(param).__name__
-
-	def __type_check__(self, first, second):
-		"""Raise the exception in case operand type mismatch
-		*first* is the first parameter of comparison
-		*second* is the second parameter of comparison
+	def __affinity__(self):
+		"""Returns the column type affinity by sqlite rules for the declared type
+		{integer|text|blob|real|numeric}
 		"""
-		if self.__get_type__(first) != self.__get_type__(second):
-			raise TypeError('%s != %s' % (self.__get_type__(first), self.__get_type__(second)))
+		type = str(self.__data__.get('type') or '').upper()
+		if 'INT' in type:
+			return 'integer'
+		elif 'CHAR' in type or 'CLOB' in type or 'TEXT' in type:
+			return 'text'
+		elif 'BLOB' in type or not type:
+			return 'blob'
+		elif 'REAL' in type or 'FLOA' in type or 'DOUB' in type:
+			return 'real'
+		return 'numeric'
 	
 	def __eq__(self, other):
 		"""Operator ==
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		self.__type_check__(self, other)
-		repr = '(%s = %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Compare('=', self, other)
 	
 	def __ne__(self, other):
 		"""Operator !=
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		self.__type_check__(self, other)
-		repr = '(%s != %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Compare('!=', self, other)
 
 	def __and__(self, other):
 		"""Operator &
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		repr = '(%s and %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Make('and', (self, other))
 	
 	def __or__(self, other):
 		"""Operator |
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		repr = '(%s or %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Make('or', (self, other))
 
 	def __lt__(self, other):
 		"""Operator <
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		self.__type_check__(self, other)
-		repr = '(%s < %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Compare('<', self, other)
 
 	def __gt__(self, other):
 		"""Operator >
 		*other* is the second parameter of operation
-		Returns the object itself
+		Returns the expression object
 		"""
-		self.__type_check__(self, other)
-		repr = '(%s > %s)' % (self.__get__(self), self.__get__(other))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return dbExpression.Compare('>', self, other)
 
 	def In(self, *arguments):
 		"""Operator in
-		*arguments* is the second parameter of operation, can be list of values
-		Returns the object itself
+		*arguments* is the second parameter of operation, can be list or any iterable of values
+		Returns the expression object
 		"""
-		if len(arguments) == 1:
-			repr = '(%s in %s)' % (self.__get__(self), self.__get__(arguments[0]))
-		elif len(arguments) > 1:
-			list = []
-			for arg in arguments:
-				list.append(str(self.__get__(arg)))
-			repr = '(%s in (%s))' % (self.__get__(self), ', '.join(list))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+		return self.__in__('in', arguments)
 	
 	def NotIn(self, *arguments):
 		"""Operator not in
-		*arguments* is the second parameter of operation, can be list of values
-		Returns the object itself
+		*arguments* is the second parameter of operation, can be list or any iterable of values
+		Returns the expression object
+		"""
+		return self.__in__('not in', arguments)
+	
+	def Match(self, text):
+		"""Operator match of the full text search index created by DataBase.CreateSearch
+		The expression is also accepted by OrderBy to sort the rows by the bm25 rank, the best ones first in asc order
+		*text* is the fts5 query string
+		Returns the expression object
+		"""
+		if not self.__data__.get('search'):
+			raise Exception("no full text search index on %s" % self.__repr__)
+		return dbExpression.Make('match', (self, text))
+	
+	def __in__(self, op, arguments):
+		"""Make the in/not in expression, big lists of values are passed as a single json array
+		*op* is the operation - {in|not in}
+		*arguments* is the list of operands
+		Returns the expression object
 		"""
 		if len(arguments) == 1:
-			repr = '(%s not in %s)' % (self.__get__(self), self.__get__(arguments[0]))
+			argument = arguments[0]
+			if hasattr(argument, '__iter__') and not isinstance(argument, (str, bytes, tuple, list, set, dict, dbTableColumn, dbExpression)):
+				# generators, ranges, arrays
+				argument = tuple(argument)
+			return dbExpression.Make(op, (self, argument))
+		elif len(arguments) >= dbExpression.json_size and not any(isinstance(argument, (dbTableColumn, dbExpression, Param)) for argument in arguments):
+			return dbExpression.Make(op, (self, arguments))
 		elif len(arguments) > 1:
-			list = []
-			for arg in arguments:
-				list.append(str(self.__get__(arg)))
-			repr = '(%s not in (%s))' % (self.__get__(self), ', '.join(list))
-		return dbTableColumn(self.__name__, self.__data__, False, repr)
+			return dbExpression.Make(op + '*', (self,) + arguments)
+		# no values -> "items.id in ()", always false for in and true for not in
+		return dbExpression.Make(op, (self, ()))
+
+class dbExpression:
+	"""Immutable sql expression tree node
+	Nodes are shared by structurally identical expressions, so each one is rendered only once
+	"""
+	
+	__slots__ = ('op', 'args', 'type', 'depth', 'text', 'bound', '__weakref__')
+	
+	"Existing nodes by their structure"
+	nodes = weakref.WeakValueDictionary()
+	
+	"""Length of and/or chains rendered without nested brackets
+	SQLite parser stack overflows on about a hundred of nested brackets
+	"""
+	flat_depth = 32
+	
+	"""Number of values in the list starting from which they are passed as one json array to json_each
+	The statement stays short and the same for any number of values in bind mode
+	"""
+	json_size = 100
+	
+	def __init__(self, op, args, type = None):
+		"""Constructor
+		*op* is the operation - {=|!=|<|>|and|or|in|not in|in*|not in*|match}, starred ones have list of operands
+		*args* is the tuple of operands - columns, expressions or values
+		*type* is the python type name of the expression value
+		"""
+		self.op    = op
+		self.args  = args
+		self.type  = type
+		# length of the chain of the same and/or operations
+		self.depth = 1
+		if op in ['and', 'or'] and isinstance(args[0], dbExpression) and args[0].op == op:
+			self.depth = args[0].depth + 1
+		# rendered sql and parameters in literal and placeholders form
+		self.text  = None
+		self.bound = None
+	
+	@classmethod
+	def Key(cls, value):
+		"""Get the structural key of the operand"""
+		if isinstance(value, (dbTableColumn, dbExpression)):
+			return ('#', id(value))
+		elif isinstance(value, Param):
+			return ('Param', value.__name__)
+		elif isinstance(value, (tuple, list, set, dict)):
+			return (type(value).__name__, tuple(cls.Key(item) for item in value))
+		elif isinstance(value, float):
+			return ('float', repr(value))
+		return (type(value).__name__, value)
+	
+	@classmethod
+	def Make(cls, op, args, type = None):
+		"""Get the node for the operation, existing one if the same expression was built before
+		*op* is the operation
+		*args* is the tuple of operands
+		*type* is the python type name of the expression value
+		Returns dbExpression object
+		"""
+		key = (op,) + tuple(cls.Key(arg) for arg in args)
+		try:
+			node = cls.nodes.get(key)
+		except TypeError:
+			# operands with not hashable values are not shared
+			return cls(op, args, type)
+		if node is None:
+			node = cls.nodes.setdefault(key, cls(op, args, type))
+		return node
+	
+	@classmethod
+	def TypeOf(cls, value):
+		"""Returns the python type name of the operand, None if unknown"""
+		if isinstance(value, dbTableColumn):
+			return value.__type__
+		elif isinstance(value, dbExpression):
+			return value.type
+		elif isinstance(value, Param):
+			return None
+		return type(value).__name__
+	
+	@classmethod
+	def Compare(cls, op, first, second):
+		"""Get the comparison node raising the exception in case operand type mismatch
+		*op* is the comparison operation
+		*first* is the first parameter of comparison
+		*second* is the second parameter of comparison
+		Returns dbExpression object
+		"""
+		first_type  = cls.TypeOf(first)
+		second_type = cls.TypeOf(second)
+		if first_type and second_type and first_type != second_type:
+			raise TypeError('%s != %s' % (first_type, second_type))
+		return cls.Make(op, (first, second), first_type)
+	
+	@classmethod
+	def Leaf(cls, value, bind = False):
+		"""Render the operand which is not an expression
+		*value* is a column or a value
+		*bind* is a flag to render values as placeholders
+		Returns tuple of sql part and tuple of values
+		"""
+		if isinstance(value, dbTableColumn):
+			return (value.__repr__, ())
+		elif isinstance(value, (tuple, list, set, dict)):
+			values = tuple(value)
+			if len(values) >= cls.json_size:
+				try:
+					text = json.dumps(values, allow_nan = False)
+				except (TypeError, ValueError):
+					raise Exception('values of in list can not be passed as json array')
+				if bind:
+					return ('(select value from json_each(?))', (text,))
+				return ("(select value from json_each('%s'))" % text.replace("'", "''"), ())
+			if bind:
+				return ('(%s)' % ', '.join(['?'] * len(values)), values)
+			return ('(%s)' % ', '.join([("'%s'" % item.replace("'", "''")) if isinstance(item, str) else 'null' if item is None else repr(item) if isinstance(item, float) else str(item) for item in values]), ())
+		elif bind:
+			return ('?', (value,))
+		elif isinstance(value, str):
+			# quotes are doubled like in json_each text, match queries use them for phrases
+			return ("'%s'" % value.replace("'", "''"), ())
+		return ('%s' % (value,), ())
+	
+	def Parts(self):
+		"""Returns the list of sql text parts and the operands wrapped into tuples"""
+		if self.op == 'match':
+			# rows found by the full text search index -> "items.id in (select rowid from items_fts where items_fts.name match ?)"
+			column = self.args[0]
+			fts, key = column.__data__['search']
+			return ['(%s.%s in (select rowid from %s where %s.%s match ' % (column.__data__['table'], key, fts, fts, column.__name__), (self.args[1],), '))']
+		if self.op in ['in*', 'not in*']:
+			parts = ['(', (self.args[0],), ' %s (' % self.op[:-1]]
+			for pos, arg in enumerate(self.args[1:]):
+				if pos:
+					parts.append(', ')
+				parts.append((arg,))
+			parts.append('))')
+			return parts
+		if self.depth > self.flat_depth:
+			# ((a or b) or c) -> (a or b or c)
+			args = []
+			node = self
+			while isinstance(node, dbExpression) and node.op == self.op:
+				args.append(node.args[1])
+				node = node.args[0]
+			args.append(node)
+			parts = ['(']
+			for pos, arg in enumerate(reversed(args)):
+				if pos:
+					parts.append(' %s ' % self.op)
+				parts.append((arg,))
+			parts.append(')')
+			return parts
+		return ['(', (self.args[0],), ' %s ' % self.op, (self.args[1],), ')']
+	
+	def Render(self, bind = False):
+		"""Get the sql of the expression, rendered on the first call
+		*bind* is a flag to render values as placeholders
+		Returns tuple of sql and tuple of values
+		"""
+		result = self.bound if bind else self.text
+		if result is not None:
+			return result
+		sql    = []
+		params = []
+		# iterative walk keeps deep expressions away from the recursion limit
+		stack = [(self,)]
+		while stack:
+			item = stack.pop()
+			if isinstance(item, str):
+				sql.append(item)
+				continue
+			item = item[0]
+			if isinstance(item, dbExpression):
+				result = item.bound if bind else item.text
+				if result is None:
+					stack.extend(reversed(item.Parts()))
+					continue
+			else:
+				result = self.Leaf(item, bind)
+			sql.append(result[0])
+			params.extend(result[1])
+		result = (''.join(sql), tuple(params))
+		if bind:
+			self.bound = result
+		else:
+			self.text = result
+		return result
+	
+	def __and__(self, other):
+		"""Operator &
+		*other* is the second parameter of operation
+		Returns the expression object
+		"""
+		return dbExpression.Make('and', (self, other))
+	
+	def __or__(self, other):
+		"""Operator |
+		*other* is the second parameter of operation
+		Returns the expression object
+		"""
+		return dbExpression.Make('or', (self, other))
+
+class dbValues(dbTable):
+	"""Client side rows used as a table in joins, passed to the db as one json array"""
+	
+	def __init__(self, name, columns, rows):
+		"""Constructor
+		*name* is the table alias used in conditions
+		*columns* is the list of column names
+		*rows* is the list of tuples or dicts of values in columns order
+		"""
+		dbTable.__init__(self, name, columns)
+		self.__rows__ = [[row.get(column) for column in columns] if isinstance(row, dict) else list(row) for row in rows]
+		for pos, column in enumerate(columns):
+			# column types are taken from the first known value
+			type = ''
+			for row in self.__rows__:
+				if row[pos] is not None:
+					type = {int: 'INTEGER', float: 'REAL', str: 'TEXT'}.get(row[pos].__class__, '')
+					break
+			setattr(self, column, dbTableColumn(column, {'table': name, 'type': type, 'pk': 0}, True))
+	
+	def Render(self, bind = False):
+		"""Get the sql of the subquery reading rows from json
+		*bind* is a flag to pass the json as a placeholder value
+		Returns tuple of sql part and tuple of values
+		"""
+		text   = json.dumps(self.__rows__)
+		fields = ', '.join(["json_extract(value, '$[%s]') as %s" % (pos, column) for pos, column in enumerate(self.__columns__)])
+		if bind:
+			return ('(select %s from json_each(?)) as %s' % (fields, self.__name__), (text,))
+		return ("(select %s from json_each('%s')) as %s" % (fields, text.replace("'", "''"), self.__name__), ())
+
+class dbPool:
+	"""Pool of shared connections to the database file"""
+	
+	def __init__(self, dbfile, size, timeout = 5.0, statements = 128):
+		"""Constructor
+		*dbfile* is a file name of the sqlite db
+		*size* is the maximum number of connections
+		*timeout* is the number of seconds to wait for a free connection
+		*statements* is a number of prepared statements kept by each connection
+		"""
+		self.dbfile     = dbfile
+		self.size       = size
+		self.timeout    = timeout
+		self.statements = statements
+		self.conns = []
+		self.free  = queue.LifoQueue()
+		self.lock  = threading.Lock()
+		self.trace = (None, None, 0)
+		self.pragmas = {}
+	
+	def Connect(self):
+		"""Opens the new read only connection"""
+		conn = sqlite3.connect(self.dbfile, cached_statements = self.statements, check_same_thread = False)
+		conn.execute('pragma query_only = 1')
+		for name, value in self.pragmas.items():
+			conn.execute('pragma %s = %s' % (name, value)).fetchall()
+		conn.set_trace_callback(self.trace[0])
+		conn.set_progress_handler(self.trace[1], self.trace[2])
+		return conn
+	
+	def Configure(self, pragmas):
+		"""Set the connection pragmas for all connections
+		*pragmas* is the dict of pragma names and values
+		"""
+		with self.lock:
+			self.pragmas = dict(self.pragmas, **pragmas)
+			for conn in self.conns:
+				for name, value in pragmas.items():
+					conn.execute('pragma %s = %s' % (name, value)).fetchall()
+	
+	def Trace(self, callback = None, progress = None, steps = 1000):
+		"""Set the statements trace callback and the progress handler for all connections
+		*callback* is the function called with each statement sql
+		*progress* is the function called every *steps* virtual machine instructions, non zero result aborts the query
+		*steps* is the number of instructions between progress calls
+		"""
+		with self.lock:
+			self.trace = (callback, progress, steps)
+			for conn in self.conns:
+				conn.set_trace_callback(callback)
+				conn.set_progress_handler(progress, steps)
+	
+	def Checkout(self):
+		"""Get the free connection, new connections are opened on demand up to the pool size
+		Returns healthy connection
+		"""
+		conn = None
+		with self.lock:
+			if self.free.empty() and len(self.conns) < self.size:
+				conn = self.Connect()
+				self.conns.append(conn)
+		if conn is None:
+			try:
+				conn = self.free.get(timeout = self.timeout)
+			except queue.Empty:
+				raise Exception('connection pool timeout')
+			# check the connection is still usable and replace it otherwise
+			try:
+				conn.execute('select 1').fetchone()
+			except sqlite3.Error:
+				with self.lock:
+					self.conns.remove(conn)
+					conn = self.Connect()
+					self.conns.append(conn)
+		return conn
+	
+	def Checkin(self, conn):
+		"""Return the connection to the pool
+		*conn* is the connection got by Checkout
+		"""
+		if conn in self.conns:
+			self.free.put(conn)
+	
+	def Close(self):
+		"""Close all the connections"""
+		with self.lock:
+			for conn in self.conns:
+				conn.close()
+			self.conns = []
+
+class dbPoolHolder:
+	"""Pool connection checked out for a query cursor or a Connection block, returned to the pool on release or deletion"""
+	
+	__slots__ = ('pool', 'conn')
+	
+	def __init__(self, pool):
+		"""Constructor
+		*pool* is the dbPool object to checkout the connection from
+		"""
+		self.pool = pool
+		# nothing to return if the checkout fails
+		self.conn = None
+		self.conn = pool.Checkout()
+	
+	def __del__(self):
+		"""Destructor to return the connection"""
+		self.Release()
+	
+	def Release(self):
+		"""Return the connection to the pool"""
+		if self.conn is not None:
+			self.pool.Checkin(self.conn)
+			self.conn = None
+
+class dbReplica:
+	"""In memory copy of the database file for reading, reloaded through the backup api on other connections commits"""
+
+	def __init__(self, dbfile, check = 1.0, statements = 128):
+		"""Constructor
+		*dbfile* is a file name of the sqlite db
+		*check* is the number of seconds between background checks for commits to the file, only manual refresh if not set
+		*statements* is a number of prepared statements kept by the copy connection
+		"""
+		self.dbfile     = dbfile
+		self.check      = check
+		self.statements = statements
+		self.trace   = (None, None, 0)
+		self.lock    = threading.Lock()
+		self.stop    = threading.Event()
+		self.version = None
+		self.refreshed = 0
+		# data_version of this connection changes on commits of any other one, the main writer included
+		self.source = sqlite3.connect(dbfile, check_same_thread = False)
+		self.conn   = None
+		self.Refresh()
+		self.thread = None
+		if check is not None:
+			self.thread = threading.Thread(target = self.Watch, name = 'dbReplica', daemon = True)
+			self.thread.start()
+
+	def Refresh(self, force = True):
+		"""Load the fresh copy of the file and swap it with the current one
+		Cursors opened before keep reading the previous copy until closed
+		*force* is a flag to reload the copy even if the file is not changed
+		Returns True if the copy is reloaded
+		"""
+		with self.lock:
+			if self.source is None:
+				return False
+			version = self.source.execute('pragma data_version').fetchone()[0]
+			if not force and version == self.version:
+				return False
+			conn = sqlite3.connect(':memory:', cached_statements = self.statements, check_same_thread = False)
+			self.source.backup(conn)
+			conn.execute('pragma query_only = 1')
+			conn.set_trace_callback(self.trace[0])
+			conn.set_progress_handler(self.trace[1], self.trace[2])
+			# readers take the connection reference once, the previous copy is closed on freeing with its last cursor
+			self.conn    = conn
+			self.version = version
+			self.refreshed += 1
+		return True
+
+	def Watch(self):
+		"""Background loop reloading the copy on commits to the file"""
+		while not self.stop.wait(self.check):
+			try:
+				self.Refresh(False)
+			except sqlite3.Error:
+				log.exception('replica refresh failed')
+
+	def Trace(self, callback = None, progress = None, steps = 1000):
+		"""Set the statements trace callback and the progress handler for the copy connection
+		*callback* is the function called with each statement sql
+		*progress* is the function called every *steps* virtual machine instructions, non zero result aborts the query
+		*steps* is the number of instructions between progress calls
+		"""
+		with self.lock:
+			self.trace = (callback, progress, steps)
+			self.conn.set_trace_callback(callback)
+			self.conn.set_progress_handler(progress, steps)
+
+	def Close(self):
+		"""Stop the refresh and close the connections"""
+		self.stop.set()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+		with self.lock:
+			if self.source is not None:
+				self.source.close()
+				self.source = None
+			if self.conn is not None:
+				self.conn.close()
+				self.conn = None
+
+class dbResultCache:
+	"""Cache of selects results with LRU eviction by the number of rows
+	Results are invalidated by the tables the query reads on writes to them and at all on other processes commits
+	"""
+	
+	def __init__(self, size, ttl = None, check = 1.0):
+		"""Constructor
+		*size* is the maximum number of cached rows of all results
+		*ttl* is the number of seconds a result is kept, not limited if not set
+		*check* is the number of seconds between checks for other processes commits
+		"""
+		self.size    = size
+		self.ttl     = ttl
+		self.check   = check
+		self.rows    = 0
+		self.entries = collections.OrderedDict()
+		self.tables  = {}
+		self.lock    = threading.Lock()
+		# any invalidation changes the epoch so results read before it are not stored
+		self.epoch   = 0
+		self.version = None
+		self.checked = None
+		self.reads   = {}
+		self.writes  = {}
+		self.hits    = 0
+		self.misses  = 0
+	
+	@staticmethod
+	def Read(db, sql, params = (), build = 0.0):
+		"""Run select query bypassing the cache
+		*db* is a DataBase object with opened connection
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		Returns tuple of column names and list of records tuples
+		"""
+		# all the records are fetched before the main connection is given to the transaction of other thread
+		with db.__guard__(db.__reader__()):
+			cur = db.__read__(sql, params, build)
+			cur.row_factory = None
+			try:
+				return tuple(column[0] for column in cur.description), cur.fetchall()
+			finally:
+				cur.close()
+	
+	def Fetch(self, db, sql, params = (), build = 0.0):
+		"""Get the query result from the cache or run the query and cache its result
+		*db* is a DataBase object with opened connection
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		Returns tuple of column names and list of records tuples
+		"""
+		try:
+			key = (sql, tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params))
+			hash(key)
+		except TypeError:
+			return self.Read(db, sql, params, build)
+		now = time.monotonic()
+		if self.checked is None or now - self.checked >= self.check:
+			self.Check(db, now)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				if entry[3] is None or entry[3] > now:
+					self.entries.move_to_end(key)
+					self.hits += 1
+					return entry[0], entry[1]
+				self.Remove(key)
+			self.misses += 1
+			epoch = self.epoch
+		names, rows = self.Read(db, sql, params, build)
+		tables = self.Tables(self.reads, sql)
+		with self.lock:
+			if epoch == self.epoch and len(rows) <= self.size:
+				self.entries[key] = (names, rows, tables, now + self.ttl if self.ttl is not None else None)
+				self.rows += len(rows)
+				for table in tables:
+					self.tables.setdefault(table, set()).add(key)
+				while self.rows > self.size:
+					self.Remove(next(iter(self.entries)))
+		return names, rows
+	
+	def Check(self, db, now):
+		"""Drop all results if the db is changed by other connections and reload the tables dependencies on schema change
+		*db* is a DataBase object with opened connection
+		*now* is the current time
+		"""
+		with db.__lock__:
+			version = db.__conn__.execute('select d.data_version, s.schema_version from pragma_data_version d, pragma_schema_version s').fetchone()
+			# the replica copy could be read before it got the own writes, so results are dropped on its reload too
+			if db.__replica__ is not None:
+				version += (db.__replica__.refreshed,)
+			if self.version is None or version[1] != self.version[1]:
+				self.Schema(db.__conn__.execute("select type, lower(name), lower(tbl_name), lower(sql) from sqlite_master where type in ('table', 'view', 'trigger')").fetchall())
+		self.checked = now
+		if self.version != version:
+			self.version = version
+			self.Invalidate([None])
+	
+	def Schema(self, schema):
+		"""Collect tables read by views and written by triggers
+		*schema* is the list of sqlite_master type, name, table name and sql
+		"""
+		tables = set(name for type, name, tbl, sql in schema if type == 'table')
+		reads  = dict((name, set([name])) for name in tables)
+		writes = dict((name, set([name])) for name in tables)
+		views  = dict((name, set(re.findall(r'\w+', sql or ''))) for type, name, tbl, sql in schema if type == 'view')
+		for type, name, tbl, sql in schema:
+			if type == 'trigger':
+				writes.setdefault(tbl, set()).update(tables.intersection(re.findall(r'\w+', sql or '')))
+		# views of views and cascading triggers
+		for name in views:
+			reads[name] = set()
+		changed = True
+		while changed:
+			changed = False
+			for name, words in views.items():
+				found = set().union(*[reads[word] for word in words if word in reads and word != name])
+				if not found <= reads[name]:
+					reads[name].update(found)
+					changed = True
+			for name, found in writes.items():
+				more = set().union(*[writes[table] for table in found if table in writes])
+				if not more <= found:
+					found.update(more)
+					changed = True
+		self.reads  = reads
+		self.writes = writes
+	
+	@staticmethod
+	def Tables(names, sql):
+		"""Get the tables used by the query
+		*names* is the dict of table or view names and sets of the tables behind them
+		*sql* is the query sql
+		Returns set of table names
+		"""
+		tables = set()
+		for word in set(re.findall(r'\w+', sql.lower())):
+			if word in names:
+				tables.update(names[word])
+		return tables
+	
+	def Written(self, sql):
+		"""Get the tables changed by the query
+		*sql* is the insert/update/delete query sql
+		Returns set of table names, None item stands for all tables
+		"""
+		match = re.match(r'\s*(?:insert|replace|update|delete)(?:\s+or\s+\w+)?(?:\s+into|\s+from)?\s+[\["`]?(\w+)', sql, re.I)
+		if match is None:
+			return set([None])
+		return self.writes.get(match.group(1).lower(), set([match.group(1).lower()]))
+	
+	def Remove(self, key):
+		"""Drop the cached result, the lock should be held
+		*key* is the query sql and params key
+		"""
+		entry = self.entries.pop(key)
+		self.rows -= len(entry[1])
+		for table in entry[2]:
+			keys = self.tables[table]
+			keys.discard(key)
+			if not keys:
+				del self.tables[table]
+	
+	def Invalidate(self, tables):
+		"""Drop the results of queries reading the given tables
+		*tables* is the list of table names, None item stands for all tables
+		"""
+		with self.lock:
+			self.epoch += 1
+			if None in tables:
+				self.entries.clear()
+				self.tables.clear()
+				self.rows = 0
+				return
+			for table in tables:
+				for key in list(self.tables.get(table, ())):
+					self.Remove(key)
+
+class dbQueryInfo:
+	"""Query execution data passed to the profiling hooks"""
+	
+	__slots__ = ('kind', 'sql', 'params', 'fingerprint', 'build', 'execute', 'fetch', 'fetched', 'changed', 'start')
+	
+	def __init__(self, kind, sql, params = (), build = 0.0):
+		"""Constructor
+		*kind* is the query type - {read|write}
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		"""
+		self.kind        = kind
+		self.sql         = sql
+		self.params      = params
+		self.fingerprint = self.Fingerprint(sql)
+		self.build       = build
+		self.execute     = 0.0
+		self.fetch       = 0.0
+		self.fetched     = 0
+		self.changed     = 0
+		self.start       = 0.0
+	
+	@staticmethod
+	@functools.lru_cache(maxsize = 1024)
+	def Fingerprint(sql):
+		"""Normalize the query to group the same queries with different values
+		*sql* is the query sql
+		Returns sql with literals and lists of values replaced with placeholders
+		"""
+		sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+		sql = re.sub(r'(?<![\w.])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b', '?', sql, flags = re.I)
+		sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?+)', sql)
+		return re.sub(r'\s+', ' ', sql).strip()
+	
+	@property
+	def duration(self):
+		"""Total number of seconds spent for the query"""
+		return self.build + self.execute + self.fetch
+
+class dbCursor(sqlite3.Cursor):
+	"""Cursor counting fetched rows and time for the profiling hooks, the after hooks are called on close
+	Pool connection of the cursor is kept checked out until all the rows are fetched or the cursor is closed,
+	rows of the shared main connection are fetched under its lock
+	"""
+	
+	"Lock of the cursors not sharing the connection"
+	unlocked = contextlib.nullcontext()
+	
+	"Number of rows fetched at once by iteration, so the lock is taken once for them"
+	chunk = 256
+	
+	def __init__(self, conn):
+		"""Constructor
+		*conn* is the connection
+		"""
+		super().__init__(conn)
+		self.info   = None
+		self.db     = None
+		self.holder = None
+		self.lock   = self.unlocked
+		# rows fetched by iteration and not returned yet, in reverse order
+		self.rows   = []
+	
+	def __del__(self):
+		"""Destructor to finish the query if the cursor is not closed"""
+		self.__done__()
+	
+	def __done__(self):
+		"""Call the after hooks once and return the pool connection"""
+		self.__release__()
+		if self.info is not None:
+			info, self.info = self.info, None
+			self.db.__after__(info)
+	
+	def __release__(self):
+		"""Return the pool connection once"""
+		if self.holder is not None:
+			holder, self.holder = self.holder, None
+			holder.Release()
+	
+	def __next__(self):
+		if not self.rows:
+			rows = self.fetchmany(self.chunk)
+			if not rows:
+				raise StopIteration
+			rows.reverse()
+			self.rows = rows
+		return self.rows.pop()
+	
+	def fetchone(self):
+		if self.rows:
+			return self.rows.pop()
+		start = time.perf_counter()
+		with self.lock:
+			row = super().fetchone()
+		if row is None:
+			self.__release__()
+		if self.info is not None:
+			self.info.fetch += time.perf_counter() - start
+			self.info.fetched += row is not None
+		return row
+	
+	def fetchmany(self, size = None):
+		size = self.arraysize if size is None else size
+		rows = []
+		if self.rows:
+			rows = self.rows[-size:][::-1] if size > 0 else []
+			del self.rows[len(self.rows) - len(rows):]
+			size -= len(rows)
+			if size <= 0:
+				return rows
+		start = time.perf_counter()
+		with self.lock:
+			fetched = super().fetchmany(size)
+		if len(fetched) < size:
+			self.__release__()
+		if self.info is not None:
+			self.info.fetch += time.perf_counter() - start
+			self.info.fetched += len(fetched)
+		return rows + fetched if rows else fetched
+	
+	def fetchall(self):
+		rows = self.rows[::-1]
+		self.rows = []
+		start = time.perf_counter()
+		with self.lock:
+			fetched = super().fetchall()
+		self.__release__()
+		if self.info is not None:
+			self.info.fetch += time.perf_counter() - start
+			self.info.fetched += len(fetched)
+		return rows + fetched if rows else fetched
+	
+	def close(self):
+		self.__done__()
+		super().close()
+
+class dbQueryStats:
+	"""Queries statistics by fingerprint, to be added as the after hook"""
+	
+	def __init__(self, samples = 1000):
+		"""Constructor
+		*samples* is the number of the last durations kept for each fingerprint to get percentiles
+		"""
+		self.samples = samples
+		self.data    = {}
+		self.lock    = threading.Lock()
+	
+	def __call__(self, info):
+		"""Add the query data
+		*info* is the dbQueryInfo object
+		"""
+		with self.lock:
+			item = self.data.get(info.fingerprint)
+			if item is None:
+				item = self.data[info.fingerprint] = {'count': 0, 'total': 0.0, 'fetched': 0, 'changed': 0, 'times': collections.deque(maxlen = self.samples)}
+			item['count']   += 1
+			item['total']   += info.duration
+			item['fetched'] += info.fetched
+			item['changed'] += info.changed
+			item['times'].append(info.duration)
+	
+	def Report(self, top = None):
+		"""Get the statistics ordered by the total time
+		*top* is the number of the slowest queries, all queries if not set
+		Returns list of dicts with fingerprint, count, total, mean, p50, p99, fetched and changed rows
+		"""
+		with self.lock:
+			items = [(fingerprint, dict(item), sorted(item['times'])) for fingerprint, item in self.data.items()]
+		report = []
+		for fingerprint, item, times in items:
+			del item['times']
+			item['fingerprint'] = fingerprint
+			item['mean'] = item['total'] / item['count']
+			# nearest rank percentiles
+			item['p50'] = times[max(0, -(-len(times) * 50 // 100) - 1)]
+			item['p99'] = times[max(0, -(-len(times) * 99 // 100) - 1)]
+			report.append(item)
+		report.sort(key = lambda item: item['total'], reverse = True)
+		return report[:top] if top else report
+	
+	def Reset(self):
+		"""Clear the statistics"""
+		with self.lock:
+			self.data = {}
+
+class dbSlowLog:
+	"""Log of the queries taking longer than the threshold, to be added as the after hook"""
+	
+	def __init__(self, threshold = 0.1, logger = None):
+		"""Constructor
+		*threshold* is the number of seconds starting from which the query is logged
+		*logger* is the logging.Logger object, the module logger if not set
+		"""
+		self.threshold = threshold
+		self.logger    = logger or log
+	
+	def __call__(self, info):
+		"""Log the query if it is slow
+		*info* is the dbQueryInfo object
+		"""
+		if info.duration >= self.threshold:
+			self.logger.warning('slow query %.3fs (build %.3fs, execute %.3fs, fetch %.3fs, fetched %s, changed %s): %s',
+				info.duration, info.build, info.execute, info.fetch, info.fetched, info.changed, info.fingerprint)
+
+class dbWriter:
+	"""Background writer running queries from any thread in group commits
+	Queries waiting in the queue are run in one transaction, each one in its own savepoint,
+	so a failed query doesn't roll back the others of the group
+	"""
+
+	def __init__(self, db, batch_size = 500, latency = 0.005, queue_size = 10000):
+		"""Constructor
+		*db* is a DataBase object with opened connection
+		*batch_size* is the maximum number of queries in one commit
+		*latency* is the number of seconds to wait for more queries after the first one of the group
+		*queue_size* is the number of waiting queries starting from which the new ones wait for the free place
+		"""
+		self.db         = db
+		self.batch_size = max(1, batch_size)
+		self.latency    = latency
+		self.queue  = queue.Queue(queue_size)
+		self.lock   = threading.Lock()
+		self.closed = False
+		self.commits = 0
+		self.thread = threading.Thread(target = self.Run, name = 'dbWriter', daemon = True)
+		self.thread.start()
+
+	def Submit(self, query, timeout = None, **values):
+		"""Put the insert/update/delete query to the queue
+		*query* is the SqlBuilder or SqlTemplate object, the builder is compiled on call and can be reused at once
+		*timeout* is the number of seconds to wait for the free place in the full queue, waits without limit if not set
+		*values* is the dict of the named parameters values
+		Returns concurrent.futures.Future resolved with the inserted row id or the query exception
+		"""
+		if isinstance(query, SqlBuilder):
+			query = query.Compile()
+		if not isinstance(query, SqlTemplate) or query.mode == 'select':
+			raise Exception('wrong query')
+		return self.__put__(query, values, timeout)
+
+	def SubmitRow(self, table, row, timeout = None):
+		"""Put the row insert to the queue
+		*table* is the table object or name
+		*row* is the dict of column names and values
+		*timeout* is the number of seconds to wait for the free place in the full queue, waits without limit if not set
+		Returns concurrent.futures.Future resolved with the inserted row id or the query exception
+		"""
+		if isinstance(table, dbTable):
+			table = table.__name__
+		if not row or not isinstance(row, dict):
+			raise Exception('wrong row')
+		columns = list(row.keys())
+		template = SqlTemplate('insert', 'insert into %s (%s) values (%s)' % (table, ', '.join(columns), ', '.join(['?'] * len(columns))), tuple(row[column] for column in columns), True)
+		return self.__put__(template, {}, timeout)
+
+	def __put__(self, template, values, timeout):
+		"""Put the query to the queue
+		Returns concurrent.futures.Future object
+		"""
+		future = concurrent.futures.Future()
+		# queries are checked and queued under the lock, so none of them gets behind the stop mark
+		if not self.lock.acquire(timeout = -1 if timeout is None else timeout):
+			raise Exception('writer queue is full')
+		try:
+			if self.closed:
+				raise Exception('writer is closed')
+			self.queue.put((future, template, values), timeout = timeout)
+		except queue.Full:
+			raise Exception('writer queue is full')
+		finally:
+			self.lock.release()
+		return future
+
+	def Run(self):
+		"""Background loop collecting queries into groups"""
+		stop = False
+		while not stop:
+			item = self.queue.get()
+			if item is None:
+				self.queue.task_done()
+				return
+			batch = [item]
+			deadline = time.monotonic() + self.latency
+			while len(batch) < self.batch_size:
+				try:
+					item = self.queue.get_nowait()
+				except queue.Empty:
+					wait = deadline - time.monotonic()
+					if wait <= 0:
+						break
+					try:
+						item = self.queue.get(timeout = wait)
+					except queue.Empty:
+						break
+				if item is None:
+					# stop after the current group
+					self.queue.task_done()
+					stop = True
+					break
+				batch.append(item)
+			self.Commit(batch)
+			for item in batch:
+				self.queue.task_done()
+
+	def Commit(self, batch):
+		"""Run the group of queries in one transaction and resolve their futures after the commit
+		*batch* is the list of future, template and values tuples
+		"""
+		batch   = [item for item in batch if item[0].set_running_or_notify_cancel()]
+		results = []
+		try:
+			with self.db.Transaction('immediate'):
+				for future, template, values in batch:
+					try:
+						with self.db.Transaction():
+							results.append((future, template.ExecuteIn(self.db, **values), None))
+					except Exception as error:
+						results.append((future, None, error))
+		except Exception as error:
+			log.exception('writer group commit failed')
+			for future, template, values in batch:
+				future.set_exception(error)
+			return
+		self.commits += 1
+		for future, result, error in results:
+			if error is None:
+				future.set_result(result)
+			else:
+				future.set_exception(error)
+
+	def Flush(self):
+		"""Wait for all the queued queries to be committed"""
+		self.queue.join()
+
+	def Close(self):
+		"""Commit the queued queries and stop the writer thread"""
+		with self.lock:
+			if self.closed:
+				return
+			self.closed = True
+			self.queue.put(None)
+		if self.thread is not threading.current_thread():
+			self.thread.join()
+
+class DataBase:
+	"""DB wrapper"""
+	
+	"Database file name; in memory mode if empty"
+	__dbfile__ = None
+	
+	"Connection handler, the only one used for writing"
+	__conn__ = None
+	
+	"Size of the connection LRU cache of prepared statements"
+	__statements__ = 128
+	
+	"Nesting level of the current explicit transaction, 0 if there is no one"
+	__depth__ = 0
+	
+	"Pool of connections for reading; all queries use the main connection if not set"
+	__pool__ = None
+	
+	"In memory copy of the db file for reading, used instead of the pool if set"
+	__replica__ = None
+	
+	"Background group commit writer, started by the first Writer call"
+	__writer__ = None
+	
+	"Tables structure cache file name, not used if empty"
+	__cache__ = None
+	
+	"Lazy mode flag and not yet created tables data, tables are created on the first access in this mode"
+	__lazy__   = False
+	__tables__ = {}
+	
+	"Lock for the main connection and the thread id holding it in explicit transaction"
+	__lock__  = None
+	__owner__ = None
+	
+	"Query plan check mode - {raise|log}, not checked if empty, and the table size to report full scans from"
+	__plan__      = None
+	__plan_rows__ = 1000
+	
+	"Tables sizes and the fingerprints of the queries already passed the plan check"
+	__sizes__   = None
+	__checked__ = None
+	
+	"Selects results cache, disabled if not set, and the tables changed in the current explicit transaction"
+	__results__ = None
+	__dirty__   = None
+	
+	"Profiling hooks lists by stage - {before|after}"
+	__hooks__ = None
+	
+	"Ids of unique column values by table and column names kept by GetOrCreateMany"
+	__ids__ = None
+	
+	"Storage profiles, journal mode and page size are set for the db file, other pragmas for each connection"
+	__profiles__ = {
+		'default'    : {},
+		'read_heavy' : {'page_size': 8192, 'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -65536, 'mmap_size': 268435456, 'temp_store': 'memory', 'busy_timeout': 5000},
+		'bulk_load'  : {'page_size': 8192, 'journal_mode': 'memory', 'synchronous': 'off', 'cache_size': -262144, 'temp_store': 'memory', 'busy_timeout': 5000},
+		'durable'    : {'journal_mode': 'wal', 'synchronous': 'full', 'busy_timeout': 5000}
+	}
+	
+	"Profile pragmas in order of applying, the flag shows if the pragma is set for pool connections, and the values as read back"
+	__pragmas__ = [('page_size', False), ('journal_mode', False), ('synchronous', False), ('cache_size', True), ('mmap_size', True), ('temp_store', True), ('busy_timeout', True)]
+	__values__  = {'synchronous': {'off': 0, 'normal': 1, 'full': 2, 'extra': 3}, 'temp_store': {'default': 0, 'file': 1, 'memory': 2}}
+	
+	def __init__(self, dbfile = None, statements = 128, pool = 0, timeout = 5.0, cache = None, lazy = False, plan = None, plan_rows = 1000, results = 0, results_ttl = None, results_check = 1.0, profile = None, replica = None, replica_check = 1.0):
+		"""Constructor
+		*dbfile* is a file name of the sqlite db
+		*statements* is a number of prepared statements kept by the connection
+		*pool* is a number of connections for reading shared between threads, switches db to WAL mode
+		*timeout* is the number of seconds to wait for a free pool connection
+		*cache* is a tables structure cache file name or True to keep it near the db file as "dbfile.struct"
+		*lazy* is a flag to create tables on the first access instead of the whole db investigation
+		*plan* is the query plan check mode for selects - {raise|log}, full scans of big tables and temporary b-trees are reported
+		*plan_rows* is the table size starting from which full scans are reported
+		*results* is the maximum number of rows kept in the selects results cache, the cache is disabled if 0
+		*results_ttl* is the number of seconds a cached result is kept, not limited if not set
+		*results_check* is the number of seconds between checks for other processes commits to drop the cached results
+		*profile* is the storage profile name - {default|read_heavy|bulk_load|durable} or the dict of pragmas
+		*replica* is the read copy mode - {memory}, selects outside explicit transactions read the in memory copy of the db file
+		*replica_check* is the number of seconds between checks for commits to reload the copy, only Refresh calls reload it if not set
+		"""
+		if plan not in [None, 'raise', 'log']:
+			raise Exception('wrong plan check mode')
+		if replica not in [None, 'memory']:
+			raise Exception('wrong replica mode')
+		if replica and pool > 0:
+			raise Exception('replica and pool can not be used together')
+		self.__plan__      = plan
+		self.__plan_rows__ = plan_rows
+		self.__sizes__     = {}
+		self.__checked__   = set()
+		self.__dirty__     = set()
+		self.__hooks__     = {'before': [], 'after': []}
+		self.__ids__       = {}
+		if results > 0:
+			self.__results__ = dbResultCache(results, results_ttl, results_check)
+		self.__statements__ = statements
+		self.__lock__  = threading.RLock()
+		self.__local__ = threading.local()
+		self.__lazy__  = lazy
+		if dbfile and os.path.isfile(dbfile):
+			# check input data and choose connection type
+			self.__dbfile__ = dbfile
+			if cache:
+				self.__cache__ = cache if isinstance(cache, str) else dbfile + '.struct'
+			if pool > 0:
+				# readers and the writer don't block each other in WAL mode
+				self.__conn__ = sqlite3.connect(self.__dbfile__, cached_statements = self.__statements__, check_same_thread = False)
+				self.__conn__.execute('pragma journal_mode = wal')
+				self.__pool__ = dbPool(self.__dbfile__, pool, timeout, self.__statements__)
+			else:
+				# writes of other threads and the background writer are serialized by the lock
+				self.__conn__ = sqlite3.connect(self.__dbfile__, cached_statements = self.__statements__, check_same_thread = False)
+			if profile:
+				self.__configure__(profile)
+			self.__struct__(lazy)
+			if replica:
+				self.__replica__ = dbReplica(self.__dbfile__, replica_check, self.__statements__)
+		else:
+			self.__conn__ = sqlite3.connect(':memory:', cached_statements = self.__statements__, check_same_thread = False)
+			if profile:
+				self.__configure__(profile)
+
+	def __del__(self):
+		"""Destructor to close connection if necessary"""
+		self.Close()
+	
+	def Close(self):
+		"""Close all the connections, queries queued to the writer are committed before"""
+		if self.__writer__:
+			self.__writer__.Close()
+			self.__writer__ = None
+		if self.__replica__:
+			self.__replica__.Close()
+			self.__replica__ = None
+		if self.__pool__:
+			self.__pool__.Close()
+			self.__pool__ = None
+		if self.__conn__:
+			self.__conn__.close()
+			self.__conn__ = None
+	
+	def __reader__(self):
+		"""Get the connection for reading in the current thread
+		Returns the replica or the main connection, the pool connection bound to the thread by Connection block
+		or None if the query should take the pool connection for its cursor
+		"""
+		if self.__replica__ is not None and self.__owner__ != threading.get_ident():
+			return self.__replica__.conn
+		if self.__pool__ is None or self.__owner__ == threading.get_ident():
+			return self.__conn__
+		holder = getattr(self.__local__, 'holder', None)
+		if holder is None:
+			return None
+		return holder.conn
+	
+	def __guard__(self, conn):
+		"""Get the lock to read with the connection
+		The main connection is shared between threads, so reads of other threads wait for the end of its explicit transaction
+		instead of seeing the not committed changes
+		*conn* is the connection got by __reader__
+		Returns the main connection lock or the empty context for pool and replica connections
+		"""
+		if conn is self.__conn__:
+			return self.__lock__
+		return contextlib.nullcontext()
+	
+	def __read__(self, sql, params = (), build = 0.0):
+		"""Run select query
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		Returns cursor with the query result
+		"""
+		if self.__plan__ and dbQueryInfo.Fingerprint(sql) not in self.__checked__:
+			self.CheckPlan(sql, params)
+		hooks = self.__hooks__['before'] or self.__hooks__['after']
+		conn  = self.__reader__()
+		if not hooks and conn is not None and conn is not self.__conn__:
+			cur = conn.cursor()
+			cur.row_factory = sqlite3.Row
+			cur.execute(sql, params)
+			return cur
+		info   = self.__before__('read', sql, params, build) if hooks else None
+		holder = None
+		if conn is None:
+			# the pool connection is returned when the cursor is read to the end or closed, not on the thread exit
+			holder = dbPoolHolder(self.__pool__)
+			conn   = holder.conn
+		with self.__guard__(conn):
+			cur = conn.cursor(dbCursor)
+			cur.holder = holder
+			if conn is self.__conn__:
+				# streamed rows are fetched between the explicit transactions of other threads too
+				cur.lock = self.__lock__
+			cur.row_factory = sqlite3.Row
+			try:
+				cur.execute(sql, params)
+			except BaseException:
+				cur.close()
+				raise
+		if info is not None:
+			info.execute = time.perf_counter() - info.start
+			cur.info = info
+			cur.db   = self
+		return cur
+	
+	def __write__(self, sql, params = (), build = 0.0, rows = None):
+		"""Run insert/update/delete query on the main connection and commit it
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		*rows* is the list to add the returned records as dicts to
+		Returns closed cursor with the last row id and the number of changes
+		"""
+		info = None
+		if self.__hooks__['before'] or self.__hooks__['after']:
+			info = self.__before__('write', sql, params, build)
+		with self.__lock__:
+			cur = self.__conn__.cursor()
+			try:
+				cur.execute(sql, params)
+				if rows is not None:
+					names = [column[0] for column in cur.description]
+					rows.extend(dict(zip(names, row)) for row in cur.fetchall())
+				self.__commit__()
+				self.__changed__(sql)
+			finally:
+				cur.close()
+		if info is not None:
+			info.execute = time.perf_counter() - info.start
+			info.changed = cur.rowcount
+			self.__after__(info)
+		return cur
+	
+	def __before__(self, kind, sql, params = (), build = 0.0):
+		"""Call the before hooks and start the query timer
+		*kind* is the query type - {read|write}
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		Returns dbQueryInfo object
+		"""
+		info = dbQueryInfo(kind, sql, params, build)
+		for hook in self.__hooks__['before']:
+			hook(info)
+		info.start = time.perf_counter()
+		return info
+	
+	def __after__(self, info):
+		"""Call the after hooks
+		*info* is the dbQueryInfo object
+		"""
+		for hook in self.__hooks__['after']:
+			hook(info)
+	
+	def AddHook(self, stage, hook):
+		"""Add the profiling hook called for each query with dbQueryInfo object
+		Before hooks get only the query sql, fingerprint and build time
+		After hooks of selects are called when the cursor is closed, with the fetched rows number and time
+		*stage* is the hook call moment - {before|after}
+		*hook* is the function, dbQueryStats and dbSlowLog objects are the ready after hooks
+		"""
+		if stage not in self.__hooks__:
+			raise Exception('wrong hook stage')
+		# lists are replaced, not changed, for the queries running in other threads
+		self.__hooks__ = dict(self.__hooks__, **{stage: self.__hooks__[stage] + [hook]})
+		return hook
+	
+	def RemoveHook(self, stage, hook):
+		"""Remove the profiling hook
+		*stage* is the hook call moment - {before|after}
+		*hook* is the function added before
+		"""
+		if stage not in self.__hooks__:
+			raise Exception('wrong hook stage')
+		self.__hooks__ = dict(self.__hooks__, **{stage: [item for item in self.__hooks__[stage] if item is not hook]})
+	
+	def Trace(self, callback = None, progress = None, steps = 1000):
+		"""Set the statements trace callback and the progress handler for all connections, unset if not given
+		*callback* is the function called with each statement sql as executed
+		*progress* is the function called every *steps* virtual machine instructions, non zero result aborts the query
+		*steps* is the number of instructions between progress calls
+		"""
+		with self.__lock__:
+			self.__conn__.set_trace_callback(callback)
+			self.__conn__.set_progress_handler(progress, steps)
+		if self.__pool__:
+			self.__pool__.Trace(callback, progress, steps)
+		if self.__replica__:
+			self.__replica__.Trace(callback, progress, steps)
+	
+	def __fetchall__(self, sql, params = (), build = 0.0):
+		"""Run select query and get all the records, taken from the results cache if enabled
+		The cache is bypassed inside the explicit transaction
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		*build* is the number of seconds spent to build the query sql
+		Returns list of dict records
+		"""
+		if self.__results__ is None or self.__owner__ == threading.get_ident():
+			names, rows = dbResultCache.Read(self, sql, params, build)
+		else:
+			names, rows = self.__results__.Fetch(self, sql, params, build)
+		return [dict(zip(names, row)) for row in rows]
+	
+	def __changed__(self, sql):
+		"""Drop the cached results of the tables changed by the query
+		Tables changed in the explicit transaction are dropped on its end
+		*sql* is the insert/update/delete query sql
+		"""
+		# updated or deleted rows could be cached by GetOrCreateMany, replaces and upserts change existing rows too
+		if self.__ids__ and not (re.match(r'\s*insert\b(?!\s+or\s+replace\b)', sql, re.I) and not re.search(r'\bdo\s+update\b', sql, re.I)):
+			self.__ids__.clear()
+		if self.__results__ is not None:
+			if self.__depth__:
+				self.__dirty__.update(self.__results__.Written(sql))
+			else:
+				self.__results__.Invalidate(self.__results__.Written(sql))
+	
+	@contextlib.contextmanager
+	def Connection(self):
+		"""Bind the pool connection to the current thread for the block
+		Returns the connection for reading
+		"""
+		conn = self.__reader__()
+		if conn is not None:
+			yield conn
+		else:
+			self.__local__.holder = dbPoolHolder(self.__pool__)
+			try:
+				yield self.__local__.holder.conn
+			finally:
+				self.Release()
+	
+	def Release(self):
+		"""Return the pool connection bound to the current thread"""
+		holder = self.__local__.__dict__.pop('holder', None)
+		if holder is not None:
+			holder.Release()
+	
+	def Writer(self, batch_size = 500, latency = 0.005, queue_size = 10000):
+		"""Get the background writer grouping queries from all threads into one commit, started on the first call
+		The writer is stopped by Close
+		*batch_size* is the maximum number of queries in one commit
+		*latency* is the number of seconds to wait for more queries after the first one of the group
+		*queue_size* is the number of waiting queries starting from which the new ones wait for the free place
+		Returns dbWriter object
+		"""
+		with self.__lock__:
+			if self.__writer__ is None:
+				self.__writer__ = dbWriter(self, batch_size, latency, queue_size)
+		return self.__writer__
+	
+	def Refresh(self):
+		"""Reload the in memory replica from the db file, own writes are seen by its readers after that
+		Returns True if the replica is reloaded
+		"""
+		if self.__replica__ is None:
+			return False
+		return self.__replica__.Refresh()
+	
+	def __commit__(self):
+		"""Commit changes unless there is an explicit transaction to commit them later"""
+		if not self.__depth__:
+			self.__conn__.commit()
+	
+	@contextlib.contextmanager
+	def Transaction(self, mode = 'deferred'):
+		"""Run the block of statements as a single transaction, nested calls use savepoints
+		All changes are rolled back on exception and committed on exit otherwise
+		Other threads writes wait for the transaction end
+		*mode* is the outermost transaction type - {deferred|immediate|exclusive}
+		"""
+		mode = mode.lower().strip()
+		if mode not in ['deferred', 'immediate', 'exclusive']:
+			raise Exception('wrong transaction mode')
+		with self.__lock__:
+			savepoint = ''
+			if self.__depth__:
+				savepoint = 'level%s' % self.__depth__
+				self.__conn__.execute('savepoint %s' % savepoint)
+			else:
+				if self.__conn__.in_transaction:
+					self.__conn__.commit()
+				self.__conn__.execute('begin %s' % mode)
+				self.__owner__ = threading.get_ident()
+			self.__depth__ += 1
+			try:
+				yield self
+			except BaseException:
+				self.__depth__ -= 1
+				self.__ids__.clear()
+				if savepoint:
+					self.__conn__.execute('rollback to %s' % savepoint)
+					self.__conn__.execute('release %s' % savepoint)
+				else:
+					self.__owner__ = None
+					self.__conn__.rollback()
+					self.__flush__()
+				raise
+			self.__depth__ -= 1
+			if savepoint:
+				self.__conn__.execute('release %s' % savepoint)
+			else:
+				self.__owner__ = None
+				self.__conn__.commit()
+				self.__flush__()
+	
+	def __flush__(self):
+		"""Drop the cached results of the tables changed in the finished transaction"""
+		if self.__results__ is not None and self.__dirty__:
+			self.__results__.Invalidate(self.__dirty__)
+		self.__dirty__ = set()
+	
+	def __configure__(self, profile):
+		"""Apply the storage profile pragmas to the main connection and the pool and check them
+		Journal mode isn't changed for the db in memory and with the pool which needs WAL mode,
+		page size is changed only for the empty db
+		*profile* is the profile name or the dict of pragmas
+		Returns dict of the previous values of the changed pragmas
+		"""
+		pragmas = profile if isinstance(profile, dict) else self.__profiles__.get(profile)
+		if pragmas is None:
+			raise Exception('wrong storage profile')
+		known = dict(self.__pragmas__)
+		for name, value in pragmas.items():
+			if name not in known or not re.match(r'^-?\w+$', str(value)):
+				raise Exception("wrong pragma '%s'" % name)
+		if self.__depth__:
+			raise Exception('storage profile can not be changed in transaction')
+		previous = {}
+		with self.__lock__:
+			if self.__conn__.in_transaction:
+				self.__conn__.commit()
+			for name, shared in self.__pragmas__:
+				if name not in pragmas:
+					continue
+				if name == 'journal_mode' and (not self.__dbfile__ or self.__pool__):
+					continue
+				if name == 'page_size' and self.__conn__.execute('pragma page_count').fetchone()[0]:
+					continue
+				value  = pragmas[name]
+				expect = self.__values__.get(name, {}).get(str(value).lower(), value)
+				previous[name] = self.__conn__.execute('pragma %s' % name).fetchone()[0]
+				self.__conn__.execute('pragma %s = %s' % (name, value)).fetchall()
+				actual = self.__conn__.execute('pragma %s' % name).fetchone()[0]
+				# mmap size is limited by the sqlite build
+				if name == 'mmap_size' and 0 <= actual <= expect:
+					continue
+				if str(actual).lower() != str(expect).lower():
+					raise Exception("pragma %s is %s instead of %s" % (name, actual, value))
+		if self.__pool__:
+			self.__pool__.Configure(dict((name, pragmas[name]) for name, shared in self.__pragmas__ if shared and name in pragmas))
+		return previous
+	
+	def SetProfile(self, profile):
+		"""Apply the storage profile
+		*profile* is the profile name - {default|read_heavy|bulk_load|durable} or the dict of pragmas
+		Returns dict of the previous values of the changed pragmas
+		"""
+		return self.__configure__(profile)
+	
+	@contextlib.contextmanager
+	def UseProfile(self, profile):
+		"""Apply the storage profile for the block, the previous pragmas values are restored on exit
+		*profile* is the profile name - {default|read_heavy|bulk_load|durable} or the dict of pragmas
+		"""
+		previous = self.__configure__(profile)
+		try:
+			yield self
+		finally:
+			self.__configure__(previous)
+	
+	def GetOrCreateMany(self, table, column, values, cache = False, chunk_size = 500):
+		"""Get ids of the rows with the given unique column values, missing rows are inserted
+		Values are resolved by chunks with one select and one insert for each in a single transaction
+		*table* is the dbTable object or the table name
+		*column* is the unique column object or name
+		*values* is the list of the column values
+		*cache* is a flag to keep the ids in memory for the next calls, dropped on updates, deletes and rollbacks
+		*chunk_size* is the number of values in one statement
+		Returns dict of values and ids
+		"""
+		if not isinstance(table, dbTable):
+			table = getattr(self, table, None)
+		if isinstance(column, dbTableColumn):
+			column = column.__name__
+		if not isinstance(table, dbTable) or column not in table.__columns__:
+			raise Exception('wrong table or column')
+		keys = [name for name in table.__columns__ if getattr(table, name).__data__['pk']]
+		id   = keys[0] if len(keys) == 1 else 'rowid'
+		ids  = self.__ids__.get((table.__name__, column), {}) if cache else {}
+		result  = {}
+		missing = []
+		for value in dict.fromkeys(values):
+			if value in ids:
+				result[value] = ids[value]
+			elif value is not None:
+				missing.append(value)
+		if missing:
+			with self.Transaction('immediate'):
+				for pos in range(0, len(missing), max(1, chunk_size)):
+					chunk = missing[pos:pos + max(1, chunk_size)]
+					marks = ', '.join(['?'] * len(chunk))
+					cur = self.__read__('select %s, %s from %s where %s in (%s)' % (column, id, table.__name__, column, marks), chunk)
+					try:
+						found = dict((row[0], row[1]) for row in cur)
+					finally:
+						cur.close()
+					chunk = [value for value in chunk if value not in found]
+					if chunk:
+						# the transaction holds the write lock, so there are no conflicts with other writers
+						rows = []
+						self.__write__('insert into %s (%s) values %s on conflict (%s) do nothing returning %s, %s' % (table.__name__, column, ', '.join(['(?)'] * len(chunk)), column, column, id), chunk, 0.0, rows)
+						found.update((row[column], row[id]) for row in rows)
+					result.update(found)
+			if cache:
+				self.__ids__.setdefault((table.__name__, column), {}).update((value, result[value]) for value in missing)
+		return result
+	
+	def __struct__(self, lazy = False):
+		"""Investigate the db, collecting tables and columns data
+		The result is taken from the cache file if the db schema version is the same
+		*lazy* is a flag to postpone tables creation till the first access
+		"""
+		version = self.__conn__.execute('pragma schema_version').fetchone()[0]
+		struct  = None
+		if self.__cache__ and os.path.isfile(self.__cache__):
+			try:
+				with open(self.__cache__) as cache:
+					struct = json.load(cache)
+				if struct.get('version') != version:
+					struct = None
+			except (OSError, ValueError):
+				struct = None
+		if struct is None:
+			if lazy:
+				# tables are investigated one by one on access
+				self.__tables__ = {}
+				return
+			struct = self.__inspect__()
+			struct['version'] = version
+			if self.__cache__:
+				# replace the cache file at once for concurrent processes
+				try:
+					with open(self.__cache__ + '.tmp', 'w') as cache:
+						json.dump(struct, cache)
+					os.replace(self.__cache__ + '.tmp', self.__cache__)
+				except OSError:
+					pass
+		if lazy:
+			self.__tables__ = struct['tables']
+			return
+		for tbl, info in struct['tables'].items():
+			self.__define__(tbl, info)
+	
+	def __define__(self, tbl, info):
+		"""Add the table with its columns to the db object
+		*tbl* is the table name
+		*info* is the dict with table columns, indexes and foreign keys
+		Returns dbTable object
+		"""
+		# add table as class
+		tbl_class = dbTable(tbl, [column[0] for column in info['columns']], info['indexes'], info['fkeys'])
+		search = info.get('search', {})
+		for name, type, pk in info['columns']:
+			# add columns for tables
+			setattr(tbl_class, name, dbTableColumn(name, {'table':tbl, 'type':type, 'pk':pk}, True))
+			if name in search:
+				getattr(tbl_class, name).__data__['search'] = search[name]
+		setattr(self, tbl, tbl_class)
+		return tbl_class
+	
+	def __getattr__(self, name):
+		"""Create the table on the first access in lazy mode
+		*name* is the table name
+		Returns dbTable object
+		"""
+		if name.startswith('__') or not self.__lazy__ or not self.__conn__:
+			raise AttributeError(name)
+		info = self.__tables__.get(name)
+		if info is None:
+			info = self.__inspect__([name])['tables'].get(name)
+			if info is None:
+				raise AttributeError(name)
+		return self.__define__(name, info)
+	
+	def CreateSearch(self, table, columns, name = None, tokenize = None):
+		"""Create the full text search index of the table columns kept in sync by triggers
+		Indexed columns get the Match operator
+		*table* is the table object or name, it should have the integer primary key
+		*columns* is the list of text columns objects or names
+		*name* is the index name, "table_fts" if not set
+		*tokenize* is the fts5 tokenizer options, e.g. "porter unicode61", the default one if not set
+		Returns dbTable object of the index
+		"""
+		table = getattr(self, table.__name__ if isinstance(table, dbTable) else table)
+		columns = [column.__name__ if isinstance(column, dbTableColumn) else column for column in columns]
+		keys = [key for key in table.__columns__ if getattr(table, key).__data__['pk']]
+		if len(keys) != 1 or getattr(table, keys[0]).__affinity__() != 'integer':
+			raise Exception('full text search needs the integer primary key')
+		for column in columns:
+			if not isinstance(getattr(table, column, None), dbTableColumn):
+				raise Exception("wrong column '%s'" % column)
+		tbl  = table.__name__
+		key  = keys[0]
+		name = name or '%s_fts' % tbl
+		options = "content='%s', content_rowid='%s'" % (tbl, key)
+		if tokenize:
+			options += ", tokenize='%s'" % tokenize
+		fields = ', '.join(columns)
+		new = ', '.join(['new.%s' % column for column in columns])
+		old = ', '.join(['old.%s' % column for column in columns])
+		with self.Transaction():
+			self.__conn__.execute('create virtual table %s using fts5(%s, %s)' % (name, fields, options))
+			self.__conn__.execute('create trigger %s_insert after insert on %s begin insert into %s (rowid, %s) values (new.%s, %s); end' % (name, tbl, name, fields, key, new))
+			self.__conn__.execute("create trigger %s_delete after delete on %s begin insert into %s (%s, rowid, %s) values ('delete', old.%s, %s); end" % (name, tbl, name, name, fields, key, old))
+			self.__conn__.execute("create trigger %s_update after update on %s begin insert into %s (%s, rowid, %s) values ('delete', old.%s, %s); insert into %s (rowid, %s) values (new.%s, %s); end" % (name, tbl, name, name, fields, key, old, name, fields, key, new))
+			self.__conn__.execute("insert into %s (%s) values ('rebuild')" % (name, name))
+		for tbl, info in self.__inspect__([table.__name__, name])['tables'].items():
+			self.__define__(tbl, info)
+		return getattr(self, name)
+	
+	def Warm(self, *names):
+		"""Create the given tables at once in lazy mode
+		*names* is a list of table names
+		"""
+		names = [name for name in names if not isinstance(vars(self).get(name), dbTable)]
+		tables = dict((name, self.__tables__[name]) for name in names if name in self.__tables__)
+		missing = [name for name in names if name not in tables]
+		if missing:
+			tables.update(self.__inspect__(missing)['tables'])
+		for name, info in tables.items():
+			self.__define__(name, info)
+	
+	def __inspect__(self, names = None):
+		"""Read tables with columns, indexes and foreign keys
+		*names* is a list of table names to read, all tables are read if not set
+		Returns dict with tables data
+		"""
+		tables = {}
+		filter = ''
+		params = ()
+		if names is not None:
+			filter = ' and m.name in (%s)' % ', '.join(['?'] * len(names))
+			params = tuple(names)
+		cur = self.__conn__.cursor()
+		cur.execute("select m.name, p.name, p.type, p.pk from sqlite_master m join pragma_table_info(m.name) p where m.type in ('table', 'view')%s order by m.name, p.cid" % filter, params)
+		for tbl, name, type, pk in cur:
+			tables.setdefault(tbl, {'columns': [], 'indexes': {}, 'fkeys': []})['columns'].append([name, type, pk])
+		cur.execute("select m.name, i.name, i.[unique], c.name from sqlite_master m join pragma_index_list(m.name) i join pragma_index_info(i.name) c where m.type = 'table'%s order by m.name, i.name, c.seqno" % filter, params)
+		for tbl, name, unique, column in cur:
+			tables[tbl]['indexes'].setdefault(name, {'columns': [], 'unique': bool(unique)})['columns'].append(column)
+		cur.execute("select m.name, f.id, f.[table], f.[from], f.[to] from sqlite_master m join pragma_foreign_key_list(m.name) f where m.type = 'table'%s order by m.name, f.id, f.seq" % filter, params)
+		fkeys = {}
+		for tbl, id, table, column, to in cur:
+			if (tbl, id) not in fkeys:
+				fkeys[(tbl, id)] = {'columns': [], 'table': table, 'to': []}
+				tables[tbl]['fkeys'].append(fkeys[(tbl, id)])
+			fkeys[(tbl, id)]['columns'].append(column)
+			fkeys[(tbl, id)]['to'].append(to)
+		# full text search indexes of the content tables, the index name and the content table key by columns
+		cur.execute("select name, sql from sqlite_master where type = 'table' and lower(sql) like 'create virtual table%using fts5%'")
+		for name, sql in cur:
+			options = dict(re.findall(r"(\w+)\s*=\s*'([^']*)'", sql))
+			if options.get('content') in tables and options.get('content_rowid'):
+				columns = re.search(r'fts5\s*\((.*)\)', sql, re.I | re.S).group(1).split(',')
+				search = tables[options['content']].setdefault('search', {})
+				for column in columns:
+					if '=' not in column and column.split():
+						search[column.split()[0]] = [name, options['content_rowid']]
+		cur.close()
+		return {'tables': tables}
+	
+	def Explain(self, sql, params = ()):
+		"""Get the query plan
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		Returns list of the plan tree root nodes, each node is a dict with id, detail and children list
+		"""
+		nodes = {}
+		roots = []
+		with self.Connection() as conn, self.__guard__(conn):
+			plan = conn.execute('explain query plan %s' % sql, params).fetchall()
+		for id, parent, notused, detail in plan:
+			node = {'id': id, 'detail': detail, 'children': []}
+			nodes[id] = node
+			(nodes[parent]['children'] if parent in nodes else roots).append(node)
+		return roots
+	
+	def CheckPlan(self, sql, params = ()):
+		"""Check the query plan for full scans of big tables and temporary b-trees for sorting
+		Problems are raised or logged according to the plan check mode
+		*sql* is the query sql
+		*params* is the tuple or dict of the query placeholders values
+		Returns list of problems descriptions
+		"""
+		problems = []
+		stack = list(reversed(self.Explain(sql, params)))
+		while stack:
+			node = stack.pop()
+			stack.extend(reversed(node['children']))
+			detail = node['detail']
+			match = re.match(r'SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$', detail)
+			if match:
+				# index only reads are the cheapest full pass possible
+				if 'COVERING INDEX' in match.group(2):
+					continue
+				# virtual tables like full text search indexes find rows by their own means
+				if 'VIRTUAL TABLE' in match.group(2):
+					continue
+				size = self.__size__(match.group(1))
+				if size is None or size < self.__plan_rows__:
+					continue
+				problem = 'full scan of %s (%s rows)' % (match.group(1), size)
+				missing = self.__unindexed__(match.group(1), sql)
+				if missing:
+					problem += ', no index on %s(%s)' % (match.group(1), ', '.join(missing))
+				problems.append(problem)
+			elif detail.startswith('USE TEMP B-TREE FOR '):
+				problems.append('temporary b-tree for %s' % detail[len('USE TEMP B-TREE FOR '):].lower())
+		if problems and self.__plan__ == 'raise':
+			raise Exception('query plan: %s in "%s"' % ('; '.join(problems), sql))
+		if problems and self.__plan__ == 'log':
+			log.warning('query plan: %s in "%s"', '; '.join(problems), sql)
+		# the same query is reported only once, queries differing in literal values only are the same
+		self.__checked__.add(dbQueryInfo.Fingerprint(sql))
+		return problems
+	
+	def __size__(self, tbl):
+		"""Get the table size, taken from the analyze statistics if present
+		*tbl* is the table name
+		Returns number of rows or None for unknown tables
+		"""
+		if tbl not in self.__sizes__:
+			with self.Connection() as conn, self.__guard__(conn):
+				cur = conn.cursor()
+				try:
+					try:
+						row = cur.execute("select stat from sqlite_stat1 where tbl = ? and idx is null", (tbl,)).fetchone()
+					except sqlite3.OperationalError:
+						row = None
+					if row is None:
+						row = cur.execute('select count(*) from "%s"' % tbl.replace('"', '""')).fetchone()
+					self.__sizes__[tbl] = int(str(row[0]).split()[0])
+				except sqlite3.Error:
+					self.__sizes__[tbl] = None
+				finally:
+					cur.close()
+		return self.__sizes__[tbl]
+	
+	def __unindexed__(self, tbl, sql):
+		"""Get the table columns used in the query conditions without an index to search them
+		*tbl* is the table name
+		*sql* is the query sql
+		Returns list of column names
+		"""
+		table = getattr(self, tbl, None)
+		if not isinstance(table, dbTable):
+			return []
+		# only the leading index column is usable for a search by the column alone
+		indexed = set(index['columns'][0] for index in table.__indexes__.values())
+		indexed.update(name for name in table.__columns__ if getattr(table, name).__data__['pk'])
+		position = sql.lower().find(' from ')
+		missing = []
+		for name in re.findall(r'\b%s\.(\w+)\b' % re.escape(tbl), sql[position:] if position >= 0 else ''):
+			if name in table.__columns__ and name not in indexed and name not in missing:
+				missing.append(name)
+		return missing
+
+class dbQueryState:
+	"""Base class for compact sql building parameters of one query mode"""
+	
+	__slots__ = ()
+	
+	"Parameters default values, mutable ones are copied for each instance"
+	defaults = {}
+	
+	def __init__(self):
+		"""Constructor"""
+		for name, value in self.defaults.items():
+			if isinstance(value, (list, dict)):
+				value = type(value)()
+			setattr(self, name, value)
+	
+	def __getitem__(self, name):
+		"""Get parameter value by name"""
+		return getattr(self, name)
+	
+	def __setitem__(self, name, value):
+		"""Set parameter value by name"""
+		setattr(self, name, value)
 
-class DataBase:
-	"""DB wrapper"""
+class dbSelectState(dbQueryState):
+	"""Select query parameters"""
 	
-	"Database file name; in memory mode if empty"
-	__dbfile__ = None
+	defaults  = {'select': [], 'distinct': False, 'from': [], 'join': [], 'where': '', 'params': (), 'cond': None, 'group': [], 'having': '', 'order': [], 'limit': '', 'page': None, 'prefetch': []}
+	__slots__ = tuple(defaults)
+
+class dbInsertState(dbQueryState):
+	"""Insert query parameters"""
 	
-	"Connection handler"
-	__conn__ = None
+	defaults  = {'id': None, 'data': {}, 'rows': None, 'cols': [], 'into': '', 'conflict': None, 'returning': []}
+	__slots__ = tuple(defaults)
+
+class dbUpdateState(dbQueryState):
+	"""Update query parameters"""
 	
-	def __init__(self, dbfile = None):
-		"""Constructor
-		*dbfile* is a file name of the sqlite db
-		"""
-		if dbfile and os.path.isfile(dbfile):
-			# check input data and choose connection type
-			self.__dbfile__ = dbfile
-			self.__conn__ = sqlite3.connect(self.__dbfile__)
-			self.__struct__()
-		else:
-			self.__conn__ = sqlite3.connect(':memory:')
+	defaults  = {'table': '', 'data': {}, 'where': '', 'params': (), 'cond': None}
+	__slots__ = tuple(defaults)
 
-	def __del__(self):
-		"""Destructor to close connection if necessary"""
-		if self.__conn__:
-			self.__conn__.close()
+class dbDeleteState(dbQueryState):
+	"""Delete query parameters"""
 	
-	def __struct__(self):
-		"""Investigate the db, collecting tables and columns data"""
-		cur = self.__conn__.cursor()
-		# get all tables
-		cur.execute('select tbl_name from sqlite_master')
-		struct = []
-		for row in cur:
-			struct.append(row[0])
-		for tbl in struct:
-			# iterate all tables and get columns with details for each
-			cur.execute('pragma table_info(%s)' % tbl)
-			# add table as class
-			tbl_class = dbTable(tbl)
-			setattr(self, tbl, tbl_class)
-			for row in cur:
-				# add columns for tables
-				setattr(tbl_class, row[1], dbTableColumn(row[1], {'table':tbl, 'type':row[2], 'pk':row[5]}, True))
-		cur.close()
+	defaults  = {'table': '', 'where': '', 'params': (), 'cond': None}
+	__slots__ = tuple(defaults)
 
 class SqlBuilder:
 	"""Query builder"""
@@ -207,71 +1979,71 @@ class SqlBuilder:
 	"Last executed query sql"
 	sql = ''
 	
+	"Last executed query parameters"
+	params = ()
+	
+	"Compile mode flag - values are passed as placeholders with parameters if set"
+	bind = False
+	
 	"Query mode - {select|insert|update|delete}"
 	mode = ''
 	
-	"""Sql building parameters with flags and check rules
-	Rules - shows after which parts the current one is allowed
+	"""Query parts check rules
+	Shows after which parts the current one is allowed
 	"""
-	data = {
+	rules = {
 		'select' : {
-			'select'  : [],
-			'distinct': False,
-			'from'    : [],
-			'join'    : [],
-			'where'   : '',
-			'group'   : [],
-			'having'  : '',
-			'order'   : [],
-			'limit'   : '',
-			'rules'   : {
-				'select' : [''],
-				'from'   : ['select',],
-				'join'   : ['from', 'join'],
-				'where'  : ['from', 'join'],
-				'where+' : ['where', 'where+'],
-				'group'  : ['where', 'where+', 'from', 'join'],
-				'having' : ['group'],
-				'order'  : ['from', 'join', 'where', 'where+', 'group', 'having', 'order'],
-				'limit'  : ['from', 'join', 'where', 'where+', 'group', 'having', 'order'],
-			}
+			'select' : [''],
+			'from'   : ['select',],
+			'join'   : ['from', 'join'],
+			'where'  : ['from', 'join'],
+			'where+' : ['where', 'where+'],
+			'group'  : ['where', 'where+', 'from', 'join'],
+			'having' : ['group'],
+			'order'  : ['from', 'join', 'where', 'where+', 'group', 'having', 'order'],
+			'limit'  : ['from', 'join', 'where', 'where+', 'group', 'having', 'order'],
+			'page'   : ['from', 'join', 'where', 'where+', 'group', 'having'],
+			'prefetch' : ['from', 'join', 'where', 'where+', 'group', 'having', 'order', 'limit', 'page', 'prefetch'],
 		},
 		'insert' : {
-			'id'    : None,
-			'data'  : {},
-			'into'  : '',
-			'rules' : {
-				'insert' : [''],
-				'into'   : ['insert']
-			}
+			'insert'    : [''],
+			'into'      : ['insert'],
+			'conflict'  : ['into'],
+			'returning' : ['into', 'conflict']
 		},
 		'update' : {
-			'table' : '',
-			'data'  : {},
-			'where' : '',
-			'rules' : {
-				'update' : [''],
-				'set'    : ['update'],
-				'where'  : ['set']
-			}
+			'update' : [''],
+			'set'    : ['update'],
+			'where'  : ['set']
 		},
 		'delete' : {
-			'table' : '',
-			'where' : '',
-			'rules' : {
-				'delete' : [''],
-				'where'  : ['delete']
-			}
+			'delete' : [''],
+			'where'  : ['delete']
 		}
 	}
+	
+	"Sql building parameters classes for each query mode"
+	states = {
+		'select' : dbSelectState,
+		'insert' : dbInsertState,
+		'update' : dbUpdateState,
+		'delete' : dbDeleteState
+	}
 
+	"Row classes for namedtuple and slots row representations by query shape"
+	row_classes = {}
+	
 	"Markers for parts orderding managing"
 	marker_curr = ''
 	marker_prev = ''
 	
-	def __init__(self):
-		"""Constructor"""
-		pass
+	def __init__(self, bind = False):
+		"""Constructor
+		*bind* is a compile mode flag, values are passed as placeholders with parameters if set
+		"""
+		self.bind = bind
+		# sql building parameters of the instance by mode
+		self.data = {}
 	
 	def __del__(self):
 		"""Destructor to free resources"""
@@ -282,14 +2054,8 @@ class SqlBuilder:
 		self.marker_curr = ''
 		self.marker_prev = ''
 		# set params for specific data parts
-		if self.mode == 'select':
-			self.data[self.mode].update({'select': [], 'distinct': False, 'from': [], 'join': [], 'where': '', 'group': [], 'having': '', 'order': [], 'limit': ''})
-		elif self.mode == 'insert':
-			self.data[self.mode].update({'id': None, 'data': {}, 'into': ''})
-		elif self.mode == 'update':
-			self.data[self.mode].update({'table': '', 'data': {}, 'where': ''})
-		elif self.mode == 'delete':
-			self.data[self.mode].update({'table': '', 'where': ''})
+		if self.mode in self.states:
+			self.data[self.mode] = self.states[self.mode]()
 
 	def GetInt(self, param):
 		"""Get the int value from param
@@ -315,9 +2081,9 @@ class SqlBuilder:
 		
 		if self.mode and self.mode in self.data:
 			if not skip_check:
-				if self.marker_curr and self.marker_prev in self.data[self.mode]['rules']:
-					if self.marker_curr in self.data[self.mode]['rules']:
-						if self.marker_prev not in self.data[self.mode]['rules'][self.marker_curr]:
+				if self.marker_curr and self.marker_prev in self.rules[self.mode]:
+					if self.marker_curr in self.rules[self.mode]:
+						if self.marker_prev not in self.rules[self.mode][self.marker_curr]:
 							raise Exception("wrong query parts sequence: '%s' can't be after '%s'" % (self.marker_curr, self.marker_prev))
 					else:
 						raise Exception('wrong query part')
@@ -425,17 +2191,23 @@ class SqlBuilder:
 		Returns the object itself
 		"""
 		if table:
+			values = ()
+			# client side rows -> "(select ... from json_each(?)) as name"
+			if isinstance(table, dbValues):
+				table, values = table.Render(self.bind)
 			# table class -> "tblname"
 			if isinstance(table, dbTable):
 				table = table.__name__
+			params = ()
 			if condition:
-				condition = condition.__repr__
+				condition, params = self.Render(condition)
+			params = values + params
 			if table and condition:
 				if mode != '':
 					mode = mode.lower().strip()
 					if not mode in ['inner', 'left outer', 'right outer', 'full outer', 'left', 'right', 'full', 'cross']:
 						mode = ''
-				self.data[self.mode]['join'].append({'table': table, 'cond': condition, 'mode': mode})
+				self.data[self.mode]['join'].append({'table': table, 'cond': condition, 'mode': mode, 'params': params})
 		return self
 	
 	def Join(self, table, condition, mode = ''):
@@ -448,23 +2220,44 @@ class SqlBuilder:
 		self.SetCurrMarker('join')
 		# exec cur part
 		return self.AddJoin(table, condition, mode)
+	
+	def JoinValues(self, values, condition, mode = ''):
+		"""Join client side rows wrapper with permission checks
+		*values* is a dbValues object
+		*condition* is a join condition
+		*mode* can be {INNER | {LEFT | RIGHT | FULL} OUTER | CROSS }
+		Returns the object itself
+		"""
+		if not isinstance(values, dbValues):
+			raise Exception('wrong values')
+		return self.Join(values, condition, mode)
 
+	def Render(self, condition):
+		"""Get the sql of the condition in the current compile mode
+		*condition* is an expression, a column or a free form string
+		Returns tuple of sql and tuple of values
+		"""
+		if isinstance(condition, dbExpression):
+			return condition.Render(self.bind)
+		elif isinstance(condition, dbTableColumn):
+			return (condition.__repr__, ())
+		elif isinstance(condition, str):
+			return (condition.strip(), ())
+		return ('', ())
+	
 	def SetWhere(self, condition):
 		"""Set conditions for select/update query
 		*condition* is a list of where fields
 		Returns the object itself
 		"""
-		where = ''
+		where  = ''
+		params = ()
 		if condition:
-			if isinstance(condition, dbTableColumn):
-				if condition.__repr__:
-					where = condition.__repr__
-					condition.__repr__ = ''
-			if isinstance(condition, str):
-				condition = condition.strip()
-				if condition:
-					where = condition
-		self.data[self.mode]['where'] = where
+			where, params = self.Render(condition)
+		self.data[self.mode]['where']  = where
+		self.data[self.mode]['params'] = params
+		# expression tree is kept to find the shard key values
+		self.data[self.mode]['cond'] = condition if isinstance(condition, dbExpression) else None
 		return self
 	
 	def Where(self, condition):
@@ -482,10 +2275,21 @@ class SqlBuilder:
 		Returns the object itself
 		"""
 		self.SetCurrMarker('where+')
-		where = self.data[self.mode]['where']
+		where  = self.data[self.mode]['where']
+		params = self.data[self.mode]['params']
+		cond   = self.data[self.mode]['cond']
 		self.SetWhere(condition)
 		if self.data[self.mode]['where']:
-			self.data[self.mode]['where'] = '%s and %s' % (where, self.data[self.mode]['where'])
+			self.data[self.mode]['where']  = '%s and %s' % (where, self.data[self.mode]['where'])
+			self.data[self.mode]['params'] = params + self.data[self.mode]['params']
+			if cond is not None and self.data[self.mode]['cond'] is not None:
+				self.data[self.mode]['cond'] = dbExpression.Make('and', (cond, self.data[self.mode]['cond']))
+			else:
+				self.data[self.mode]['cond'] = None
+		else:
+			self.data[self.mode]['where']  = where
+			self.data[self.mode]['params'] = params
+			self.data[self.mode]['cond']   = cond
 		return self
 	
 	def Or(self, condition):
@@ -494,10 +2298,21 @@ class SqlBuilder:
 		Returns the object itself
 		"""
 		self.SetCurrMarker('where+')
-		where = self.data[self.mode]['where']
+		where  = self.data[self.mode]['where']
+		params = self.data[self.mode]['params']
+		cond   = self.data[self.mode]['cond']
 		self.SetWhere(condition)
 		if self.data[self.mode]['where']:
-			self.data[self.mode]['where'] = '%s or %s' % (where, self.data[self.mode]['where'])
+			self.data[self.mode]['where']  = '%s or %s' % (where, self.data[self.mode]['where'])
+			self.data[self.mode]['params'] = params + self.data[self.mode]['params']
+			if cond is not None and self.data[self.mode]['cond'] is not None:
+				self.data[self.mode]['cond'] = dbExpression.Make('or', (cond, self.data[self.mode]['cond']))
+			else:
+				self.data[self.mode]['cond'] = None
+		else:
+			self.data[self.mode]['where']  = where
+			self.data[self.mode]['params'] = params
+			self.data[self.mode]['cond']   = cond
 		return self
 	
 	def SetGroupBy(self, *arguments):
@@ -576,6 +2391,15 @@ class SqlBuilder:
 		if direction not in ['asc', 'desc']:
 			direction = 'asc'
 		if field:
+			# full text search match -> "items_fts.rank", bm25 by default, the index is joined with the same match condition
+			# and gives the rows in rank order itself without sorting
+			if isinstance(field, dbExpression) and field.op == 'match':
+				column = field.args[0]
+				fts, key = column.__data__['search']
+				text, params = dbExpression.Leaf(field.args[1], self.bind)
+				condition = '%s.rowid = %s.%s and %s.%s match %s' % (fts, column.__data__['table'], key, fts, column.__name__, text)
+				self.data[self.mode]['join'].append({'table': fts, 'cond': condition, 'mode': '', 'params': params})
+				self.data[self.mode]['order'].append({direction: '%s.rank' % fts})
 			# table column -> "tblname.colname"
 			if isinstance(field, dbTableColumn):
 				self.data[self.mode]['order'].append({direction: '%s.%s' % (field.__data__['table'], field.__name__)})
@@ -630,14 +2454,59 @@ class SqlBuilder:
 		# exec cur part
 		return self.SetLimit(restriction, offset)
 	
+	def SetPaginate(self, key, page_size = 50, direction = 'asc'):
+		"""Set keyset pagination, pages are fetched by FetchPageFrom
+		Order and limit are set by key fields, the key should be unique and indexed
+		*key* is a column or a list of columns
+		*page_size* is the number of records on a page
+		*direction* is a ordering direction - asc|desc
+		Returns the object itself
+		"""
+		self.data[self.mode]['page'] = None
+		keys = key if isinstance(key, (list, tuple)) else [key]
+		keys = ['%s.%s' % (key.__data__['table'], key.__name__) for key in keys if isinstance(key, dbTableColumn)]
+		page_size = self.GetInt(page_size)
+		direction = direction.lower().strip()
+		if direction not in ['asc', 'desc']:
+			direction = 'asc'
+		if keys and page_size:
+			self.data[self.mode]['page'] = {'keys': keys, 'size': abs(page_size), 'direction': direction, 'op': '>' if direction == 'asc' else '<', 'last': None}
+		return self
+	
+	def Paginate(self, key, page_size = 50, direction = 'asc'):
+		"""Set keyset pagination wrapper with permission checks
+		*key* is a column or a list of columns
+		*page_size* is the number of records on a page
+		*direction* is a ordering direction - asc|desc
+		Returns the object itself
+		"""
+		self.SetCurrMarker('page')
+		# exec cur part
+		return self.SetPaginate(key, page_size, direction)
+	
 	def BuildSelect(self):
 		"""Conbines all the parts of query
 		Returns resutl sql string
 		"""
 		query  = ''
 		select = '*'
+		page   = self.data[self.mode]['page']
+		where  = self.data[self.mode]['where']
+		order  = self.data[self.mode]['order']
+		limit  = self.data[self.mode]['limit']
 		if self.data[self.mode]['select']:
 			select = ', '.join(self.data[self.mode]['select'])
+		if page:
+			# key fields are added to the end of the result to get the next page position
+			select = '%s, %s' % (select, ', '.join(page['keys']))
+			if page['last'] is not None:
+				if len(page['keys']) > 1:
+					seek = '(%s) %s (%s)' % (', '.join(page['keys']), page['op'], ', '.join(['?'] * len(page['keys'])))
+				else:
+					seek = '%s %s ?' % (page['keys'][0], page['op'])
+				where = '(%s) and %s' % (where, seek) if where else seek
+			order = [{page['direction']: key} for key in page['keys']]
+			limit = 'limit %s' % page['size']
 		if self.data[self.mode]['from']:
 			if self.data[self.mode]['distinct']:
 				query = 'select distinct %s from %s' % (select, ', '.join(self.data[self.mode]['from']))
@@ -648,55 +2517,362 @@ class SqlBuilder:
 				for jpart in self.data[self.mode]['join']:
 					join.append(('%s join %s on %s' % (jpart['mode'], jpart['table'], jpart['cond'])).strip())
 				query = '%s %s' % (query, ' '.join(join))
-			if self.data[self.mode]['where']:
-				query = '%s where %s' % (query, self.data[self.mode]['where'])
+			if where:
+				query = '%s where %s' % (query, where)
 			if self.data[self.mode]['group']:
 				query = '%s group by %s' % (query, ', '.join(self.data[self.mode]['group']))
 			if self.data[self.mode]['having']:
 				query = '%s having %s' % (query, self.data[self.mode]['having'])
-			if self.data[self.mode]['order']:
-				for order in self.data[self.mode]['order']:
-					if order:
-						list = []
-						for key in order.keys():
-							list.append('%s %s' % (order[key], key))
-							query = '%s order by %s' % (query, ', '.join(list))
+			if order:
+				list = []
+				for part in order:
+					for key in part.keys():
+						list.append('%s %s' % (part[key], key))
+				if list:
+					query = '%s order by %s' % (query, ', '.join(list))
+			if limit:
+				query = '%s %s' % (query, limit)
 			return query
 		else:
 			raise Exception('wrong query parameters')
 	
+	def Build(self):
+		"""Combines all the parts of query according to the current mode
+		Returns result sql string
+		"""
+		if self.mode == 'select':
+			return self.BuildSelect()
+		elif self.mode == 'insert':
+			return self.BuildInsert()
+		elif self.mode == 'update':
+			return self.BuildUpdate()
+		elif self.mode == 'delete':
+			return self.BuildDelete()
+		raise Exception('inconsistent query')
+	
+	def Compile(self):
+		"""Freezes the current query into the template to run it several times
+		Values given as Param objects are set on each template run
+		Returns SqlTemplate object
+		"""
+		sql = self.Build()
+		if not sql:
+			raise Exception('wrong query parameters')
+		if self.mode == 'select':
+			self.__noprefetch__()
+		return SqlTemplate(self.mode, sql, self.BuildParams(), self.bind, self.mode == 'insert' and bool(self.data[self.mode]['returning']))
+	
+	def BuildParams(self):
+		"""Collects the placeholders values of the current query in order of their appearance
+		Returns tuple of values, empty if compile mode is off
+		"""
+		params = ()
+		if self.mode == 'select':
+			for jpart in self.data[self.mode]['join']:
+				params += jpart['params']
+			params += self.data[self.mode]['params']
+			if self.data[self.mode]['page'] and self.data[self.mode]['page']['last'] is not None:
+				params += tuple(self.data[self.mode]['page']['last'])
+		elif self.bind and self.mode == 'insert':
+			for key in self.data[self.mode]['data'].keys():
+				if isinstance(self.data[self.mode]['data'][key], (str, int, Param)):
+					params += (self.data[self.mode]['data'][key],)
+			params += self.BuildConflict()[1]
+		elif self.mode == 'update':
+			if self.bind:
+				for key in self.data[self.mode]['data'].keys():
+					if isinstance(self.data[self.mode]['data'][key], (str, int, Param)):
+						params += (self.data[self.mode]['data'][key],)
+			params += self.data[self.mode]['params']
+		elif self.mode == 'delete':
+			params += self.data[self.mode]['params']
+		return params
+	
 	def FetchFrom(self, db):
-		"""Get records from selected database
+		"""Get records from selected database, prefetch steps are applied by FetchAllFrom and FetchPageFrom only
+		*db* is a DataBase object with opened connection
+		Returns pointer to query result
+		"""
+		self.__noprefetch__()
+		return self.__cursor__(db)
+	
+	def __noprefetch__(self):
+		"""Check there are no prefetch steps which can't be applied to the records stream"""
+		if self.data[self.mode]['prefetch']:
+			raise Exception('prefetch is supported by FetchAllFrom and FetchPageFrom only')
+	
+	def __cursor__(self, db):
+		"""Run the select query
 		*db* is a DataBase object with opened connection
 		Returns pointer to query result
 		"""
 		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			start = time.perf_counter()
 			self.sql = self.BuildSelect()
 			if self.sql:
-				db.__conn__.row_factory = sqlite3.Row
-				cur = db.__conn__.cursor()
-				cur.execute(self.sql)
-				return cur
+				self.params = self.BuildParams()
+				return db.__read__(self.sql, self.params, time.perf_counter() - start)
 		else:
 			raise Exception('wrong db connection')
-		
+
+	def Explain(self, db):
+		"""Get the plan of the current query
+		*db* is a DataBase object with opened connection
+		Returns list of the plan tree root nodes
+		"""
+		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			self.sql = self.Build()
+			self.params = self.BuildParams()
+			return db.Explain(self.sql, self.params)
+		else:
+			raise Exception('wrong db connection')
+
 	def FetchAllFrom(self, db):
 		"""Get all records from selected database
 		*db* is a DataBase object with opened connection
 		Returns list of dict records result
 		"""
-		# get rows pointer
-		cur = self.FetchFrom(db)
-		if cur and isinstance(cur, sqlite3.Cursor):
-			list = []
-			# iterate and fill list with dicts
-			for row in cur:
-				dict = {}
-				for key in row.keys():
-					dict[key] = row[key]
-				list.append(dict)
-			return list
-			
+		if isinstance(db, DataBase) and db.__results__ is not None and isinstance(db.__conn__, sqlite3.Connection):
+			start = time.perf_counter()
+			self.sql = self.BuildSelect()
+			self.params = self.BuildParams()
+			rows = db.__fetchall__(self.sql, self.params, time.perf_counter() - start)
+		elif isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			# all the records are fetched before the main connection is given to the transaction of other thread
+			with db.__guard__(db.__reader__()):
+				rows = list(self.__iterate__(db, 500, 'dict'))
+		else:
+			rows = list(self.__iterate__(db, 500, 'dict'))
+		if self.data[self.mode]['prefetch']:
+			self.FetchRelated(db, rows)
+		return rows
+	
+	def FetchPageFrom(self, db, token = None):
+		"""Get one page of records from selected database
+		*db* is a DataBase object with opened connection
+		*token* is the position of the page returned with the previous one, the first page if not set
+		Returns tuple of list of dict records and the next page token, None for the last page
+		"""
+		page = self.data[self.mode]['page']
+		if not page:
+			raise Exception('pagination is not defined')
+		page['last'] = None
+		if token:
+			try:
+				page['last'] = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+			except ValueError:
+				raise Exception('wrong page token')
+			if not isinstance(page['last'], list) or len(page['last']) != len(page['keys']):
+				raise Exception('wrong page token')
+		count = len(page['keys'])
+		rows  = []
+		last  = None
+		cur = self.__cursor__(db)
+		try:
+			names = [column[0] for column in cur.description][:-count]
+			cur.row_factory = None
+			for values in cur:
+				rows.append(dict(zip(names, values)))
+				last = values[-count:]
+		finally:
+			cur.close()
+		token = None
+		if len(rows) == page['size']:
+			token = base64.urlsafe_b64encode(json.dumps(list(last)).encode()).decode()
+		if self.data[self.mode]['prefetch']:
+			self.FetchRelated(db, rows)
+		return (rows, token)
+	
+	def SetPrefetch(self, table, on, to = None, name = None):
+		"""Add the related table to fetch with one query for all records, applied by FetchAllFrom and FetchPageFrom
+		*table* is the related table
+		*on* is the selected column with the key, can be the column of the table prefetched before
+		*to* is the related table column the key refers to, the primary key if not set
+		*name* is the record field to put the related row to, the table name if not set;
+		the field gets the list of rows if *to* isn't the primary or unique key
+		Returns the object itself
+		"""
+		if not isinstance(table, dbTable) or not isinstance(on, dbTableColumn):
+			raise Exception('wrong prefetch parameters')
+		keys = [column for column in table.__columns__ if getattr(table, column).__data__['pk']]
+		if to is None:
+			if len(keys) != 1:
+				raise Exception('wrong prefetch parameters')
+			to = getattr(table, keys[0])
+		if not isinstance(to, dbTableColumn) or to.__data__['table'] != table.__name__:
+			raise Exception('wrong prefetch parameters')
+		unique = keys == [to.__name__] or any(index['unique'] and index['columns'] == [to.__name__] for index in table.__indexes__.values())
+		self.data[self.mode]['prefetch'].append({'table': table, 'on': on, 'to': to, 'name': name or table.__name__, 'many': not unique})
+		return self
+	
+	def Prefetch(self, table, on, to = None, name = None):
+		"""Add the related table to fetch wrapper with permission checks
+		*table* is the related table
+		*on* is the selected column with the key, can be the column of the table prefetched before
+		*to* is the related table column the key refers to, the primary key if not set
+		*name* is the record field to put the related row to, the table name if not set
+		Returns the object itself
+		"""
+		self.SetCurrMarker('prefetch')
+		# exec cur part
+		return self.SetPrefetch(table, on, to, name)
+	
+	def FetchRelated(self, db, rows):
+		"""Fetch the prefetched tables rows and attach them to the records, one query for each table
+		*db* is a DataBase object with opened connection
+		*rows* is the list of dict records
+		Returns the records
+		"""
+		fetched = {}
+		for prefetch in self.data[self.mode]['prefetch']:
+			# keys are taken from the rows of the table prefetched before if the column belongs to it
+			parents = fetched.get(prefetch['on'].__data__['table'], rows)
+			key  = prefetch['on'].__name__
+			keys = {}
+			for parent in parents:
+				if key not in parent:
+					raise Exception("prefetch key '%s' is not selected" % key)
+				if parent[key] is not None:
+					keys[parent[key]] = None
+			related = []
+			if keys:
+				query   = SqlBuilder(self.bind).Select().From(prefetch['table']).Where(prefetch['to'].In(list(keys)))
+				related = query.FetchAllFrom(db)
+			fetched[prefetch['table'].__name__] = related
+			groups = {}
+			for row in related:
+				if prefetch['many']:
+					groups.setdefault(row[prefetch['to'].__name__], []).append(row)
+				else:
+					groups[row[prefetch['to'].__name__]] = row
+			for parent in parents:
+				parent[prefetch['name']] = groups.get(parent[key], [] if prefetch['many'] else None)
+		return rows
+	
+	def GetColumnTypes(self, db):
+		"""Get declared types of the selected fields
+		*db* is a DataBase object with tables structure
+		Returns dict of field name and type affinity
+		"""
+		types  = {}
+		fields = list(self.data[self.mode]['select'])
+		tables = self.data[self.mode]['from'] + [jpart['table'] for jpart in self.data[self.mode]['join']]
+		if not fields:
+			fields = ['%s.*' % table for table in tables]
+		for field in fields:
+			if '.' in field:
+				table, name = field.split('.', 1)
+			elif len(tables) == 1:
+				table, name = tables[0], field
+			else:
+				continue
+			table = getattr(db, table, None)
+			if isinstance(table, dbTable):
+				for column in vars(table).values():
+					if isinstance(column, dbTableColumn) and name in ['*', column.__name__]:
+						types.setdefault(column.__name__, column.__affinity__())
+		return types
+	
+	def FetchColumnsFrom(self, db, chunk_size = 10000):
+		"""Get all records from selected database in columnar form
+		Integer and real fields are packed to typed arrays, numpy ones if available
+		*db* is a DataBase object with opened connection
+		*chunk_size* is a number of records fetched at once
+		Returns dict of field name and pair of values array and null mask array
+		"""
+		types = self.GetColumnTypes(db)
+		cur   = self.FetchFrom(db)
+		cur.row_factory = None
+		names = [column[0] for column in cur.description]
+		codes = [{'integer': 'q', 'real': 'd', 'numeric': 'd'}.get(types.get(name)) for name in names]
+		data  = [array.array(code) if code else [] for code in codes]
+		nulls = [array.array('b') for name in names]
+		try:
+			while True:
+				rows = cur.fetchmany(chunk_size)
+				if not rows:
+					break
+				# pivot the whole chunk at once
+				for pos, values in enumerate(zip(*rows)):
+					mask = [value is None for value in values]
+					nulls[pos].extend(mask)
+					if codes[pos] and True in mask:
+						values = [0 if value is None else value for value in values]
+					if not codes[pos]:
+						data[pos].extend(values)
+						continue
+					try:
+						# the chunk is packed apart, so a failure leaves the column values untouched
+						data[pos].extend(array.array(codes[pos], values))
+					except (TypeError, OverflowError):
+						# declared type doesn't match the stored values or integers don't fit 64 bits
+						codes[pos] = None
+						data[pos]  = data[pos].tolist() + list(values)
+		finally:
+			cur.close()
+		result = {}
+		for pos, name in enumerate(names):
+			if numpy is not None:
+				if codes[pos]:
+					values = numpy.frombuffer(data[pos], dtype = {'q': numpy.int64, 'd': numpy.float64}[codes[pos]])
+				else:
+					values = numpy.array(data[pos], dtype = object)
+				result[name] = (values, numpy.frombuffer(nulls[pos], dtype = numpy.bool_))
+			else:
+				result[name] = (data[pos], nulls[pos])
+		return result
+	
+	@classmethod
+	def RowFactory(cls, names, row = 'row'):
+		"""Get the cursor row factory for the given row representation
+		*names* is a tuple of result column names
+		*row* is the row representation - {tuple|row|dict|namedtuple|slots}
+		Returns factory function or None for plain tuples
+		"""
+		if row == 'tuple':
+			return None
+		elif row == 'row':
+			return sqlite3.Row
+		elif row == 'dict':
+			return lambda cur, values: dict(zip(names, values))
+		elif row in ['namedtuple', 'slots']:
+			# row class is built once per query shape
+			key = (row, names)
+			row_class = cls.row_classes.get(key)
+			if row_class is None:
+				if row == 'namedtuple':
+					row_class = collections.namedtuple('Row', names, rename = True)
+				else:
+					row_class = type('Row', (dbRow,), {'__slots__': collections.namedtuple('Row', names, rename = True)._fields})
+				# the first class built for the shape wins on concurrent calls
+				row_class = cls.row_classes.setdefault(key, row_class)
+			return lambda cur, values: row_class(*values)
+		raise Exception('wrong row representation')
+	
+	def IterFrom(self, db, chunk_size = 500, row = 'row'):
+		"""Iterate records from selected database fetching them by chunks, prefetch steps are not supported
+		*db* is a DataBase object with opened connection
+		*chunk_size* is a number of records fetched at once
+		*row* is the row representation - {tuple|row|dict|namedtuple|slots}
+		Returns records generator
+		"""
+		self.__noprefetch__()
+		return self.__iterate__(db, chunk_size, row)
+	
+	def __iterate__(self, db, chunk_size, row):
+		"""Records generator for IterFrom"""
+		cur = self.__cursor__(db)
+		cur.row_factory = self.RowFactory(tuple(column[0] for column in cur.description), row)
+		try:
+			while True:
+				rows = cur.fetchmany(chunk_size)
+				if not rows:
+					break
+				yield from rows
+		finally:
+			cur.close()
+	
+
 	def SetInsert(self, data):
 		"""Set data for insert
 		*data* list of fields in dict form
@@ -739,6 +2915,83 @@ class SqlBuilder:
 		# exec cur part
 		return self.SetInto(table)
 	
+	def SetOnConflict(self, columns = (), update = None):
+		"""Set the unique constraint conflict resolution for insert
+		*columns* is the conflict target column or list of columns, required for update
+		*update* is the dict of column values or the list of columns to take from the inserted row, the row is skipped if not set
+		Returns the object itself
+		"""
+		columns = columns if isinstance(columns, (list, tuple)) else [columns]
+		target = []
+		for column in columns:
+			if isinstance(column, dbTableColumn):
+				target.append(column.__name__)
+			elif isinstance(column, str) and column.strip():
+				target.append(column.strip())
+		if update and not isinstance(update, dict):
+			update = [column.__name__ if isinstance(column, dbTableColumn) else column for column in update]
+		self.data[self.mode]['conflict'] = {'target': target, 'update': update or None}
+		return self
+	
+	def OnConflict(self, columns = (), update = None):
+		"""Set the unique constraint conflict resolution wrapper with permission checks
+		*columns* is the conflict target column or list of columns, required for update
+		*update* is the dict of column values or the list of columns to take from the inserted row, the row is skipped if not set
+		Returns the object itself
+		"""
+		self.SetCurrMarker('conflict')
+		# exec cur part
+		return self.SetOnConflict(columns, update)
+	
+	def SetReturning(self, *columns):
+		"""Set the columns of the inserted rows to return
+		*columns* is a list of columns, all columns if not set
+		Returns the object itself
+		"""
+		self.data[self.mode]['returning'] = [column.__name__ if isinstance(column, dbTableColumn) else column for column in columns] or ['*']
+		return self
+	
+	def Returning(self, *columns):
+		"""Set the columns of the inserted rows to return wrapper with permission checks
+		*columns* is a list of columns, all columns if not set
+		Returns the object itself
+		"""
+		self.SetCurrMarker('returning')
+		# exec cur part
+		return self.SetReturning(*columns)
+	
+	def BuildConflict(self):
+		"""Conbines the conflict resolution and returning parts of insert
+		Returns tuple of sql string and the placeholders values
+		"""
+		query    = ''
+		params   = ()
+		conflict = self.data[self.mode]['conflict']
+		if conflict is not None:
+			query = ' on conflict'
+			if conflict['target']:
+				query += ' (%s)' % ', '.join(conflict['target'])
+			if conflict['update'] and isinstance(conflict['update'], dict):
+				values = []
+				for key, value in conflict['update'].items():
+					if self.bind and isinstance(value, (str, int, Param)):
+						values.append('%s = ?' % key)
+						params += (value,)
+					elif isinstance(value, Param):
+						values.append('%s = %s' % (key, value))
+					elif isinstance(value, str):
+						values.append("%s = '%s'" % (key, value))
+					elif isinstance(value, int):
+						values.append('%s = %s' % (key, value))
+				query += ' do update set %s' % ', '.join(values)
+			elif conflict['update']:
+				query += ' do update set %s' % ', '.join(['%s = excluded.%s' % (column, column) for column in conflict['update']])
+			else:
+				query += ' do nothing'
+		if self.data[self.mode]['returning']:
+			query += ' returning %s' % ', '.join(self.data[self.mode]['returning'])
+		return query, params
+	
 	def BuildInsert(self):
 		"""Conbines all the parts of query
 		Returns resutl sql string
@@ -747,30 +3000,126 @@ class SqlBuilder:
 		values = []
 		for key in self.data[self.mode]['data'].keys():
 			fields.append(key)
-			if isinstance(self.data[self.mode]['data'][key], str):
+			if self.bind and isinstance(self.data[self.mode]['data'][key], (str, int, Param)):
+				values.append('?')
+			elif isinstance(self.data[self.mode]['data'][key], Param):
+				values.append(str(self.data[self.mode]['data'][key]))
+			elif isinstance(self.data[self.mode]['data'][key], str):
 				values.append("'%s'" % self.data[self.mode]['data'][key])
 			elif isinstance(self.data[self.mode]['data'][key], int):
 				values.append(str(self.data[self.mode]['data'][key]))
 		if fields and values and self.data[self.mode]['into']:
-			return 'insert into %s (%s) values (%s)' % (self.data[self.mode]['into'], ', '.join(fields), ', '.join(values))
+			return 'insert into %s (%s) values (%s)%s' % (self.data[self.mode]['into'], ', '.join(fields), ', '.join(values), self.BuildConflict()[0])
 	
 	def InsertTo(self, db):
 		"""Insert prepared sql to the selected database
 		*db* is a DataBase object with opened connection
-		Returns pointer to query result
+		Returns the inserted row id or list of dict records if returning is set
 		"""
 		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			start = time.perf_counter()
 			self.sql = self.BuildInsert()
 			if self.sql:
-				cur = db.__conn__.cursor()
-				cur.execute(self.sql)
-				self.data[self.mode]['id'] = cur.lastrowid
-				db.__conn__.commit()
-				cur.close()
-				return self.data[self.mode]['id']
+				self.params = self.BuildParams()
+				rows = [] if self.data[self.mode]['returning'] else None
+				self.data[self.mode]['id'] = db.__write__(self.sql, self.params, time.perf_counter() - start, rows).lastrowid
+				return self.data[self.mode]['id'] if rows is None else rows
 		else:
 			raise Exception('wrong db connection')
 		
+	def SetInsertMany(self, rows, columns = None):
+		"""Set rows for bulk insert
+		*rows* is an iterable of dicts or tuples, it's consumed only on insert
+		*columns* is a list of field names, required for tuples, taken from the first dict otherwise
+		"""
+		self.data[self.mode]['rows'] = None
+		self.data[self.mode]['cols'] = []
+		if rows is not None:
+			self.data[self.mode]['rows'] = rows
+			if columns:
+				for column in columns:
+					# table column -> "colname"
+					if isinstance(column, dbTableColumn):
+						column = column.__name__
+					if isinstance(column, str) and column.strip():
+						self.data[self.mode]['cols'].append(column.strip())
+		return self
+	
+	def InsertMany(self, rows, columns = None):
+		"""Set rows for bulk insert wrapper with permission checks
+		*rows* is an iterable of dicts or tuples, it's consumed only on insert
+		*columns* is a list of field names, required for tuples, taken from the first dict otherwise
+		"""
+		self.SetCurrMode('insert')
+		# exec cur part
+		return self.SetInsertMany(rows, columns)
+	
+	def InsertManyTo(self, db, batch_size = 500, ids = False):
+		"""Insert all prepared rows to the selected database in a single transaction
+		*db* is a DataBase object with opened connection
+		*batch_size* is a number of rows passed to the database at once
+		*ids* is a flag to collect the inserted rows ids
+		Returns list of inserted rows ids if *ids* is set or number of inserted rows otherwise
+		"""
+		if not (db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection)):
+			raise Exception('wrong db connection')
+		if self.data[self.mode]['rows'] is None or not self.data[self.mode]['into']:
+			raise Exception('wrong query parameters')
+		rows    = iter(self.data[self.mode]['rows'])
+		columns = list(self.data[self.mode]['cols'])
+		first   = next(rows, None)
+		if first is None:
+			return [] if ids else 0
+		if not columns:
+			if not isinstance(first, dict):
+				raise Exception('columns are not defined')
+			columns = list(first.keys())
+		# check the columns set once for all rows
+		table = getattr(db, self.data[self.mode]['into'], None)
+		if isinstance(table, dbTable):
+			for column in columns:
+				if not isinstance(getattr(table, column, None), dbTableColumn):
+					raise Exception("wrong column '%s'" % column)
+		conflict, params = self.BuildConflict()
+		if params or self.data[self.mode]['returning']:
+			raise Exception('returning and conflict update values are not supported for bulk insert')
+		self.sql = 'insert into %s (%s) values (%s)%s' % (self.data[self.mode]['into'], ', '.join(columns), ', '.join(['?'] * len(columns)), conflict)
+		self.params = ()
+		# rows to values tuples converter
+		if isinstance(first, dict):
+			convert = lambda row: tuple([row[column] for column in columns])
+		else:
+			convert = tuple
+		rows   = map(convert, itertools.chain([first], rows))
+		result = [] if ids else 0
+		info   = None
+		if db.__hooks__['before'] or db.__hooks__['after']:
+			info = db.__before__('write', self.sql)
+		with db.Transaction():
+			db.__changed__(self.sql)
+			cur = db.__conn__.cursor()
+			try:
+				while True:
+					batch = list(itertools.islice(rows, max(1, batch_size)))
+					if not batch:
+						break
+					if ids:
+						for values in batch:
+							cur.execute(self.sql, values)
+							result.append(cur.lastrowid)
+					else:
+						cur.executemany(self.sql, batch)
+						result += len(batch)
+			finally:
+				cur.close()
+		if info is not None:
+			info.execute = time.perf_counter() - info.start
+			info.changed = len(result) if ids else result
+			db.__after__(info)
+		if ids:
+			self.data[self.mode]['id'] = result[-1]
+		return result
+	
 	def SetUpdate(self, table):
 		"""Set table for update
 		*table* is a table name
@@ -818,7 +3167,11 @@ class SqlBuilder:
 		"""
 		values = []
 		for key in self.data[self.mode]['data'].keys():
-			if isinstance(self.data[self.mode]['data'][key], str):
+			if self.bind and isinstance(self.data[self.mode]['data'][key], (str, int, Param)):
+				values.append('%s = ?' % key)
+			elif isinstance(self.data[self.mode]['data'][key], Param):
+				values.append('%s = %s' % (key, self.data[self.mode]['data'][key]))
+			elif isinstance(self.data[self.mode]['data'][key], str):
 				values.append("%s = '%s'" % (key, self.data[self.mode]['data'][key]))
 			elif isinstance(self.data[self.mode]['data'][key], int):
 				values.append("%s = %s" % (key, self.data[self.mode]['data'][key]))
@@ -834,12 +3187,11 @@ class SqlBuilder:
 		Returns pointer to query result
 		"""
 		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			start = time.perf_counter()
 			self.sql = self.BuildUpdate()
 			if self.sql:
-				cur = db.__conn__.cursor()
-				cur.execute(self.sql)
-				db.__conn__.commit()
-				cur.close()
+				self.params = self.BuildParams()
+				db.__write__(self.sql, self.params, time.perf_counter() - start)
 		else:
 			raise Exception('wrong db connection')
 		
@@ -885,11 +3237,503 @@ class SqlBuilder:
 		Returns pointer to query result
 		"""
 		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			start = time.perf_counter()
 			self.sql = self.BuildDelete()
 			if self.sql:
-				cur = db.__conn__.cursor()
-				cur.execute(self.sql)
-				db.__conn__.commit()
-				cur.close()
+				self.params = self.BuildParams()
+				db.__write__(self.sql, self.params, time.perf_counter() - start)
+		else:
+			raise Exception('wrong db connection')
+
+class SqlTemplate:
+	"""Compiled query template, immutable once created by SqlBuilder.Compile"""
+	
+	__slots__ = ('mode', 'sql', 'slots', 'names', 'bind', 'returning')
+	
+	def __init__(self, mode, sql, params = (), bind = False, returning = False):
+		"""Constructor
+		*mode* is the query mode - {select|insert|update|delete}
+		*sql* is the final query sql
+		*params* is the tuple of placeholders values, Param objects are set on run
+		*bind* is a flag showing if sql has positional placeholders instead of named ones
+		*returning* is a flag showing if the insert returns records
+		"""
+		self.mode  = mode
+		self.sql   = sql
+		self.bind  = bind
+		self.returning = returning
+		self.slots = tuple(params)
+		# positions and names of the values set on run
+		self.names = tuple((pos, param.__name__) for pos, param in enumerate(self.slots) if isinstance(param, Param))
+	
+	def Bind(self, **values):
+		"""Prepares the parameters for execution
+		*values* is the dict of the named parameters values
+		Returns tuple of values in compile mode or dict otherwise
+		"""
+		if not self.bind:
+			return values
+		if not self.names:
+			return self.slots
+		params = list(self.slots)
+		for pos, name in self.names:
+			if name not in values:
+				raise Exception("missing query parameter '%s'" % name)
+			params[pos] = values[name]
+		return tuple(params)
+	
+	def FetchFrom(self, db, **values):
+		"""Get records from selected database
+		*db* is a DataBase object with opened connection
+		*values* is the dict of the named parameters values
+		Returns pointer to query result
+		"""
+		if self.mode != 'select':
+			raise Exception('wrong query mode')
+		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			return db.__read__(self.sql, self.Bind(**values))
+		else:
+			raise Exception('wrong db connection')
+	
+	def FetchAllFrom(self, db, **values):
+		"""Get all records from selected database
+		*db* is a DataBase object with opened connection
+		*values* is the dict of the named parameters values
+		Returns list of dict records result
+		"""
+		if self.mode == 'select' and isinstance(db, DataBase) and db.__results__ is not None and isinstance(db.__conn__, sqlite3.Connection):
+			return db.__fetchall__(self.sql, self.Bind(**values))
+		if isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			with db.__guard__(db.__reader__()):
+				return list(self.IterFrom(db, row = 'dict', **values))
+		return list(self.IterFrom(db, row = 'dict', **values))
+	
+	def IterFrom(self, db, chunk_size = 500, row = 'row', **values):
+		"""Iterate records from selected database fetching them by chunks
+		*db* is a DataBase object with opened connection
+		*chunk_size* is a number of records fetched at once
+		*row* is the row representation - {tuple|row|dict|namedtuple|slots}
+		*values* is the dict of the named parameters values
+		Returns records generator
+		"""
+		cur = self.FetchFrom(db, **values)
+		cur.row_factory = SqlBuilder.RowFactory(tuple(column[0] for column in cur.description), row)
+		try:
+			while True:
+				rows = cur.fetchmany(chunk_size)
+				if not rows:
+					break
+				yield from rows
+		finally:
+			cur.close()
+	
+	def ExecuteIn(self, db, **values):
+		"""Runs insert/update/delete template on the selected database
+		*db* is a DataBase object with opened connection
+		*values* is the dict of the named parameters values
+		Returns the inserted row id or list of dict records if returning is set for insert template
+		"""
+		if self.mode == 'select':
+			raise Exception('wrong query mode')
+		if db and isinstance(db, DataBase) and isinstance(db.__conn__, sqlite3.Connection):
+			rows = [] if self.returning else None
+			cur  = db.__write__(self.sql, self.Bind(**values), 0.0, rows)
+			if rows is not None:
+				return rows
+			if self.mode == 'insert':
+				return cur.lastrowid
+		else:
+			raise Exception('wrong db connection')
+
+class AsyncDataBase:
+	"""Asyncio front-end for DataBase running queries in dedicated threads
+	Queries are compiled on call, so the builder can be reused before the result is awaited.
+	Writes are run one by one in the order of calls by the single thread,
+	reads use the same thread or a thread per pool connection if pool is set,
+	IterFrom chunks may be fetched by different threads from the cursor keeping its pool connection to the end
+	"""
+	
+	def __init__(self, dbfile = None, **options):
+		"""Constructor
+		*dbfile* is a file name of the sqlite db
+		*options* are DataBase constructor options
+		"""
+		self.__writer__ = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+		# the main connection belongs to the thread it's created in
+		self.__db__ = self.__writer__.submit(DataBase, dbfile, **options).result()
+		self.__reader__ = self.__writer__
+		if self.__db__.__pool__ is not None:
+			self.__reader__ = concurrent.futures.ThreadPoolExecutor(max_workers = self.__db__.__pool__.size)
+	
+	def __getattr__(self, name):
+		"""Get the database table to build queries with"""
+		if name.startswith('__'):
+			raise AttributeError(name)
+		return getattr(self.__db__, name)
+	
+	def __run__(self, executor, function, *arguments, **options):
+		"""Run the function in the executor thread
+		Returns awaitable result
+		"""
+		return asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *arguments, **options))
+	
+	def __compile__(self, query):
+		"""Freeze the query to be run in other thread
+		*query* is the SqlBuilder or SqlTemplate object
+		Returns SqlTemplate object
+		"""
+		if isinstance(query, SqlBuilder):
+			return query.Compile()
+		elif isinstance(query, SqlTemplate):
+			return query
+		raise Exception('wrong query')
+	
+	def FetchAllFrom(self, query, **values):
+		"""Get all records
+		*query* is the SqlBuilder or SqlTemplate object
+		*values* is the dict of the named parameters values
+		Returns awaitable list of dict records result
+		"""
+		template = self.__compile__(query)
+		return self.__run__(self.__reader__, template.FetchAllFrom, self.__db__, **values)
+	
+	def IterFrom(self, query, chunk_size = 500, row = 'row', **values):
+		"""Iterate records fetching them by chunks in the executor thread
+		*query* is the SqlBuilder or SqlTemplate object
+		*chunk_size* is a number of records fetched at once
+		*row* is the row representation - {tuple|row|dict|namedtuple|slots}
+		*values* is the dict of the named parameters values
+		Returns async records generator
+		"""
+		return self.__iterate__(self.__compile__(query), chunk_size, row, values)
+	
+	async def __iterate__(self, template, chunk_size, row, values):
+		"""Async records generator for IterFrom"""
+		rows = await self.__run__(self.__reader__, lambda: template.IterFrom(self.__db__, chunk_size, row, **values))
+		try:
+			while True:
+				chunk = await self.__run__(self.__reader__, lambda: list(itertools.islice(rows, chunk_size)))
+				if not chunk:
+					break
+				for item in chunk:
+					yield item
+		finally:
+			await self.__run__(self.__reader__, rows.close)
+	
+	def ExecuteIn(self, query, **values):
+		"""Run insert/update/delete query
+		*query* is the SqlBuilder or SqlTemplate object
+		*values* is the dict of the named parameters values
+		Returns awaitable inserted row id for insert query
+		"""
+		template = self.__compile__(query)
+		return self.__run__(self.__writer__, template.ExecuteIn, self.__db__, **values)
+	
+	InsertTo = UpdateIn = DeleteFrom = ExecuteIn
+	
+	def InsertManyTo(self, query, batch_size = 500, ids = False):
+		"""Insert all prepared rows in a single transaction, the query shouldn't be changed until done
+		*query* is the SqlBuilder object with InsertMany and Into parts set
+		*batch_size* is a number of rows passed to the database at once
+		*ids* is a flag to collect the inserted rows ids
+		Returns awaitable list of inserted rows ids if *ids* is set or number of inserted rows otherwise
+		"""
+		return self.__run__(self.__writer__, query.InsertManyTo, self.__db__, batch_size, ids)
+	
+	async def Close(self):
+		"""Close the database and stop the threads"""
+		await self.__run__(self.__writer__, self.__db__.Close)
+		if self.__reader__ is not self.__writer__:
+			self.__reader__.shutdown()
+		self.__writer__.shutdown()
+
+class ShardedDataBase:
+	"""Tables partitioned across several db files by the shard key column
+	Queries constrained by the shard key with =/in run on its shards only, other ones run on all shards in parallel
+	and their results are merged with order by and limit applied again, count/sum/min/max values are combined.
+	Not partitioned tables are kept in the first file, joins are done inside each file,
+	so partitioned tables can be joined only with each other, the rows of the same key should be in the same shard.
+	Each shard has its own thread, so writes to different shards don't wait for each other
+	"""
+	
+	"Aggregate functions which values can be combined from the shards results"
+	aggregates = {
+		'count' : lambda values: sum(value for value in values if value is not None),
+		'total' : lambda values: sum(value for value in values if value is not None),
+		'sum'   : lambda values: sum(value for value in values if value is not None) if any(value is not None for value in values) else None,
+		'min'   : lambda values: min([value for value in values if value is not None] or [None]),
+		'max'   : lambda values: max([value for value in values if value is not None] or [None])
+	}
+	
+	def __init__(self, dbfiles, keys, **options):
+		"""Constructor
+		*dbfiles* is the list of shard db file names with the same structure
+		*keys* is the dict of partitioned table names and their shard key column names, tables and columns objects are accepted too
+		*options* are DataBase constructor options
+		"""
+		if not dbfiles:
+			raise Exception('no shard files')
+		self.__keys__ = {}
+		for table, column in keys.items():
+			table  = table.__name__ if isinstance(table, dbTable) else table
+			column = column.__name__ if isinstance(column, dbTableColumn) else column
+			self.__keys__[table] = column
+		# the main connection of each shard belongs to the thread it's created in
+		self.__executors__ = [concurrent.futures.ThreadPoolExecutor(max_workers = 1) for dbfile in dbfiles]
+		self.__shards__ = [executor.submit(DataBase, dbfile, **options).result() for executor, dbfile in zip(self.__executors__, dbfiles)]
+	
+	def __getattr__(self, name):
+		"""Get the database table of the first shard to build queries with"""
+		if name.startswith('__'):
+			raise AttributeError(name)
+		return getattr(self.__shards__[0], name)
+	
+	def Shard(self, value):
+		"""Get the shard number of the key value
+		*value* is the shard key value, integers are taken by modulo and other values by crc32 of their text
+		Returns shard number
+		"""
+		if isinstance(value, float) and value.is_integer():
+			value = int(value)
+		if isinstance(value, int):
+			return value % len(self.__shards__)
+		return zlib.crc32(str(value).encode('utf-8')) % len(self.__shards__)
+	
+	@classmethod
+	def Values(cls, condition, table, column):
+		"""Get the shard key values the condition limits the rows to
+		*condition* is the where expression tree
+		*table* is the partitioned table name
+		*column* is the shard key column name
+		Returns set of values or None if the rows are not limited by the key
+		"""
+		if not isinstance(condition, dbExpression):
+			return None
+		if condition.op in ['and', 'or']:
+			# chains are walked without recursion, like in dbExpression.Parts
+			args = []
+			node = condition
+			while isinstance(node, dbExpression) and node.op == condition.op:
+				args.append(node.args[1])
+				node = node.args[0]
+			args.append(node)
+			found = [cls.Values(arg, table, column) for arg in args]
+			if condition.op == 'or':
+				return None if None in found else set().union(*found)
+			found = [values for values in found if values is not None]
+			return set.intersection(*found) if found else None
+		first = condition.args[0]
+		if not (isinstance(first, dbTableColumn) and first.__data__.get('table') == table and first.__name__ == column):
+			return None
+		if condition.op in ['=', 'in*']:
+			values = condition.args[1:]
+		elif condition.op == 'in' and isinstance(condition.args[1], (tuple, list, set, dict)):
+			values = condition.args[1]
+		else:
+			return None
+		for value in values:
+			if isinstance(value, (dbTableColumn, dbExpression, Param)):
+				return None
+		return set(values)
+	
+	def __route__(self, tables, condition = None):
+		"""Get the shards to run the query on
+		*tables* is the list of the query tables names, joined ones included
+		*condition* is the where expression tree
+		Returns list of shard numbers
+		"""
+		partitioned = [table for table in tables if table in self.__keys__]
+		if not partitioned:
+			return [0]
+		if len(partitioned) != len(tables):
+			raise Exception('not partitioned tables are kept in the first shard and can not be joined with partitioned ones')
+		shards = set(range(len(self.__shards__)))
+		for table in partitioned:
+			values = self.Values(condition, table, self.__keys__[table])
+			if values is not None:
+				shards &= set(self.Shard(value) for value in values)
+		# no rows match, any shard gives the right empty result
+		return sorted(shards) or [0]
+	
+	def __map__(self, shards, call):
+		"""Run the call for each shard in its thread
+		*shards* is the list of shard numbers
+		*call* is the function getting the shard number and its DataBase object
+		Returns list of results in order of shards
+		"""
+		futures = [self.__executors__[shard].submit(call, shard, self.__shards__[shard]) for shard in shards]
+		return [future.result() for future in futures]
+	
+	@staticmethod
+	def __clone__(query, changes = None):
+		"""Copy the query to run it in other thread
+		*query* is the SqlBuilder object
+		*changes* is the dict of the query state values to replace
+		Returns SqlBuilder object
+		"""
+		part = SqlBuilder(query.bind)
+		part.mode = query.mode
+		state = query.states[query.mode]()
+		for name in state.__slots__:
+			state[name] = query.data[query.mode][name]
+		for name, value in (changes or {}).items():
+			state[name] = value
+		part.data = {query.mode: state}
+		return part
+	
+	def __check__(self, query, mode):
+		"""Check the query is the builder in the given mode
+		*query* is the SqlBuilder object
+		*mode* is the expected query mode
+		Returns the query state
+		"""
+		if not isinstance(query, SqlBuilder) or query.mode != mode or mode not in query.data:
+			raise Exception('wrong query')
+		return query.data[mode]
+	
+	def FetchAllFrom(self, query):
+		"""Get all records from the shards the query is routed to
+		*query* is the SqlBuilder object in select mode
+		Returns list of dict records result
+		"""
+		state  = self.__check__(query, 'select')
+		# client side rows are joined as subqueries and exist in any shard
+		tables = state['from'] + [join['table'] for join in state['join'] if re.match(r'\w+$', join['table'])]
+		shards = self.__route__(tables, state['cond'])
+		if len(shards) == 1:
+			return self.__map__(shards, lambda shard, db: self.__clone__(query).FetchAllFrom(db))[0]
+		if state['page'] or state['prefetch'] or state['having']:
+			raise Exception('pages, prefetch and having are not supported for queries to several shards')
+		# positions of the aggregated select fields
+		functions = {}
+		for pos, field in enumerate(state['select']):
+			match = re.match(r'(\w+)\(\s*(distinct\b)?', field, re.I)
+			if match and match.group(1).lower() in ['count', 'total', 'sum', 'min', 'max', 'avg', 'group_concat']:
+				if match.group(1).lower() not in self.aggregates:
+					raise Exception("aggregate '%s' can not be combined from several shards" % field)
+				# the same value could be counted in each shard
+				if match.group(2) and match.group(1).lower() not in ['min', 'max']:
+					raise Exception("aggregate '%s' of distinct values can not be combined from several shards" % field)
+				functions[pos] = self.aggregates[match.group(1).lower()]
+		limit  = re.match(r'limit (\d+)(?: offset (\d+))?', state['limit'])
+		offset = int(limit.group(2) or 0) if limit else 0
+		limit  = int(limit.group(1)) if limit else None
+		if functions or state['group']:
+			changes = {'limit': ''}
+		else:
+			# each shard gives all the rows up to the end of the requested part
+			changes = {'limit': 'limit %s' % (limit + offset) if limit is not None else ''}
+		rows = []
+		for part in self.__map__(shards, lambda shard, db: self.__clone__(query, changes).FetchAllFrom(db)):
+			rows.extend(part)
+		if not rows:
+			return rows
+		names = list(rows[0].keys())
+		if functions or state['group']:
+			if len(names) != len(state['select']):
+				raise Exception('aggregated fields should be selected by name')
+			groups = collections.OrderedDict()
+			for row in rows:
+				key = tuple(row[name] for pos, name in enumerate(names) if pos not in functions)
+				groups.setdefault(key, []).append(row)
+			rows = []
+			for key, group in groups.items():
+				row = dict(group[0])
+				for pos, combine in functions.items():
+					row[names[pos]] = combine([item[names[pos]] for item in group])
+				rows.append(row)
+		elif state['distinct']:
+			rows = list(collections.OrderedDict((tuple(row.values()), row) for row in rows).values())
+		# the least significant key is sorted first, sorting is stable
+		for part in reversed(state['order']):
+			for direction, field in part.items():
+				name = field if field in names else field.split('.')[-1]
+				if name not in names:
+					raise Exception("order field '%s' is not selected" % field)
+				# nulls go first in ascending order like in sqlite
+				rows.sort(key = lambda row: (row[name] is not None, row[name]), reverse = direction == 'desc')
+		if limit is not None or offset:
+			rows = rows[offset:offset + limit if limit is not None else None]
+		return rows
+	
+	def InsertTo(self, query):
+		"""Insert the row to the shard of its key value
+		*query* is the SqlBuilder object in insert mode
+		Returns the inserted row id or list of dict records if returning is set
+		"""
+		state = self.__check__(query, 'insert')
+		shard = 0
+		if state['into'] in self.__keys__:
+			key = self.__keys__[state['into']]
+			if key not in state['data'] or isinstance(state['data'][key], Param):
+				raise Exception("shard key '%s' is not set" % key)
+			shard = self.Shard(state['data'][key])
+		part = self.__clone__(query)
+		result = self.__map__([shard], lambda shard, db: part.InsertTo(db))[0]
+		state['id'] = part.data['insert']['id']
+		return result
+	
+	def InsertManyTo(self, query, batch_size = 500, ids = False):
+		"""Insert all prepared rows to the shards of their key values, each shard in a single transaction
+		*query* is the SqlBuilder object with InsertMany and Into parts set
+		*batch_size* is a number of rows passed to the database at once
+		*ids* is a flag to collect the inserted rows ids
+		Returns list of shard number and inserted row id pairs in order of the rows if *ids* is set or number of inserted rows otherwise,
+		ids are given by each shard separately, so the same id could be in several shards
+		"""
+		state = self.__check__(query, 'insert')
+		if state['rows'] is None or not state['into']:
+			raise Exception('wrong query parameters')
+		parts = collections.OrderedDict()
+		order = []
+		if state['into'] in self.__keys__:
+			key = self.__keys__[state['into']]
+			for row in state['rows']:
+				if isinstance(row, dict):
+					value = row[key]
+				elif key in state['cols']:
+					value = row[state['cols'].index(key)]
+				else:
+					raise Exception("shard key '%s' is not set" % key)
+				order.append(self.Shard(value))
+				parts.setdefault(order[-1], []).append(row)
 		else:
-			raise Exception('wrong db connection')
\ No newline at end of file
+			parts[0] = list(state['rows'])
+			order = [0] * len(parts[0])
+		shards  = sorted(parts)
+		results = self.__map__(shards, lambda shard, db: self.__clone__(query, {'rows': parts[shard]}).InsertManyTo(db, batch_size, ids))
+		if ids:
+			found = dict((shard, iter(result)) for shard, result in zip(shards, results))
+			return [(shard, next(found[shard])) for shard in order]
+		return sum(results)
+	
+	def __modify__(self, query, mode, function):
+		"""Run the update/delete query on the shards it's routed to
+		*query* is the SqlBuilder object
+		*mode* is the query mode - {update|delete}
+		*function* is the name of the builder method to run
+		"""
+		state = self.__check__(query, mode)
+		if mode == 'update' and self.__keys__.get(state['table']) in state['data']:
+			raise Exception("shard key '%s' can not be updated" % self.__keys__[state['table']])
+		self.__map__(self.__route__([state['table']], state['cond']), lambda shard, db: getattr(self.__clone__(query), function)(db))
+	
+	def UpdateIn(self, query):
+		"""Update the rows in the shards the query is routed to
+		*query* is the SqlBuilder object in update mode
+		"""
+		self.__modify__(query, 'update', 'UpdateIn')
+	
+	def DeleteFrom(self, query):
+		"""Delete the rows from the shards the query is routed to
+		*query* is the SqlBuilder object in delete mode
+		"""
+		self.__modify__(query, 'delete', 'DeleteFrom')
+	
+	def Close(self):
+		"""Close all the shards and stop their threads"""
+		for executor, shard in zip(self.__executors__, self.__shards__):
+			executor.submit(shard.Close).result()
+			executor.shutdown()
+		self.__shards__ = []
+		self.__executors__ = []
@@ -3,7 +3,15 @@
 __author__ = "DarkPark"
 
 import unittest
+import re
 import time
+import threading
+import tempfile
+import shutil
+import os
+import json
+import asyncio
+import concurrent.futures
 from sql import *
 
 class DataBaseTest(unittest.TestCase):
@@ -37,6 +45,414 @@ class DataBaseTest(unittest.TestCase):
 		self.assertEqual(self.db.sections.sum_inc.__data__['pk'], 0)
 		del self.db
 
+	def test_struct(self):
+		"Check tables, columns, indexes collecting and the structure cache"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		shutil.copy('test.sqlite', path)
+		self.db = DataBase(path, cache=True)
+		self.assertEqual(self.db.items.__columns__[:3], ['id', 'id_src', 'id_section'])
+		self.assertEqual(self.db.info.__indexes__['info_id_item'], {'columns': ['id_item'], 'unique': False})
+		self.assertTrue(self.db.brands.__indexes__['sqlite_autoindex_brands_1']['unique'])
+		self.assertTrue(os.path.isfile(path + '.struct'))
+		self.db.Close()
+		# the same schema version - struct is taken from the cache
+		with open(path + '.struct') as cache:
+			struct = json.load(cache)
+		struct['tables']['sections']['columns'][-1][1] = 'CACHED'
+		with open(path + '.struct', 'w') as cache:
+			json.dump(struct, cache)
+		self.db = DataBase(path, cache=True)
+		self.assertEqual(self.db.sections.sum_dec.__data__['type'], 'CACHED')
+		# changed schema
+		self.db.__conn__.execute('create table tags (id integer primary key, id_item integer references items (id))')
+		self.db.Close()
+		self.db = DataBase(path, cache=True)
+		self.assertEqual(self.db.sections.sum_dec.__data__['type'], 'FLOAT')
+		self.assertEqual(self.db.tags.__fkeys__, [{'columns': ['id_item'], 'table': 'items', 'to': ['id']}])
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_lazy(self):
+		"Check tables creation on the first access"
+		self.db = DataBase('test.sqlite', lazy=True)
+		self.assertNotIn('items', vars(self.db))
+		self.assertEqual(self.db.sections.sum_inc.__data__['type'], 'FLOAT')
+		self.assertIs(self.db.sections, self.db.sections)
+		self.assertEqual(self.db.items.__indexes__['items_name']['columns'], ['name'])
+		with self.assertRaises(AttributeError): self.db.not_exist_table
+		self.db.Warm('info', 'brands', 'sections')
+		self.assertIsInstance(vars(self.db)['info'], dbTable)
+		self.assertNotIn('checks', vars(self.db))
+		rows = SqlBuilder().Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 20).FetchAllFrom(self.db)
+		self.assertEqual(len(rows), 19)
+		del self.db
+
+	def test_transaction(self):
+		"Check explicit transactions with nested savepoints"
+		self.db = DataBase()
+		self.db.__conn__.execute('create table tags (id integer primary key autoincrement, name varchar unique)')
+		self.db.__struct__()
+		query = SqlBuilder()
+		with self.db.Transaction('immediate'):
+			query.Insert({'name': 'a'}).Into(self.db.tags).InsertTo(self.db)
+			self.assertTrue(self.db.__conn__.in_transaction)
+			with self.assertRaises(sqlite3.IntegrityError):
+				with self.db.Transaction():
+					query.Insert({'name': 'b'}).Into(self.db.tags).InsertTo(self.db)
+					query.Insert({'name': 'a'}).Into(self.db.tags).InsertTo(self.db)
+			query.Insert({'name': 'c'}).Into(self.db.tags).InsertTo(self.db)
+		self.assertFalse(self.db.__conn__.in_transaction)
+		self.assertEqual([row['name'] for row in query.Select().From(self.db.tags).FetchAllFrom(self.db)], ['a', 'c'])
+		# rollback of the whole transaction
+		with self.assertRaises(ZeroDivisionError):
+			with self.db.Transaction():
+				query.Delete(self.db.tags).DeleteFrom(self.db)
+				1 / 0
+		self.assertEqual(len(query.Select().From(self.db.tags).FetchAllFrom(self.db)), 2)
+		with self.assertRaises(Exception):
+			with self.db.Transaction('some'): pass
+		del self.db
+
+	def test_isolation(self):
+		"Check reads of other threads don't see the not committed changes of the main connection"
+		folder = tempfile.mkdtemp()
+		conn = sqlite3.connect(os.path.join(folder, 'test.sqlite'))
+		conn.execute('create table tags (id integer primary key, name varchar)')
+		conn.close()
+		for self.db in [DataBase(), DataBase(os.path.join(folder, 'test.sqlite'))]:
+			if not self.db.__dbfile__:
+				self.db.__conn__.execute('create table tags (id integer primary key, name varchar)')
+				self.db.__struct__()
+			rows = []
+			reader = threading.Thread(target=lambda: rows.extend(SqlBuilder().Select().From(self.db.tags).FetchAllFrom(self.db)))
+			with self.assertRaises(ZeroDivisionError):
+				with self.db.Transaction():
+					SqlBuilder().Insert({'name': 'a'}).Into(self.db.tags).InsertTo(self.db)
+					reader.start()
+					# the reader waits for the transaction end
+					reader.join(0.1)
+					self.assertTrue(reader.is_alive())
+					1 / 0
+			reader.join(5)
+			self.assertEqual(rows, [])
+			# streamed rows are not fetched during the transaction either
+			SqlBuilder().Insert({'name': 'x'}).Into(self.db.tags).InsertTo(self.db)
+			cursor = SqlBuilder().Select(self.db.tags.name).From(self.db.tags).FetchFrom(self.db)
+			stream = SqlBuilder().Select(self.db.tags.name).From(self.db.tags).IterFrom(self.db, 1, 'tuple')
+			self.assertEqual(next(stream), ('x',))
+			streamed = []
+			readers = [threading.Thread(target=lambda: rows.extend(row['name'] for row in cursor)), threading.Thread(target=lambda: streamed.extend(stream))]
+			with self.assertRaises(ZeroDivisionError):
+				with self.db.Transaction():
+					SqlBuilder().Insert({'name': 'a'}).Into(self.db.tags).InsertTo(self.db)
+					for reader in readers: reader.start()
+					for reader in readers: reader.join(0.1)
+					self.assertTrue(all(reader.is_alive() for reader in readers))
+					1 / 0
+			for reader in readers: reader.join(5)
+			self.assertEqual([rows, streamed], [['x'], []])
+			# rows of the iteration chunk are returned by the fetch calls after it
+			SqlBuilder().InsertMany([('t%s' % i,) for i in range(600)], ['name']).Into(self.db.tags).InsertManyTo(self.db)
+			cursor = SqlBuilder().Select(self.db.tags.id).From(self.db.tags).FetchFrom(self.db)
+			ids = [next(cursor)['id'], cursor.fetchone()['id']] + [row['id'] for row in cursor.fetchmany(300)] + [next(cursor)['id']] + [row['id'] for row in cursor.fetchall()]
+			self.assertEqual(ids, list(range(1, 602)))
+			self.db.Close()
+		del self.db
+		shutil.rmtree(folder)
+
+	def test_search(self):
+		"Check full text search index creation, sync and match queries"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		shutil.copy('test.sqlite', path)
+		self.db = DataBase(path, plan='raise', plan_rows=100)
+		with self.assertRaises(Exception): self.db.items.name.Match('eeepc')
+		fts = self.db.CreateSearch(self.db.items, [self.db.items.name, self.db.items.art])
+		self.assertEqual(fts.__name__, 'items_fts')
+		names = [row[0] for row in self.db.__conn__.execute('select name from items')]
+		expected = len([name for name in names if 'eeepc' in re.findall(r'[^\W_]+', name.lower())])
+		query = SqlBuilder(bind=True)
+		query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.Match('eeepc') & (self.db.items.id < 1000))
+		self.assertEqual(query.BuildSelect(), 'select items.id from items where ((items.id in (select rowid from items_fts where items_fts.name match ?)) and (items.id < ?))')
+		self.assertGreater(expected, 0)
+		self.assertEqual(len(query.FetchAllFrom(self.db)), expected)
+		# quotes in literal mode
+		literal = SqlBuilder().Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.Match('"it\'s"'))
+		self.assertEqual(literal.BuildSelect(), 'select items.id from items where (items.id in (select rowid from items_fts where items_fts.name match \'"it\'\'s"\'))')
+		self.assertEqual(literal.FetchAllFrom(self.db), [])
+		self.assertEqual(len(SqlBuilder().Select(self.db.items.id).From(self.db.items).OrderBy(self.db.items.name.Match('eeepc OR "it\'s"')).FetchAllFrom(self.db)), expected)
+		# ranked search
+		query.Select(self.db.items.id, self.db.items.name).From(self.db.items).OrderBy(self.db.items.art.Match('epc* OR vx6*')).Limit(3)
+		self.assertEqual(query.BuildSelect(), 'select items.id, items.name from items join items_fts on items_fts.rowid = items.id and items_fts.art match ? order by items_fts.rank asc limit 3')
+		self.assertEqual(len(query.FetchAllFrom(self.db)), 3)
+		# the index follows the table changes
+		id = query.Insert({'id_src': 1, 'id_section': 1, 'id_update': 1, 'id_shop': 1, 'name': 'Планшет Zenpad'}).Into(self.db.items).InsertTo(self.db)
+		match = query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.Match('zenpad')).Compile()
+		self.assertEqual(match.FetchAllFrom(self.db), [{'id': id}])
+		query.Update(self.db.items).Set({'name': 'Планшет Qwertypad'}).Where(self.db.items.id == id).UpdateIn(self.db)
+		self.assertEqual(match.FetchAllFrom(self.db), [])
+		self.assertEqual(len(query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.Match('qwertypad')).FetchAllFrom(self.db)), 1)
+		query.Delete(self.db.items).Where(self.db.items.id == id).DeleteFrom(self.db)
+		self.assertEqual(query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.Match('qwertypad')).FetchAllFrom(self.db), [])
+		# the index is found on the next opening
+		self.db.Close()
+		self.db = DataBase(path, lazy=True)
+		self.assertEqual(self.db.items.name.__data__['search'], ['items_fts', 'id'])
+		with self.assertRaises(Exception): self.db.CreateSearch(self.db.items_attrs, ['value'])
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_writer(self):
+		"Check group commits of the queries from several threads"
+		self.db = DataBase()
+		self.db.__conn__.execute('create table tags (id integer primary key, name varchar unique)')
+		self.db.__struct__()
+		writer = self.db.Writer(batch_size=50, latency=0.01)
+		self.assertIs(self.db.Writer(), writer)
+		futures = []
+		def produce(thread):
+			for i in range(25):
+				if i % 2:
+					futures.append(writer.SubmitRow(self.db.tags, {'name': '%s-%s' % (thread, i)}))
+				else:
+					futures.append(writer.Submit(SqlBuilder(bind=True).Insert({'name': '%s-%s' % (thread, i)}).Into(self.db.tags)))
+		threads = [threading.Thread(target=produce, args=(thread,)) for thread in range(4)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		ids = [future.result(timeout=5) for future in futures]
+		self.assertEqual(len(set(ids)), 100)
+		self.assertLess(writer.commits, 100)
+		# failed query doesn't affect the others of the group
+		failed = writer.SubmitRow('tags', {'name': '0-0'})
+		done = writer.Submit(SqlBuilder().Update(self.db.tags).Set({'name': 'x'}).Where(self.db.tags.name == '0-1'))
+		writer.Flush()
+		self.assertIsInstance(failed.exception(), sqlite3.IntegrityError)
+		self.assertIsNone(done.result())
+		self.assertEqual(len(SqlBuilder().Select().From(self.db.tags).Where(self.db.tags.name == 'x').FetchAllFrom(self.db)), 1)
+		with self.assertRaises(Exception): writer.Submit(SqlBuilder().Select().From(self.db.tags))
+		# full queue
+		small = dbWriter(self.db, batch_size=1, queue_size=2)
+		with self.db.Transaction():
+			futures = [small.SubmitRow('tags', {'name': 'q%s' % i}) for i in range(3)]
+			time.sleep(0.05)
+			with self.assertRaises(Exception): small.SubmitRow('tags', {'name': 'q3'}, timeout=0.05)
+		small.Close()
+		self.assertTrue(all(future.result() for future in futures))
+		with self.assertRaises(Exception): small.SubmitRow('tags', {'name': 'q4'})
+		# queries submitted while closing are committed or rejected
+		closing = dbWriter(self.db, latency=0)
+		futures, rejected = [], []
+		def submit(thread):
+			for i in range(200):
+				try:
+					futures.append(closing.SubmitRow('tags', {'name': 'c%s-%s' % (thread, i)}))
+				except Exception:
+					rejected.append(i)
+		threads = [threading.Thread(target=submit, args=(thread,)) for thread in range(3)]
+		for thread in threads: thread.start()
+		closing.Close()
+		for thread in threads: thread.join()
+		self.assertEqual(len(futures) + len(rejected), 600)
+		self.assertTrue(all(future.done() for future in futures))
+		self.db.Close()
+		del self.db
+
+	def test_replica(self):
+		"Check reading from the in memory copy of the db file"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		conn = sqlite3.connect(path)
+		conn.execute('create table tags (id integer primary key, name varchar)')
+		conn.execute("insert into tags (name) values ('a')")
+		conn.commit()
+		self.db = DataBase(path, replica='memory', replica_check=None)
+		query = SqlBuilder(bind=True)
+		names = query.Select(self.db.tags.name).From(self.db.tags).Compile()
+		self.assertEqual(names.FetchAllFrom(self.db), [{'name': 'a'}])
+		# writes go to the file and are seen after the reload
+		query.Insert({'name': 'b'}).Into(self.db.tags).InsertTo(self.db)
+		self.assertEqual(len(names.FetchAllFrom(self.db)), 1)
+		with self.db.Transaction():
+			self.assertEqual(len(names.FetchAllFrom(self.db)), 2)
+		cur = names.FetchFrom(self.db)
+		self.assertTrue(self.db.Refresh())
+		self.assertEqual(len(names.FetchAllFrom(self.db)), 2)
+		# the cursor opened before the reload reads the previous copy
+		self.assertEqual(len(cur.fetchall()), 1)
+		with self.assertRaises(sqlite3.OperationalError):
+			self.db.__reader__().execute("insert into tags (name) values ('c')")
+		copy = self.db.__replica__.conn
+		self.db.Close()
+		with self.assertRaises(sqlite3.ProgrammingError): copy.execute('select 1')
+		# background reload on other connections commits
+		self.db = DataBase(path, replica='memory', replica_check=0.01)
+		conn.execute("insert into tags (name) values ('c')")
+		conn.commit()
+		for i in range(200):
+			if len(names.FetchAllFrom(self.db)) == 3: break
+			time.sleep(0.01)
+		self.assertEqual(len(names.FetchAllFrom(self.db)), 3)
+		self.db.Close()
+		conn.close()
+		with self.assertRaises(Exception): DataBase(path, replica='disk')
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_results(self):
+		"Check selects results cache invalidation"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		conn = sqlite3.connect(path)
+		conn.execute('create table tags (id integer primary key, name varchar)')
+		conn.execute('create table links (id integer primary key, id_tag integer)')
+		conn.execute('create view names as select name from tags')
+		conn.execute("create trigger tags_delete after delete on tags begin delete from links where id_tag = old.id; end")
+		conn.close()
+		self.db = DataBase(path, results=5, results_check=0)
+		query = SqlBuilder(bind=True)
+		query.Insert({'name': 'a'}).Into(self.db.tags).InsertTo(self.db)
+		names = query.Select().From('names').Compile()
+		self.assertEqual(names.FetchAllFrom(self.db), [{'name': 'a'}])
+		# the same query is taken from the cache
+		self.db.__conn__.execute("insert into tags (name) values ('b')")
+		self.assertEqual(query.Select(self.db.tags.name).From(self.db.tags).FetchAllFrom(self.db), [{'name': 'a'}, {'name': 'b'}])
+		self.assertEqual(names.FetchAllFrom(self.db), [{'name': 'a'}])
+		self.assertEqual(self.db.__results__.hits, 1)
+		# writes to the table drop results of the queries reading it and its views
+		query.Insert({'id_tag': 1}).Into(self.db.links).InsertTo(self.db)
+		self.assertEqual(names.FetchAllFrom(self.db), [{'name': 'a'}])
+		self.assertEqual(query.Select().From(self.db.links).FetchAllFrom(self.db), [{'id': 1, 'id_tag': 1}])
+		query.Delete(self.db.tags).Where(self.db.tags.name == 'a').DeleteFrom(self.db)
+		self.assertEqual(names.FetchAllFrom(self.db), [{'name': 'b'}])
+		self.assertEqual(query.Select().From(self.db.links).FetchAllFrom(self.db), [])
+		# transactions read own writes and drop results on commit
+		with self.db.Transaction():
+			query.InsertMany([('c',), ('d',)], ['name']).Into(self.db.tags).InsertManyTo(self.db)
+			self.assertEqual(len(names.FetchAllFrom(self.db)), 3)
+		self.assertEqual(len(names.FetchAllFrom(self.db)), 3)
+		# other connections commits
+		conn = sqlite3.connect(path)
+		conn.execute("insert into tags (name) values ('e')")
+		conn.commit()
+		conn.close()
+		self.assertEqual(len(names.FetchAllFrom(self.db)), 4)
+		# results over the size are not kept
+		self.assertEqual(len(query.Select().From(self.db.tags).FetchAllFrom(self.db)), 4)
+		self.assertLessEqual(self.db.__results__.rows, 5)
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_profile(self):
+		"Check profiling hooks, statistics and slow queries log"
+		self.db = DataBase()
+		self.db.__conn__.execute('create table tags (id integer primary key, name varchar)')
+		self.db.__struct__()
+		query = SqlBuilder()
+		stats = self.db.AddHook('after', dbQueryStats())
+		before = self.db.AddHook('before', lambda info: self.assertEqual(info.fetched, 0))
+		query.InsertMany([('a',), ('b',), ('c',)], ['name']).Into(self.db.tags).InsertManyTo(self.db)
+		for id in range(1, 4):
+			self.assertEqual(len(query.Select().From(self.db.tags).Where(self.db.tags.id < id).FetchAllFrom(self.db)), id - 1)
+		query.Update(self.db.tags).Set({'name': 'd'}).Where(self.db.tags.id > 1).UpdateIn(self.db)
+		report = dict((item['fingerprint'], item) for item in stats.Report())
+		self.assertEqual(report['select * from tags where (tags.id < ?)']['count'], 3)
+		self.assertEqual(report['select * from tags where (tags.id < ?)']['fetched'], 3)
+		self.assertEqual(report["update tags set name = ? where (tags.id > ?)"]['changed'], 2)
+		self.assertEqual(report['insert into tags (name) values (?+)']['changed'], 3)
+		self.assertLessEqual(stats.Report(1)[0]['p50'], stats.Report(1)[0]['p99'])
+		self.assertEqual(dbQueryInfo.Fingerprint("select * from t1 where id in (1, 2, 3) and name = 'it''s'  and price > -1.5"), 'select * from t1 where id in (?+) and name = ? and price > ?')
+		# slow log and trace callback
+		self.db.RemoveHook('before', before)
+		self.db.AddHook('after', dbSlowLog(0))
+		statements = []
+		self.db.Trace(statements.append)
+		with self.assertLogs('sql', 'WARNING'):
+			query.Select().From(self.db.tags).FetchAllFrom(self.db)
+		self.assertEqual(statements, ['select * from tags'])
+		with self.assertRaises(Exception): self.db.AddHook('during', print)
+		del self.db
+
+	def test_profile_storage(self):
+		"Check storage profiles pragmas applying and restoring"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		shutil.copy('test.sqlite', path)
+		self.db = DataBase(path, profile='read_heavy')
+		pragma = lambda name: self.db.__conn__.execute('pragma %s' % name).fetchone()[0]
+		self.assertEqual([pragma('journal_mode'), pragma('synchronous'), pragma('cache_size'), pragma('temp_store')], ['wal', 1, -65536, 2])
+		self.assertEqual(pragma('page_size'), 32768)
+		with self.db.UseProfile('bulk_load'):
+			self.assertEqual([pragma('journal_mode'), pragma('synchronous'), pragma('cache_size')], ['memory', 0, -262144])
+			SqlBuilder().InsertMany([(1, 1, 1, 1, 'bulk')], ['id_src', 'id_section', 'id_update', 'id_shop', 'name']).Into(self.db.items).InsertManyTo(self.db)
+		self.assertEqual([pragma('journal_mode'), pragma('synchronous'), pragma('cache_size')], ['wal', 1, -65536])
+		with self.assertRaises(Exception): self.db.SetProfile('fast')
+		with self.assertRaises(Exception): self.db.SetProfile({'cache_size': '1; drop table items'})
+		with self.assertRaises(Exception):
+			with self.db.Transaction():
+				self.db.SetProfile('durable')
+		self.db.Close()
+		# pool connections get connection pragmas, journal mode is kept
+		self.db = DataBase(path, pool=1, profile={'journal_mode': 'delete', 'cache_size': -4096})
+		self.assertEqual(pragma('journal_mode'), 'wal')
+		with self.db.Connection() as conn:
+			self.assertEqual(conn.execute('pragma cache_size').fetchone()[0], -4096)
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+		# new db page size and db in memory
+		self.db = DataBase(profile='bulk_load')
+		self.assertEqual([pragma('page_size'), pragma('synchronous')], [8192, 0])
+		del self.db
+
+	def test_pool(self):
+		"Check pool of connections for reading shared between threads"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		shutil.copy('test.sqlite', path)
+		self.db = DataBase(path, pool=2, timeout=0.1)
+		query = SqlBuilder()
+		self.assertEqual(self.db.sections.sum_inc.__data__['type'], 'FLOAT')
+		self.assertEqual(self.db.__conn__.execute('pragma journal_mode').fetchone()[0], 'wal')
+		# each thread reads with its own connection
+		conns, results = [], []
+		def read():
+			with self.db.Connection() as conn:
+				conns.append(conn)
+				results.append(len(SqlBuilder().Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 20).FetchAllFrom(self.db)))
+				time.sleep(0.05)
+		threads = [threading.Thread(target=read) for i in range(2)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(results, [19, 19])
+		self.assertIsNot(conns[0], conns[1])
+		self.assertNotIn(self.db.__conn__, conns)
+		# connections are bound to the thread by the block only
+		self.assertIsNone(self.db.__reader__())
+		with self.db.Connection() as conn:
+			self.assertIs(self.db.__reader__(), conn)
+			self.assertEqual(self.db.__pool__.free.qsize(), 1)
+		self.assertEqual(self.db.__pool__.free.qsize(), 2)
+		conns = [self.db.__pool__.Checkout(), self.db.__pool__.Checkout()]
+		with self.assertRaises(Exception): self.db.__pool__.Checkout()
+		with self.assertRaises(Exception): query.Select().From(self.db.items).FetchAllFrom(self.db)
+		for conn in conns: self.db.__pool__.Checkin(conn)
+		# query connection is returned when the cursor is read or closed
+		cur = query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 5).FetchFrom(self.db)
+		self.assertEqual(self.db.__pool__.free.qsize(), 1)
+		self.assertEqual(len(cur.fetchall()), 4)
+		self.assertEqual(self.db.__pool__.free.qsize(), 2)
+		query.Select(self.db.items.id).From(self.db.items).FetchFrom(self.db).close()
+		self.assertEqual(self.db.__pool__.free.qsize(), 2)
+		# more long lived threads than connections
+		with concurrent.futures.ThreadPoolExecutor(4) as executor:
+			counts = list(executor.map(lambda i: len(SqlBuilder().Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 20).FetchAllFrom(self.db)), range(40)))
+		self.assertEqual(counts, [19] * 40)
+		self.assertEqual(self.db.__pool__.free.qsize(), 2)
+		# readers see committed writes, transactions read own writes
+		tm = str(time.time())
+		query.Insert({'name': tm}).Into(self.db.brands).InsertTo(self.db)
+		self.assertEqual(len(query.Select().From(self.db.brands).Where(self.db.brands.name == tm).FetchAllFrom(self.db)), 1)
+		with self.db.Transaction():
+			query.Delete(self.db.brands).Where(self.db.brands.name == tm).DeleteFrom(self.db)
+			self.assertEqual(len(query.Select().From(self.db.brands).Where(self.db.brands.name == tm).FetchAllFrom(self.db)), 0)
+		self.assertEqual(len(query.Select().From(self.db.brands).Where(self.db.brands.name == tm).FetchAllFrom(self.db)), 0)
+		del self.db
+		shutil.rmtree(os.path.dirname(path))
+
 class SqlBuilderTest(unittest.TestCase):
 	"Test sql queries generator"
 	
@@ -166,6 +582,31 @@ class SqlBuilderTest(unittest.TestCase):
 		self.assertEqual(self.query.SetWhere(self.db.info.id.NotIn({'a':16, 'b':32, 'c':64})).data[self.query.mode]['where'], "(info.id not in ('a', 'c', 'b'))")
 		self.assertEqual(self.query.SetWhere(self.db.info.id.NotIn(['qw', 'as', 'zx'])).data[self.query.mode]['where'], "(info.id not in ('qw', 'as', 'zx'))")
 	
+	def test_expression(self):
+		"Check expression tree nodes sharing and rendering"
+		first  = (self.db.items.id > 10) & (self.db.items.name != 'a')
+		second = (self.db.items.id > 10) & (self.db.items.name != 'a')
+		self.assertIs(first, second)
+		self.assertIsNot(self.db.items.id > 10, self.db.items.id > 11)
+		self.assertIsNot(self.db.items.id_src.In(1, 2), self.db.items.id_src.In([1, 2]))
+		self.assertEqual(first.Render(), ("((items.id > 10) and (items.name != 'a'))", ()))
+		self.assertIs(first.Render(), second.Render())
+		self.assertEqual(first.Render(True), ('((items.id > ?) and (items.name != ?))', (10, 'a')))
+		# conditions can be used several times
+		self.query.Select().From(self.db.items).Where(first)
+		self.assertEqual(self.query.SetWhere(first).data[self.query.mode]['where'], "((items.id > 10) and (items.name != 'a'))")
+		# deep trees
+		condition = self.db.items.id == 0
+		for i in range(1, 500):
+			condition = condition | (self.db.items.id == i)
+		sql, params = condition.Render(True)
+		self.assertEqual(len(params), 500)
+		self.assertTrue(sql.startswith('((items.id = ?) or (items.id = ?) or '))
+		self.assertEqual(len(self.query.Select(self.db.items.id).From(self.db.items).Where(condition).FetchAllFrom(self.db)), 499)
+		# type of expression is the type of its first operand
+		self.assertEqual((self.db.items.name == 'a').type, 'str')
+		with self.assertRaises(TypeError): self.db.items.id == (self.db.items.name == 'a')
+
 	def test_andor(self):
 		"Check additional conditions parameters"
 		self.query.Select(self.db.items).From(self.db.items)
@@ -216,6 +657,52 @@ class SqlBuilderTest(unittest.TestCase):
 		self.assertEqual(self.query.SetLimit('asd', 'qwe').data[self.query.mode]['limit'], '')
 
 
+	def test_paginate(self):
+		"Check limit and keyset pagination"
+		self.assertEqual(self.query.Select(self.db.items.id).From(self.db.items).OrderBy(self.db.items.id_section, 'desc').OrderBy(self.db.items.id).Limit(10, 5).BuildSelect(), 'select items.id from items order by items.id_section desc, items.id asc limit 10 offset 5')
+		self.assertEqual(len(self.query.FetchAllFrom(self.db)), 10)
+		self.query.Select(self.db.items.id, self.db.items.name).From(self.db.items).Where(self.db.items.id < 200).Paginate(self.db.items.id, 50)
+		rows, token, pages = [], None, 0
+		while True:
+			page, token = self.query.FetchPageFrom(self.db, token)
+			rows += page
+			pages += 1
+			if not token: break
+		self.assertEqual(pages, 4)
+		self.assertEqual([row['id'] for row in rows], list(range(1, 200)))
+		self.assertEqual(sorted(rows[0].keys()), ['id', 'name'])
+		self.assertEqual(self.query.sql, 'select items.id, items.name, items.id from items where ((items.id < 200)) and items.id > ? order by items.id asc limit 50')
+		# composite key in reverse order
+		full = self.query.Select().From(self.db.items).Where(self.db.items.id < 200).OrderBy('items.id_section desc, items.id desc').FetchAllFrom(self.db)
+		self.query.Select().From(self.db.items).Where(self.db.items.id < 200).Paginate([self.db.items.id_section, self.db.items.id], 30, 'desc')
+		rows, token = self.query.FetchPageFrom(self.db)
+		while token:
+			page, token = self.query.FetchPageFrom(self.db, token)
+			rows += page
+		self.assertEqual(rows, full)
+		with self.assertRaises(Exception): self.query.FetchPageFrom(self.db, 'qwe')
+		with self.assertRaises(Exception): self.query.Select().From(self.db.items).OrderBy(self.db.items.id).Paginate(self.db.items.id)
+
+	def test_explain(self):
+		"Check query plan and strict plan mode"
+		plan = self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name == 'qwe').Explain(self.db)
+		self.assertEqual(plan[0]['detail'], 'SEARCH items USING COVERING INDEX items_name (name=?)')
+		self.assertEqual(plan[0]['children'], [])
+		db = DataBase('test.sqlite', plan = 'raise', plan_rows = 500)
+		self.assertEqual(len(self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 10).FetchAllFrom(db)), 9)
+		self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.price > 5.0).OrderBy(self.db.items.warranty)
+		with self.assertRaises(Exception) as error: self.query.FetchAllFrom(db)
+		self.assertIn('full scan of items (1000 rows), no index on items(price, warranty); temporary b-tree for order by', str(error.exception))
+		# small tables and log mode
+		db = DataBase('test.sqlite', plan = 'log', plan_rows = 5000)
+		with self.assertLogs('sql', 'WARNING'): self.query.FetchAllFrom(db)
+		self.assertEqual(db.CheckPlan(self.query.sql), ['temporary b-tree for order by'])
+		# queries differing in literal values are checked once
+		for price in [1.0, 2.0, 3.0]:
+			self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.price > price).FetchAllFrom(db)
+		self.assertEqual(len(db.__checked__), 2)
+		with self.assertRaises(Exception): DataBase('test.sqlite', plan = 'qwe')
+
 	def test_permissions(self):
 		"Check wrong order and malformed query parts"
 		# Exception: wrong query parts sequence: 'from' can't be after ''
@@ -248,6 +735,73 @@ class SqlBuilderTest(unittest.TestCase):
 		self.assertEqual(self.query.Delete(self.db.brands).BuildDelete(), "delete from brands")
 		self.assertEqual(self.query.Delete(self.db.brands).Where(self.db.brands.name == 'old').BuildDelete(), "delete from brands where (brands.name = 'old')")
 		
+	def test_bind(self):
+		"Check compile mode with placeholders and parameters"
+		self.query = SqlBuilder(bind=True)
+		self.query.Select().From(self.db.items).Join(self.db.info, self.db.info.id_item == self.db.items.id).Where((self.db.items.name != 'test') | self.db.items.id_src.In(1, 2)).And(self.db.items.price < 5.0)
+		self.assertEqual(self.query.BuildSelect(), 'select * from items join info on (info.id_item = items.id) where ((items.name != ?) or (items.id_src in (?, ?))) and (items.price < ?)')
+		self.assertEqual(self.query.BuildParams(), ('test', 1, 2, 5.0))
+		self.query.Select().From(self.db.items).Where(self.db.items.id.In([20, 40, 60]))
+		self.assertEqual(self.query.BuildSelect(), 'select * from items where (items.id in (?, ?, ?))')
+		self.assertEqual(self.query.BuildParams(), (20, 40, 60))
+		self.assertEqual(self.query.Insert({'name': 'some', 'description': 'some'}).Into(self.db.brands).BuildInsert(), 'insert into brands (name, description) values (?, ?)')
+		self.assertEqual(self.query.BuildParams(), ('some', 'some'))
+		self.assertEqual(self.query.Update(self.db.brands).Set({'name': 'new'}).Where(self.db.brands.name != 'old').BuildUpdate(), 'update brands set name = ? where (brands.name != ?)')
+		self.assertEqual(self.query.BuildParams(), ('new', 'old'))
+		self.assertEqual(self.query.Delete(self.db.brands).Where(self.db.brands.id == 5).BuildDelete(), 'delete from brands where (brands.id = ?)')
+		self.assertEqual(self.query.BuildParams(), (5,))
+		# same sql for different values
+		rows = self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 20).FetchAllFrom(self.db)
+		self.assertEqual(len(rows), 19)
+		sql = self.query.sql
+		rows = self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < 200).FetchAllFrom(self.db)
+		self.assertEqual(len(rows), 199)
+		self.assertEqual(self.query.sql, sql)
+		self.assertEqual(self.query.params, (200,))
+
+	def test_compile(self):
+		"Check query templates with named parameters"
+		self.query = SqlBuilder(bind=True)
+		template = self.query.Select(self.db.items.id).From(self.db.items).Where((self.db.items.id < Param('max')) & (self.db.items.id_src > 0)).Compile()
+		self.assertEqual(template.sql, 'select items.id from items where ((items.id < ?) and (items.id_src > ?))')
+		self.assertEqual(len(template.FetchAllFrom(self.db, max=20)), 19)
+		self.assertEqual(len(template.FetchAllFrom(self.db, max=200)), 199)
+		with self.assertRaises(Exception): template.FetchAllFrom(self.db)
+		with self.assertRaises(Exception): template.ExecuteIn(self.db, max=20)
+		# named placeholders without compile mode
+		template = SqlBuilder().Select(self.db.items.id).From(self.db.items).Where(self.db.items.id < Param('max')).Compile()
+		self.assertEqual(template.sql, 'select items.id from items where (items.id < :max)')
+		self.assertEqual(len(template.FetchAllFrom(self.db, max=20)), 19)
+		# write templates
+		template = self.query.Insert({'name': Param('name'), 'description': 'template'}).Into(self.db.brands).Compile()
+		self.assertEqual(template.sql, 'insert into brands (name, description) values (?, ?)')
+		tm = str(time.time())
+		self.assertTrue(template.ExecuteIn(self.db, name=tm))
+		template = self.query.Delete(self.db.brands).Where(self.db.brands.name == Param('name')).Compile()
+		template.ExecuteIn(self.db, name=tm)
+		self.assertEqual(len(self.query.Select().From(self.db.brands).Where(self.db.brands.name == tm).FetchAllFrom(self.db)), 0)
+
+	def test_state(self):
+		"Check builders don't share query state"
+		other = SqlBuilder()
+		self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id > 10)
+		other.Select(self.db.info.id).From(self.db.info).Where(self.db.info.id < 20)
+		self.assertEqual(self.query.BuildSelect(), 'select items.id from items where (items.id > 10)')
+		self.assertEqual(other.BuildSelect(), 'select info.id from info where (info.id < 20)')
+		self.assertFalse(hasattr(self.query.data[self.query.mode], '__dict__'))
+		# concurrent building
+		errors = []
+		def build(number):
+			query = SqlBuilder()
+			for i in range(200):
+				sql = query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id == number).And(self.db.items.id_src == i).BuildSelect()
+				if sql != 'select items.id from items where (items.id = %s) and (items.id_src = %s)' % (number, i):
+					errors.append(sql)
+		threads = [threading.Thread(target=build, args=(number,)) for number in range(8)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		self.assertEqual(errors, [])
+
 	def test_fetch(self):
 		"Check builded sql results fetching"
 		# Exception: wrong db connection
@@ -261,6 +815,176 @@ class SqlBuilderTest(unittest.TestCase):
 		rows = self.query.Select(self.db.items.id,self.db.items.price).From(self.db.items).Where(self.db.items.id < 200).FetchAllFrom(self.db)
 		self.assertEqual(len(rows), 199)
 
+	def test_insert_many(self):
+		"Check bulk insert"
+		db = DataBase()
+		db.__conn__.execute('create table tags (id integer primary key autoincrement, name varchar unique, weight integer)')
+		db.__struct__()
+		rows = ({'name': 'tag%s' % i, 'weight': i} for i in range(1000))
+		self.assertEqual(self.query.InsertMany(rows).Into(db.tags).InsertManyTo(db, batch_size=128), 1000)
+		self.assertEqual(self.query.sql, 'insert into tags (name, weight) values (?, ?)')
+		ids = self.query.InsertMany([('a', 1), ('b', 2)], [db.tags.name, 'weight']).Into(db.tags).InsertManyTo(db, ids=True)
+		self.assertEqual(ids, [1001, 1002])
+		self.assertEqual(len(self.query.Select().From(db.tags).FetchAllFrom(db)), 1002)
+		# wrong columns, tuples without columns and failed batch
+		with self.assertRaises(Exception): self.query.InsertMany([{'title': 'a'}]).Into(db.tags).InsertManyTo(db)
+		with self.assertRaises(Exception): self.query.InsertMany([('c', 3)]).Into(db.tags).InsertManyTo(db)
+		with self.assertRaises(sqlite3.IntegrityError): self.query.InsertMany([('c', 3), ('a', 4)], ['name', 'weight']).Into(db.tags).InsertManyTo(db)
+		self.assertEqual(len(self.query.Select().From(db.tags).FetchAllFrom(db)), 1002)
+		del db
+
+	def test_upsert(self):
+		"Check insert conflicts resolution, returning and bulk get or create"
+		db = DataBase()
+		db.__conn__.execute('create table tags (id integer primary key, name varchar unique, weight integer)')
+		db.__struct__()
+		self.assertEqual(self.query.Insert({'name': 'a', 'weight': 1}).Into(db.tags).Returning(db.tags.id, 'weight').InsertTo(db), [{'id': 1, 'weight': 1}])
+		self.query.Insert({'name': 'a', 'weight': 2}).Into(db.tags).OnConflict(db.tags.name, ['weight']).Returning()
+		self.assertEqual(self.query.BuildInsert(), "insert into tags (name, weight) values ('a', 2) on conflict (name) do update set weight = excluded.weight returning *")
+		self.assertEqual(self.query.InsertTo(db), [{'id': 1, 'name': 'a', 'weight': 2}])
+		self.assertEqual(self.query.Insert({'name': 'a'}).Into(db.tags).OnConflict().Returning(db.tags.id).InsertTo(db), [])
+		query = SqlBuilder(bind=True).Insert({'name': Param('name'), 'weight': 1}).Into(db.tags).OnConflict('name', {'weight': Param('weight')}).Returning('id')
+		self.assertEqual(query.BuildInsert(), 'insert into tags (name, weight) values (?, ?) on conflict (name) do update set weight = ? returning id')
+		template = query.Compile()
+		self.assertEqual(template.ExecuteIn(db, name='a', weight=5), [{'id': 1}])
+		self.assertEqual(template.ExecuteIn(db, name='b', weight=5), [{'id': 2}])
+		self.assertEqual(self.query.InsertMany([('b', 3), ('c', 3)], ['name', 'weight']).Into(db.tags).OnConflict().InsertManyTo(db), 2)
+		self.assertEqual([row['weight'] for row in self.query.Select().From(db.tags).FetchAllFrom(db)], [5, 1, 3])
+		with self.assertRaises(Exception): self.query.Insert({'name': 'a'}).Into(db.tags).Returning().OnConflict()
+		# get or create
+		ids = db.GetOrCreateMany(db.tags, db.tags.name, ['c', 'd', 'a', 'd', None, 'e'], cache=True, chunk_size=2)
+		self.assertEqual(ids, {'c': 3, 'd': 4, 'a': 1, 'e': 5})
+		self.assertEqual(db.GetOrCreateMany('tags', 'name', ['tag%s' % i for i in range(1000)] + ['e'])['e'], 5)
+		self.assertEqual(len(self.query.Select().From(db.tags).FetchAllFrom(db)), 1005)
+		self.assertEqual(db.__ids__[('tags', 'name')]['d'], 4)
+		self.query.Delete(db.tags).Where(db.tags.name == 'd').DeleteFrom(db)
+		self.assertEqual(db.__ids__, {})
+		self.assertEqual(db.GetOrCreateMany(db.tags, db.tags.name, ['d'], cache=True), {'d': 1006})
+		# replaces and upserts change existing rows like updates
+		SqlTemplate('insert', 'insert or replace into tags (name, weight) values (?, ?)', ('d', 1), True).ExecuteIn(db)
+		self.assertEqual(db.__ids__, {})
+		self.assertEqual(db.GetOrCreateMany(db.tags, db.tags.name, ['d'], cache=True), {'d': 1007})
+		template.ExecuteIn(db, name='d', weight=2)
+		self.assertEqual(db.__ids__, {})
+		db.GetOrCreateMany(db.tags, db.tags.name, ['d'], cache=True)
+		self.query.Insert({'name': 'f'}).Into(db.tags).InsertTo(db)
+		self.assertEqual(db.__ids__[('tags', 'name')], {'d': 1007})
+		with self.assertRaises(Exception): db.GetOrCreateMany(db.tags, 'title', ['a'])
+		with self.assertRaises(sqlite3.OperationalError): db.GetOrCreateMany(db.tags, 'weight', [100])
+		del db
+
+	def test_values(self):
+		"Check big lists of values and client side rows passed as json"
+		self.query.Select().From(self.db.info)
+		self.assertEqual(self.query.SetWhere(self.db.info.id.In(range(3))).data[self.query.mode]['where'], '(info.id in (0, 1, 2))')
+		ids = range(1, 50001)
+		self.assertEqual(self.query.SetWhere(self.db.info.id.NotIn(*ids[:200])).data[self.query.mode]['where'][:59], "(info.id not in (select value from json_each('[1, 2, 3, 4, ")
+		query = SqlBuilder(bind=True).Select(self.db.items.id).From(self.db.items).Where(self.db.items.id.In(iter(ids)))
+		self.assertEqual(len(query.FetchAllFrom(self.db)), 1000)
+		self.assertEqual(query.sql, 'select items.id from items where (items.id in (select value from json_each(?)))')
+		self.assertEqual(len(json.loads(query.params[0])), 50000)
+		self.assertEqual(len(self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.name.NotIn(['item %s' % id for id in ids])).FetchAllFrom(self.db)), 1000)
+		# floats and nulls are kept in the json array, values not encodable to json are rejected
+		prices = [row[0] for row in self.db.__conn__.execute('select distinct price from items where price is not null order by price limit 150')] + [None]
+		self.assertGreater(len(prices), 100)
+		for size in [3, 99, 100, len(prices)]:
+			expected = self.db.__conn__.execute('select count(*) from items where price in (%s)' % ', '.join(['?'] * size), prices[:size]).fetchone()[0]
+			self.assertEqual(len(self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.price.In(*prices[:size])).FetchAllFrom(self.db)), expected)
+			self.assertEqual(len(SqlBuilder(bind=True).Select(self.db.items.id).From(self.db.items).Where(self.db.items.price.In(*prices[:size])).FetchAllFrom(self.db)), expected)
+		with self.assertRaises(Exception): self.query.Select().From(self.db.items).Where(self.db.items.name.In(*[b'x'] * 100)).BuildSelect()
+		# empty lists match nothing for in and everything for not in
+		db = DataBase()
+		db.__conn__.execute('create table tags (id integer primary key, name varchar)')
+		db.__conn__.executemany('insert into tags (name) values (?)', [('a',), ('b',)])
+		db.__struct__()
+		for bind in [False, True]:
+			query = SqlBuilder(bind=bind)
+			self.assertEqual(query.Select().From(db.tags).Where(db.tags.name.In(*[])).FetchAllFrom(db), [])
+			self.assertEqual(len(query.Select().From(db.tags).Where(db.tags.name.NotIn(*[])).FetchAllFrom(db)), 2)
+			query.Delete(db.tags).Where(db.tags.name.In(*[])).DeleteFrom(db)
+			self.assertEqual(len(query.Select().From(db.tags).FetchAllFrom(db)), 2)
+		query.Delete(db.tags).Where(db.tags.name.NotIn(*[])).DeleteFrom(db)
+		self.assertEqual(query.Select().From(db.tags).FetchAllFrom(db), [])
+		db.Close()
+		# join with client side rows
+		values = dbValues('v', ['id', 'qty'], [(10, 2), {'id': 20, 'qty': 4}, (30, None)])
+		self.assertEqual(values.qty.__type__, 'int')
+		query = SqlBuilder(bind=True).Select(self.db.items.id, values.qty).From(self.db.items).JoinValues(values, values.id == self.db.items.id).Where(self.db.items.id > 15)
+		self.assertEqual(query.FetchAllFrom(self.db), [{'id': 20, 'qty': 4}, {'id': 30, 'qty': None}])
+		self.assertEqual(query.params, ('[[10, 2], [20, 4], [30, null]]', 15))
+		rows = self.query.Select(self.db.items.id, values.qty).From(self.db.items).JoinValues(values, values.id == self.db.items.id, 'left').Where(self.db.items.id < 11).FetchAllFrom(self.db)
+		self.assertEqual(rows[-2:], [{'id': 9, 'qty': None}, {'id': 10, 'qty': 2}])
+		with self.assertRaises(Exception): self.query.Select().From(self.db.items).JoinValues(self.db.info, self.db.info.id == self.db.items.id)
+
+	def test_prefetch(self):
+		"Check related tables fetching with one query for each table"
+		statements = []
+		self.db.AddHook('before', lambda info: statements.append(info.sql))
+		self.query.Select(self.db.items.id, self.db.items.id_brand).From(self.db.items).Where(self.db.items.id < 47).And(self.db.items.id > 40)\
+			.Prefetch(self.db.brands, on=self.db.items.id_brand)\
+			.Prefetch(self.db.items_attrs, self.db.items.id, self.db.items_attrs.id_item, 'attrs')\
+			.Prefetch(self.db.attr_keys, self.db.items_attrs.id_attr_key, name='key')
+		rows = self.query.FetchAllFrom(self.db)
+		self.assertEqual(len(statements), 4)
+		self.assertEqual([row['brands'] and row['brands']['name'] for row in rows], [None, 'HP', None, None, 'HP', 'HP'])
+		self.assertEqual([len(row['attrs']) for row in rows], [0, 19, 0, 0, 19, 19])
+		rows = self.query.Select(self.db.items.id).From(self.db.items).Where(self.db.items.id == 5)\
+			.Prefetch(self.db.items_attrs, self.db.items.id, self.db.items_attrs.id_item, 'attrs')\
+			.Prefetch(self.db.attr_keys, self.db.items_attrs.id_attr_key, name='key').FetchAllFrom(self.db)
+		self.assertEqual(len(rows[0]['attrs']), 19)
+		self.assertEqual(rows[0]['attrs'][0]['key'], {'id': 1, 'name': 'Характеристики экрана'})
+		# pages
+		self.query.Select(self.db.items.id, self.db.items.id_brand).From(self.db.items).Paginate(self.db.items.id, 50).Prefetch(self.db.brands, self.db.items.id_brand)
+		rows, token = self.query.FetchPageFrom(self.db)
+		self.assertEqual(rows[41]['brands']['name'], 'HP')
+		with self.assertRaises(Exception): self.query.Select(self.db.items.id).From(self.db.items).Prefetch(self.db.brands, self.db.items.id_brand).FetchAllFrom(self.db)
+		with self.assertRaises(Exception): self.query.Select().From(self.db.items).Prefetch(self.db.brands, self.db.items.id_brand, self.db.items.id)
+		# streaming paths don't attach related rows
+		self.query.Select(self.db.items.id, self.db.items.id_brand).From(self.db.items).Prefetch(self.db.brands, self.db.items.id_brand)
+		with self.assertRaises(Exception): self.query.FetchFrom(self.db)
+		with self.assertRaises(Exception): self.query.IterFrom(self.db)
+		with self.assertRaises(Exception): self.query.Compile()
+
+	def test_iter(self):
+		"Check streaming of the results with different row representations"
+		self.query.Select(self.db.items.id, self.db.items.price).From(self.db.items).Where(self.db.items.id < 20)
+		rows = self.query.IterFrom(self.db, chunk_size=7, row='tuple')
+		self.assertNotIsInstance(rows, list)
+		self.assertEqual(len([row for row in rows if isinstance(row, tuple)]), 19)
+		row = next(self.query.IterFrom(self.db, row='row'))
+		self.assertIsInstance(row, sqlite3.Row)
+		row = next(self.query.IterFrom(self.db, row='dict'))
+		self.assertEqual(sorted(row.keys()), ['id', 'price'])
+		row = next(self.query.IterFrom(self.db, row='namedtuple'))
+		self.assertEqual(row.id, 1)
+		rows = list(self.query.IterFrom(self.db, row='slots'))
+		self.assertEqual((rows[0].id, rows[0]['id'], rows[0][0], rows[0].keys()), (1, 1, 1, ['id', 'price']))
+		self.assertIs(type(rows[0]), type(rows[-1]))
+		self.assertIs(type(rows[0]), type(next(self.query.IterFrom(self.db, row='slots'))))
+		with self.assertRaises(Exception): next(self.query.IterFrom(self.db, row='some'))
+
+	def test_columns(self):
+		"Check columnar results fetching"
+		self.query.Select(self.db.items.id, self.db.items.price, self.db.items.name).From(self.db.items).Where(self.db.items.id < 200)
+		self.assertEqual(self.query.GetColumnTypes(self.db), {'id': 'integer', 'price': 'real', 'name': 'text'})
+		columns = self.query.FetchColumnsFrom(self.db, chunk_size=64)
+		rows = self.query.FetchAllFrom(self.db)
+		self.assertEqual(sorted(columns.keys()), ['id', 'name', 'price'])
+		for name in columns:
+			values, nulls = columns[name]
+			self.assertEqual(len(values), 199)
+			self.assertEqual(list(nulls), [row[name] is None for row in rows])
+			self.assertEqual([value for value, null in zip(values, nulls) if not null], [row[name] for row in rows if row[name] is not None])
+		self.assertEqual(sorted(self.query.Select().From(self.db.sections).GetColumnTypes(self.db).items())[-2:], [('sum_dec', 'real'), ('sum_inc', 'real')])
+		# values not fitting the declared type
+		db = DataBase()
+		db.__conn__.execute('create table t (id integer primary key, value integer)')
+		db.__conn__.executemany('insert into t (value) values (?)', [(1,), (2,), ('x',), (2 ** 63 - 1,), (None,)])
+		db.__struct__()
+		values, nulls = SqlBuilder().Select(db.t.value).From(db.t).FetchColumnsFrom(db, chunk_size=3)['value']
+		self.assertEqual(list(values), [1, 2, 'x', 2 ** 63 - 1, None])
+		self.assertEqual(list(nulls), [0, 0, 0, 0, 1])
+
 	def test_crud(self):
 		"Check sql insert queries"
 		tm1 = str(time.time())
@@ -275,5 +999,119 @@ class SqlBuilderTest(unittest.TestCase):
 		self.query.Delete(self.db.brands).Where(self.db.brands.name == tm2).DeleteFrom(self.db)
 		self.assertEqual(len(self.query.Select().From(self.db.brands).Where(self.db.brands.name == tm2).FetchAllFrom(self.db)), 0)
 
+class AsyncDataBaseTest(unittest.TestCase):
+	"Test asyncio front-end"
+	
+	def test_queries(self):
+		"Check fetching, streaming and writing from the event loop"
+		async def run():
+			db = AsyncDataBase('test.sqlite')
+			query = SqlBuilder(bind=True)
+			rows = await db.FetchAllFrom(query.Select(db.items.id).From(db.items).Where(db.items.id < 20))
+			self.assertEqual(len(rows), 19)
+			template = query.Select(db.items.id).From(db.items).Where(db.items.id < Param('max')).Compile()
+			rows = [row async for row in db.IterFrom(template, chunk_size=8, row='tuple', max=200)]
+			self.assertEqual(rows[:2], [(1,), (2,)])
+			self.assertEqual(len(rows), 199)
+			# writes are done in order of calls
+			tm = str(time.time())
+			results = await asyncio.gather(
+				db.InsertTo(query.Insert({'name': tm}).Into(db.brands)),
+				db.DeleteFrom(query.Delete(db.brands).Where(db.brands.name == tm)),
+				db.FetchAllFrom(query.Select().From(db.brands).Where(db.brands.name == tm)))
+			self.assertTrue(results[0])
+			self.assertEqual(results[2], [])
+			await db.Close()
+		asyncio.run(run())
+
+	def test_pool(self):
+		"Check streaming keeps its pool connection while other queries run in the reader threads"
+		path = os.path.join(tempfile.mkdtemp(), 'test.sqlite')
+		shutil.copy('test.sqlite', path)
+		async def run():
+			db = AsyncDataBase(path, pool=2, timeout=1.0)
+			pool = db.__db__.__pool__
+			query = SqlBuilder(bind=True)
+			template = query.Select(db.items.id).From(db.items).Where(db.items.id < 200).Compile()
+			ids = []
+			async for row in db.IterFrom(template, chunk_size=10, row='tuple'):
+				ids.append(row[0])
+				if len(ids) % 10 == 0:
+					counts = await asyncio.gather(*[db.FetchAllFrom(query.Select(db.items.id).From(db.items).Where(db.items.id < 5)) for i in range(4)])
+					self.assertEqual([len(rows) for rows in counts], [4] * 4)
+					# the cursor connection is not given to other queries between the chunks
+					self.assertEqual(len(pool.conns) - pool.free.qsize(), 1)
+			self.assertEqual(ids, list(range(1, 200)))
+			self.assertEqual(len(pool.conns), pool.free.qsize())
+			await db.Close()
+		asyncio.run(run())
+		shutil.rmtree(os.path.dirname(path))
+
+class ShardedDataBaseTest(unittest.TestCase):
+	"Test tables partitioned across several db files"
+
+	def test_queries(self):
+		"Check routing, fan-out merging and writes to the shards"
+		folder = tempfile.mkdtemp()
+		paths = [os.path.join(folder, 'shard%s.sqlite' % i) for i in range(2)]
+		for path in paths:
+			conn = sqlite3.connect(path)
+			conn.execute('create table items (id integer primary key, id_src integer, name varchar, price float)')
+			conn.execute('create table brands (id integer primary key, name varchar)')
+			conn.execute('create table stock (id integer primary key, id_src integer, id_item integer)')
+			conn.close()
+		db = ShardedDataBase(paths, {'items': 'id_src', 'stock': 'id_src'})
+		query = SqlBuilder(bind=True)
+		rows = [(src, 'item %s' % i, float(i)) for i, src in enumerate([0, 1, 2, 3, 4, 5, 1, 3, 5, 7])]
+		self.assertEqual(db.InsertManyTo(query.InsertMany(rows, ['id_src', 'name', 'price']).Into(db.items)), 10)
+		self.assertTrue(db.InsertTo(query.Insert({'id_src': 9, 'name': 'item 10', 'price': 10}).Into(db.items)))
+		self.assertTrue(db.InsertTo(query.Insert({'name': 'HP'}).Into(db.brands)))
+		with self.assertRaises(Exception): db.InsertTo(query.Insert({'name': 'item'}).Into(db.items))
+		counts = [sqlite3.connect(path).execute('select count(*) from items').fetchone()[0] for path in paths]
+		self.assertEqual(counts, [3, 8])
+		# routed queries run on one shard
+		statements = [[], []]
+		for shard, found in zip(db.__shards__, statements):
+			shard.AddHook('before', lambda info, found=found: found.append(info.sql))
+		rows = db.FetchAllFrom(query.Select(db.items.name).From(db.items).Where(db.items.id_src == 3).OrderBy(db.items.price))
+		self.assertEqual([row['name'] for row in rows], ['item 3', 'item 7'])
+		self.assertEqual([len(found) for found in statements], [0, 1])
+		self.assertEqual(len(db.FetchAllFrom(query.Select().From(db.items).Where(db.items.id_src.In(2, 4)).And(db.items.price > 2.0))), 1)
+		self.assertEqual(db.FetchAllFrom(query.Select(db.brands.name).From(db.brands)), [{'name': 'HP'}])
+		self.assertEqual([len(found) for found in statements], [2, 1])
+		# fan-out with merged order, limit and aggregates
+		rows = db.FetchAllFrom(query.Select(db.items.price).From(db.items).Where(db.items.price > 1.0).OrderBy(db.items.price, 'desc').Limit(3, 2))
+		self.assertEqual(rows, [{'price': 8.0}, {'price': 7.0}, {'price': 6.0}])
+		self.assertEqual([len(found) for found in statements], [3, 2])
+		rows = db.FetchAllFrom(query.Select('count(*),sum(items.price),max(items.price)').From(db.items))
+		self.assertEqual(rows, [{'count(*)': 11, 'sum(items.price)': 55.0, 'max(items.price)': 10.0}])
+		rows = db.FetchAllFrom(query.Select('items.id_src,count(*)').From(db.items).GroupBy(db.items.id_src).OrderBy('count(*) desc, items.id_src'))
+		self.assertEqual(rows[:3], [{'id_src': 1, 'count(*)': 2}, {'id_src': 3, 'count(*)': 2}, {'id_src': 5, 'count(*)': 2}])
+		with self.assertRaises(Exception): db.FetchAllFrom(query.Select('avg(items.price)').From(db.items))
+		# joins are routed by all partitioned tables, not partitioned ones can't be joined
+		db.InsertManyTo(query.InsertMany([(3, 4), (3, 8), (4, 5)], ['id_src', 'id_item']).Into(db.stock))
+		rows = db.FetchAllFrom(query.Select(db.items.name).From(db.stock).Join(db.items, db.items.id_src == db.stock.id_src).Where(db.items.id_src == 3))
+		self.assertEqual(len(rows), 4)
+		self.assertEqual([len(found) for found in statements], [6, 6])
+		with self.assertRaises(Exception): db.FetchAllFrom(query.Select().From(db.items).Join(db.brands, db.brands.id == db.items.id))
+		with self.assertRaises(Exception): db.FetchAllFrom(query.Select().From(db.brands).Join(db.items, db.brands.id == db.items.id).Where(db.items.id_src == 1))
+		# writes run on the routed shards
+		db.UpdateIn(query.Update(db.items).Set({'name': 'odd'}).Where(db.items.id_src.In([1, 3])))
+		db.DeleteFrom(query.Delete(db.items).Where(db.items.price < 2.0))
+		self.assertEqual(len(db.FetchAllFrom(query.Select().From(db.items).Where(db.items.name == 'odd'))), 3)
+		self.assertEqual(len(db.FetchAllFrom(query.Select().From(db.items))), 9)
+		with self.assertRaises(Exception): db.UpdateIn(query.Update(db.items).Set({'id_src': 2}).Where(db.items.id_src == 1))
+		# inserted ids are given with their shards in order of the rows
+		ids = db.InsertManyTo(query.InsertMany([(2, 'new 1'), (3, 'new 2'), (4, 'new 3')], ['id_src', 'name']).Into(db.items), ids=True)
+		self.assertEqual([shard for shard, id in ids], [0, 1, 0])
+		self.assertEqual([db.__shards__[shard].__conn__.execute('select name from items where id = ?', (id,)).fetchone()[0] for shard, id in ids], ['new 1', 'new 2', 'new 3'])
+		self.assertEqual([shard for shard, id in db.InsertManyTo(query.InsertMany([('Dell',)], ['name']).Into(db.brands), ids=True)], [0])
+		# distinct values could be in several shards
+		with self.assertRaises(Exception): db.FetchAllFrom(query.Select('count(distinct(items.id_src))').From(db.items))
+		with self.assertRaises(Exception): db.FetchAllFrom(query.Select('sum(distinct(items.price))').From(db.items))
+		self.assertEqual(db.FetchAllFrom(query.Select('max(distinct(items.price))').From(db.items)), [{'max(distinct(items.price))': 10.0}])
+		db.Close()
+		shutil.rmtree(folder)
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file